@@ -0,0 +1,15 @@
+from setuptools import setup
+
+setup(
+    name="webhookcommon",
+    version="0.1.0",
+    description="Authentication and serving code shared by the webhook router's python servers",
+    packages=["webhookcommon"],
+    install_requires=[
+        "cachetools",
+        "flask",
+        "prometheus_client",
+        "requests",
+        "tornado"
+    ]
+)
@@ -0,0 +1,83 @@
+import webhookcommon.auth
+from webhookcommon.auth import IdentityCache, configure_identity_cache, normal_auth
+from webhookcommon.errors import InvalidCredentialsError, ServiceUnavailableError
+from webhookcommon.launcher import PreforkLauncher
+import flask
+import pytest
+import multiprocessing
+import os
+import signal
+import time
+import urllib.request
+
+import tornado.testing
+
+def test_identity_cache():
+    cache = IdentityCache(max_size=10, expiry=60, rejected_expiry=60)
+
+    assert cache.get("google=token") is None
+
+    cache.set_identity("google=token", "test_user@sanger.ac.uk", "sanger.ac.uk")
+    assert cache.get("google=token") == ("test_user@sanger.ac.uk", "sanger.ac.uk")
+
+    cache.set_rejected("google=rejected", "Invalid token")
+    with pytest.raises(InvalidCredentialsError):
+        cache.get("google=rejected")
+
+def test_normal_auth_only_caches_rejections(monkeypatch):
+    statuses = [503, 401]
+    requested = []
+
+    class FakeResponse:
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+    def get(url, **kwargs):
+        requested.append(url)
+        return FakeResponse(statuses.pop(0))
+
+    monkeypatch.setattr(webhookcommon.auth._session, "get", get)
+    configure_identity_cache()
+
+    with flask.Flask(__name__).test_request_context(headers={"Authorization": "Bearer sanger=token"}):
+        # The provider failing says nothing about the token, so it's asked again
+        with pytest.raises(ServiceUnavailableError):
+            normal_auth("client_id")
+        with pytest.raises(InvalidCredentialsError):
+            normal_auth("client_id")
+        # ... but rejections are cached
+        with pytest.raises(InvalidCredentialsError):
+            normal_auth("client_id")
+
+    assert len(requested) == 2
+
+def test_prefork_launcher_recycles_workers():
+    def pid_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [str(os.getpid()).encode()]
+
+    sock, port = tornado.testing.bind_unused_port()
+    sock.close()
+
+    launcher = PreforkLauncher(lambda: pid_app, "127.0.0.1", port, workers=1, max_requests=1)
+    process = multiprocessing.Process(target=launcher.run)
+    process.start()
+
+    try:
+        pids = []
+        for i in range(3):
+            for attempt in range(50):
+                try:
+                    pids.append(urllib.request.urlopen(f"http://127.0.0.1:{port}/").read())
+                    break
+                except OSError:
+                    time.sleep(0.1)
+
+        # Each request was served by a new worker
+        assert len(pids) == 3
+        assert len(set(pids)) == 3
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.join(10)
+
+    assert process.exitcode == 0
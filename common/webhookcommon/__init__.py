@@ -0,0 +1,3 @@
+"""
+Modules shared by config-server and firewall-config, installed into both of their images
+"""
@@ -0,0 +1,182 @@
+"""
+Functions for authentication.
+"""
+
+import functools
+import hashlib
+import threading
+
+import flask
+import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+import sys
+
+from .errors import InvalidCredentialsError, ServiceUnavailableError
+from .metrics import AUTH_CACHE_LOOKUPS, AUTH_PROVIDER_LATENCY
+
+DEFAULT_IDENTITY_CACHE_SIZE = 10000
+DEFAULT_IDENTITY_CACHE_EXPIRY = 300
+DEFAULT_REJECTED_TOKEN_CACHE_EXPIRY = 30
+AUTH_REQUEST_TIMEOUT = 10
+# Statuses with which the OAuth providers reject a token. Others (such as 429 or 5xx) say nothing
+# about the token, so they aren't cached as rejections
+REJECTED_TOKEN_STATUSES = (400, 401, 403)
+
+# Keep connections to the OAuth providers open between requests
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=20))
+
+class IdentityCache:
+    """
+    Cache from a hash of a bearer token to the identity that the OAuth provider verified for it,
+    so that the provider is only asked once per token per expiry period.
+    Tokens that the provider rejected are also cached, for a (normally shorter) separate expiry,
+    but not tokens that couldn't be checked because the provider failed.
+    """
+    def __init__(self, max_size: int, expiry: float, rejected_expiry: float) -> None:
+        self._identities = TTLCache(maxsize=max_size, ttl=expiry)
+        self._rejected = TTLCache(maxsize=max_size, ttl=rejected_expiry)
+        # cachetools caches aren't thread safe
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str):
+        """
+        Returns the cached (email, domain) of the token, or None if the token isn't cached.
+        Raises InvalidCredentialsError if the token was rejected.
+        """
+        key = IdentityCache._key(token)
+
+        with self._lock:
+            rejection_message = self._rejected.get(key)
+            identity = self._identities.get(key)
+
+        if rejection_message is not None:
+            raise InvalidCredentialsError(rejection_message)
+
+        return identity
+
+    def set_identity(self, token: str, email: str, domain: str):
+        with self._lock:
+            self._identities[IdentityCache._key(token)] = (email, domain)
+
+    def set_rejected(self, token: str, message: str):
+        with self._lock:
+            self._rejected[IdentityCache._key(token)] = message
+
+identity_cache = IdentityCache(
+    DEFAULT_IDENTITY_CACHE_SIZE,
+    DEFAULT_IDENTITY_CACHE_EXPIRY,
+    DEFAULT_REJECTED_TOKEN_CACHE_EXPIRY
+)
+
+def configure_identity_cache(max_size: int = DEFAULT_IDENTITY_CACHE_SIZE,
+                             expiry: float = DEFAULT_IDENTITY_CACHE_EXPIRY,
+                             rejected_expiry: float = DEFAULT_REJECTED_TOKEN_CACHE_EXPIRY):
+    """
+    Replaces the identity cache used by normal_auth with an empty one with the given settings
+    """
+    global identity_cache
+    identity_cache = IdentityCache(max_size, expiry, rejected_expiry)
+
+def test_auth():
+    """
+    Test auth function
+    """
+    try:
+        return flask.request.headers.get("user", "test_user@example.com")
+    except:
+        return "test_user@example.com"
+
+def _get_user_info(url: str, token_content: str) -> dict:
+    """
+    Gets the user info for the token from the OAuth provider's user info url.
+    Raises InvalidCredentialsError if the provider rejects the token, or ServiceUnavailableError
+    if it couldn't be asked.
+    """
+    try:
+        info_request = _session.get(url,
+            headers={
+                "Authorization": f"Bearer {token_content}"
+            },
+            timeout=AUTH_REQUEST_TIMEOUT
+        )
+    except requests.RequestException as e:
+        raise ServiceUnavailableError(f"Failed asking the OAuth provider: {e}") from e
+
+    if info_request.status_code in REJECTED_TOKEN_STATUSES:
+        raise InvalidCredentialsError()
+
+    if info_request.status_code != 200:
+        raise ServiceUnavailableError(f"The OAuth provider responded with {info_request.status_code}.")
+
+    try:
+        return info_request.json()
+    except ValueError as e:
+        raise ServiceUnavailableError("The OAuth provider responded with invalid JSON.") from e
+
+def _verify_token(token_type: str, token_content: str):
+    """
+    Asks the token's provider who the token belongs to, returning (email, domain)
+    """
+    if token_type == "google":
+        google_info = _get_user_info("https://www.googleapis.com/oauth2/v2/userinfo", token_content)
+
+        if google_info.get("hd") != "sanger.ac.uk":
+            raise InvalidCredentialsError("Google Auth doesn't have an address of sanger.ac.uk.")
+
+        return google_info["email"], google_info["hd"]
+    elif token_type == "sanger":
+        sanger_info = _get_user_info("https://www.sanger.ac.uk/oa2/Info", token_content)
+
+        return sanger_info["email"], sanger_info["email"].split("@")[-1]
+    else:
+        raise InvalidCredentialsError(f"Unknown token provider {token_type}.")
+
+def normal_auth(google_oauth_clientID: str) -> str:
+    """
+    Authenticate using google authentication
+    """
+    if flask.request.headers.get("Authorization") is None:
+        raise InvalidCredentialsError("No Authorization header provided.")
+
+    token = flask.request.headers.get("Authorization")[len("Bearer "):] # type: str
+
+    if token is None:
+        raise InvalidCredentialsError("No token provided.")
+
+    if token.find("=") == -1:
+        raise InvalidCredentialsError("Token did not contain an '=' with the token provider.")
+
+    # Keep a reference, in case the cache is reconfigured while the provider is being asked
+    cache = identity_cache
+
+    try:
+        identity = cache.get(token)
+    except InvalidCredentialsError:
+        AUTH_CACHE_LOOKUPS.labels("rejected").inc()
+        raise
+
+    if identity is not None:
+        AUTH_CACHE_LOOKUPS.labels("hit").inc()
+        return identity[0]
+
+    AUTH_CACHE_LOOKUPS.labels("miss").inc()
+
+    token_type = token[:token.find("=")]
+    token_content = token[token.find("=")+1:]
+
+    try:
+        with AUTH_PROVIDER_LATENCY.labels(token_type if token_type in ("google", "sanger") else "unknown").time():
+            email, domain = _verify_token(token_type, token_content)
+    except InvalidCredentialsError as e:
+        cache.set_rejected(token, str(e))
+        raise
+
+    cache.set_identity(token, email, domain)
+
+    return email
@@ -0,0 +1,6 @@
+class InvalidCredentialsError(Exception):
+    pass
+
+
+class ServiceUnavailableError(Exception):
+    pass
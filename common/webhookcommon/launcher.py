@@ -0,0 +1,268 @@
+"""
+Pre-fork launcher, which serves a WSGI app from several worker processes sharing one listening socket.
+"""
+
+import logging
+import os
+import resource
+import signal
+import sys
+import time
+import traceback
+from typing import Callable, Dict
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.wsgi
+
+default_logger = logging.getLogger(__name__)
+
+WORKER_SHUTDOWN_TIMEOUT = 30
+# Workers which exit sooner than this after starting are restarted with a backoff
+MIN_WORKER_LIFETIME = 5
+MAX_RESPAWN_BACKOFF = 30
+POLL_INTERVAL = 0.2
+
+class PreforkLauncher:
+    """
+    Binds the listening socket, then forks workers that each serve requests from it.
+
+    Each worker calls app_factory after it has been forked, so database connections and other
+    per process state are set up in the worker. Workers that exit are replaced, and workers recycle
+    themselves (finishing their requests first) after max_requests requests, or once their
+    memory use goes over max_memory_mb. Sending SIGHUP to the launcher replaces every worker
+    without dropping requests, and SIGTERM or SIGINT gracefully stops every worker.
+    Workers being started, replaced and stopped are logged to logger.
+    """
+    def __init__(self, app_factory: Callable, host: str, port: int, workers: int,
+                 container_factory: Callable = tornado.wsgi.WSGIContainer,
+                 max_requests: int = 0, max_memory_mb: int = 0,
+                 after_fork: Callable = None, logger: logging.Logger = default_logger) -> None:
+        self._app_factory = app_factory
+        self._container_factory = container_factory
+        self._host = host
+        self._port = port
+        self._worker_count = workers
+        self._max_requests = max_requests
+        self._max_memory_mb = max_memory_mb
+        self._after_fork = after_fork
+        self._logger = logger
+
+        self._sockets = []
+        self._workers = {} # type: Dict[int, float]
+        self._retiring = set()
+        self._respawn_backoff = 0
+        self._restart_requested = False
+        self._shutdown_requested = False
+
+        # Worker state
+        self._requests_served = 0
+        self._in_flight = 0
+        self._shutting_down = False
+
+    def run(self):
+        self._sockets = tornado.netutil.bind_sockets(self._port, address=self._host)
+
+        signal.signal(signal.SIGHUP, self._on_restart_signal)
+        signal.signal(signal.SIGTERM, self._on_shutdown_signal)
+        signal.signal(signal.SIGINT, self._on_shutdown_signal)
+
+        self._logger.info("Starting workers.", extra={
+            "workers": self._worker_count,
+            "host": self._host,
+            "port": self._port
+        })
+
+        for i in range(self._worker_count):
+            self._spawn_worker()
+
+        while not self._shutdown_requested:
+            if self._restart_requested:
+                self._restart_requested = False
+                self._restart_workers()
+
+            if not self._reap_workers():
+                time.sleep(POLL_INTERVAL)
+
+        self._stop_workers()
+
+    def _on_restart_signal(self, signum, frame):
+        self._restart_requested = True
+
+    def _on_shutdown_signal(self, signum, frame):
+        self._shutdown_requested = True
+
+    def _spawn_worker(self):
+        pid = os.fork()
+
+        if pid == 0:
+            exit_code = 0
+            try:
+                self._run_worker()
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+
+        self._workers[pid] = time.monotonic()
+
+    def _restart_workers(self):
+        """
+        Starts a new worker for each existing worker, then tells the existing ones to finish up
+        """
+        self._logger.info("Restarting workers.")
+
+        old_workers = [pid for pid in self._workers if pid not in self._retiring]
+        for pid in old_workers:
+            self._spawn_worker()
+            self._retiring.add(pid)
+            os.kill(pid, signal.SIGTERM)
+
+    def _reap_workers(self):
+        """
+        Handles a worker that has exited, replacing it if needed. Returns whether a worker exited
+        """
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return False
+
+        if pid == 0 or pid not in self._workers:
+            return False
+
+        started = self._workers.pop(pid)
+
+        if pid in self._retiring:
+            self._retiring.discard(pid)
+            return True
+
+        if self._shutdown_requested:
+            return True
+
+        # Workers exit cleanly when they are recycled
+        recycled = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+        if not recycled and time.monotonic() - started < MIN_WORKER_LIFETIME:
+            self._respawn_backoff = min(max(self._respawn_backoff * 2, 1), MAX_RESPAWN_BACKOFF)
+            self._logger.error("Worker exited soon after starting.", extra={
+                "pid": pid,
+                "status": status,
+                "backoff": self._respawn_backoff
+            })
+            time.sleep(self._respawn_backoff)
+        else:
+            self._respawn_backoff = 0
+            self._logger.info("Replacing worker.", extra={
+                "pid": pid,
+                "status": status
+            })
+
+        self._spawn_worker()
+
+        return True
+
+    def _stop_workers(self):
+        self._logger.info("Stopping workers.")
+
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+        while len(self._workers) != 0 and time.monotonic() < deadline:
+            if not self._reap_workers():
+                time.sleep(POLL_INTERVAL)
+
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def _run_worker(self):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # The launcher handles Ctrl-C, by telling its workers to stop
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        if self._after_fork is not None:
+            self._after_fork()
+
+        io_loop = tornado.ioloop.IOLoop()
+        io_loop.make_current()
+
+        container = self._container_factory(self._app_factory())
+
+        def handle_request(request):
+            self._requests_served += 1
+            self._in_flight += 1
+
+            done = False
+            def request_done():
+                nonlocal done
+                if not done:
+                    done = True
+                    self._in_flight -= 1
+                    self._on_request_finished(http_server, io_loop)
+
+            finish = request.connection.finish
+            def finish_request():
+                try:
+                    finish()
+                finally:
+                    request_done()
+
+            request.connection.finish = finish_request
+            # A request whose client disconnects may never be finished
+            request.connection.set_close_callback(request_done)
+            container(request)
+
+        http_server = tornado.httpserver.HTTPServer(handle_request)
+        http_server.add_sockets(self._sockets)
+
+        signal.signal(signal.SIGTERM,
+            lambda signum, frame: io_loop.add_callback_from_signal(self._stop_worker, http_server, io_loop))
+
+        io_loop.start()
+
+    def _is_unhealthy(self):
+        if self._max_requests > 0 and self._requests_served >= self._max_requests:
+            return True
+
+        # ru_maxrss is in kilobytes on Linux
+        if self._max_memory_mb > 0 and resource.getrusage(resource.RUSAGE_SELF).ru_maxrss > self._max_memory_mb * 1024:
+            return True
+
+        return False
+
+    def _on_request_finished(self, http_server, io_loop):
+        if self._shutting_down:
+            if self._in_flight == 0:
+                io_loop.stop()
+        elif self._is_unhealthy():
+            self._logger.info("Recycling worker.", extra={
+                "pid": os.getpid(),
+                "requests_served": self._requests_served
+            })
+            self._stop_worker(http_server, io_loop)
+
+    def _stop_worker(self, http_server, io_loop):
+        """
+        Stops accepting requests, then stops the worker once in flight requests are finished
+        """
+        if self._shutting_down:
+            return
+
+        self._shutting_down = True
+        http_server.stop()
+
+        if self._in_flight == 0:
+            io_loop.stop()
+        else:
+            io_loop.call_later(WORKER_SHUTDOWN_TIMEOUT, io_loop.stop)
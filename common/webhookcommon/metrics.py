@@ -0,0 +1,11 @@
+"""Prometheus metrics of the shared modules, exposed at /metrics along with each server's own metrics"""
+
+from prometheus_client import Counter, Histogram
+
+# OAuth providers are expected to take tens of milliseconds, and cache lookups far less
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+AUTH_PROVIDER_LATENCY = Histogram("auth_provider_request_duration_seconds",
+    "Time taken by OAuth providers to verify tokens", ["provider"], buckets=LATENCY_BUCKETS)
+AUTH_CACHE_LOOKUPS = Counter("auth_identity_cache_lookups_total",
+    "Identity cache lookups of bearer tokens", ["result"])
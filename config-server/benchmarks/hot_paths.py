@@ -0,0 +1,231 @@
+"""
+Load test of the config server's hot paths (get_by_token, create_route, get_all_routes and
+get_all_routes_stats) at increasing numbers of routes and concurrency levels.
+
+Requests go through the Flask app of a ConfigServer using test auth. Statistics come from an in memory
+log store filled with synthetic logs, so elasticsearch isn't needed.
+The database is a temporary SQLite file, or with --postgres, the (empty) database given by the
+POSTGRES_* environment variables.
+
+Run from the config-server directory:
+    python -m benchmarks.hot_paths --sizes 1000 10000 100000 --concurrency 1 4 16 --output results.json
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from peewee import SqliteDatabase
+
+from configserver import ConfigServer, get_postgres_db
+from configserver.LogStore import MemoryLogStore
+from configserver.models import Route
+
+from .route_statistics import generate_logs
+from .token_lookup import fill_routes
+
+OPERATIONS = ["get_by_token", "create_route", "get_all_routes", "get_all_routes_stats"]
+
+# Routes are linked to this many users, so the benchmarked user's routes grow with the number of routes
+USERS = 1000
+BENCHMARK_USER = "user-0@example.com"
+
+BENCHMARK_CONFIG = {
+    "googleClientId": "benchmark",
+    "frontEnd": "http://localhost"
+}
+
+READY_TIMEOUT = 60
+
+def _get_by_token(client, tokens, i):
+    return client.get(f"/routes/token/{random.choice(tokens)}").status_code
+
+def _create_route(client, tokens, i):
+    return client.post(
+        "/create-route",
+        data=json.dumps({
+            "name": f"benchmark-route-{i}",
+            "destination": "http://127.0.0.1"
+        }),
+        content_type="application/json",
+        headers={"user": BENCHMARK_USER}
+    ).status_code
+
+def _get_all_routes(client, tokens, i):
+    return client.get("/routes", headers={"user": BENCHMARK_USER}).status_code
+
+def _get_all_routes_stats(client, tokens, i):
+    return client.get("/routes/statistics", headers={"user": BENCHMARK_USER}).status_code
+
+OPERATION_REQUESTS = {
+    "get_by_token": _get_by_token,
+    "create_route": _create_route,
+    "get_all_routes": _get_all_routes,
+    "get_all_routes_stats": _get_all_routes_stats
+}
+
+def _percentile(sorted_values: list, percentile: float):
+    return sorted_values[min(int(len(sorted_values) * percentile / 100), len(sorted_values) - 1)]
+
+def _run_requests(app, request, tokens, concurrency: int, request_count: int):
+    """
+    Makes request_count requests split between concurrency threads, each with its own test client.
+    Returns the throughput, latency percentiles and number of errors
+    """
+    def run_thread(thread_request_count):
+        client = app.test_client()
+        latencies = []
+        errors = 0
+
+        for i in range(thread_request_count):
+            start = time.perf_counter()
+            status_code = request(client, tokens, i)
+            latencies.append(time.perf_counter() - start)
+
+            if status_code >= 400:
+                errors += 1
+
+        return latencies, errors
+
+    thread_request_counts = [
+        request_count // concurrency + (1 if i < request_count % concurrency else 0)
+        for i in range(concurrency)
+    ]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        thread_results = list(executor.map(run_thread, thread_request_counts))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for (thread_latencies, _) in thread_results for latency in thread_latencies)
+
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors for (_, errors) in thread_results),
+        "throughput_rps": len(latencies) / elapsed,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p90_ms": _percentile(latencies, 90) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000
+    }
+
+def _get_db(postgres: bool, max_concurrency: int):
+    if postgres:
+        return get_postgres_db({
+            "database": {
+                "pool": True,
+                "maxConnections": max_concurrency + 1
+            }
+        })
+    else:
+        # Every thread has its own connection, so the database has to be a file rather than in memory
+        database = os.path.join(tempfile.mkdtemp(prefix="config-server-benchmark-"), "benchmark.db")
+        return SqliteDatabase(database, pragmas=[("journal_mode", "wal")])
+
+def run(sizes: list, concurrency_levels: list, operations: list, request_count: int, warmup: int,
+        postgres: bool, logs_per_route: int):
+    db = _get_db(postgres, max(concurrency_levels))
+    log_store = MemoryLogStore()
+    server = ConfigServer(use_test_auth=True, db=db, config_JSON=BENCHMARK_CONFIG, log_store=log_store)
+
+    # Logging every request would be what's measured
+    logging.getLogger("config_server").setLevel(logging.WARNING)
+
+    if not server.readiness.wait_until_ready(timeout=READY_TIMEOUT):
+        raise RuntimeError("The database didn't become ready")
+
+    app = server.app.app
+    results = []
+    tokens = []
+    logged_uuids = set()
+
+    db.connect()
+    if postgres and Route.select().count() != 0:
+        raise RuntimeError("The benchmark needs an empty database")
+
+    for size in sorted(sizes):
+        tokens += fill_routes(db, size, len(tokens), USERS)
+
+        new_uuids = [route.uuid for route in Route.select(Route.uuid) if route.uuid not in logged_uuids]
+        log_store.add_logs(generate_logs(new_uuids, len(new_uuids) * logs_per_route))
+        logged_uuids.update(new_uuids)
+        db.close()
+
+        for concurrency in sorted(concurrency_levels):
+            for operation in operations:
+                request = OPERATION_REQUESTS[operation]
+
+                if warmup > 0:
+                    _run_requests(app, request, tokens, 1, warmup)
+
+                result = {
+                    "routes": size,
+                    "concurrency": concurrency,
+                    "operation": operation,
+                    **_run_requests(app, request, tokens, concurrency, request_count)
+                }
+                results.append(result)
+
+                print(f"{size:>9} routes, {concurrency:>3} threads, {operation:<20}: "
+                      f"{result['throughput_rps']:>8.1f} req/s, p50 {result['p50_ms']:.2f}ms, "
+                      f"p99 {result['p99_ms']:.2f}ms, {result['errors']} errors")
+
+        db.connect()
+
+    db.close()
+    server.close()
+
+    return results
+
+def _get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests the config server's hot paths")
+    parser.add_argument("--sizes", help="Numbers of routes to benchmark at", type=int, nargs="+",
+        default=[1000, 10000, 100000])
+    parser.add_argument("--concurrency", help="Numbers of concurrent clients to benchmark with", type=int, nargs="+",
+        default=[1, 4, 16])
+    parser.add_argument("--operations", help="Operations to benchmark", nargs="+", choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument("--requests", help="Number of requests to time for each operation", type=int, default=1000)
+    parser.add_argument("--warmup", help="Number of untimed requests before each operation", type=int, default=20)
+    parser.add_argument("--postgres", help="Use the Postgres database from the POSTGRES_* environment variables, "
+        "which must be empty", action="store_true")
+    parser.add_argument("--logs-per-route", help="Number of synthetic logs to add for each route", type=int, default=100)
+    parser.add_argument("--seed", help="Seed for choosing tokens to look up", type=int, default=0)
+    parser.add_argument("--output", help="File to write the results to as JSON")
+
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+
+    results = run(options.sizes, options.concurrency, options.operations, options.requests, options.warmup,
+        options.postgres, options.logs_per_route)
+
+    if options.output is not None:
+        with open(options.output, "w") as output_file:
+            json.dump({
+                "commit": _get_commit(),
+                "date": datetime.datetime.utcnow().isoformat() + "Z",
+                "python": sys.version,
+                "platform": platform.platform(),
+                "database": "postgres" if options.postgres else "sqlite",
+                "options": vars(options),
+                "results": results
+            }, output_file, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark of the route statistics and logs queries, against an in memory log store filled
+with synthetic router logs, so no elasticsearch is needed.
+
+Run from the config-server directory:
+    python -m benchmarks.route_statistics --logs 100000 1000000 5000000 --routes 1000 --output results.json
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+import uuid
+
+from configserver.LogStore import MemoryLogStore
+from configserver.StatisticQueryier import STATISTIC_PERIODS, StatisticQueryier
+
+# Logs are spread over the last week
+LOG_SPAN_MS = STATISTIC_PERIODS["week"]
+SUCCESS_RATE = 0.9
+STATS_BATCH_SIZE = 50
+
+def generate_logs(uuids: list, count: int, span_ms: int = LOG_SPAN_MS, success_rate: float = SUCCESS_RATE):
+    """
+    Yields count synthetic router logs, spread randomly over the routes and the last span_ms milliseconds
+    """
+    now = int(time.time() * 1000)
+
+    for i in range(count):
+        success = random.random() < success_rate
+
+        yield {
+            "uuid": random.choice(uuids),
+            "success": success,
+            "@timestamp": now - random.randrange(span_ms),
+            "message": "Successfully routed" if success else "Failed to route",
+            "status_code": 200 if success else 500
+        }
+
+def _time_queries(query, count: int):
+    latencies = []
+
+    for i in range(count):
+        start = time.perf_counter()
+        query()
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+
+    return {
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000
+    }
+
+def run(log_counts: list, route_count: int, queries: int):
+    uuids = [str(uuid.uuid4()) for i in range(route_count)]
+    log_store = MemoryLogStore()
+    results = []
+    total_logs = 0
+
+    for log_count in sorted(log_counts):
+        log_store.add_logs(generate_logs(uuids, log_count - total_logs))
+        total_logs = log_count
+
+        # The rollup cache would hide the cost of time series queries after the first, so each size gets a new queryier
+        queryier = StatisticQueryier(log_store=log_store)
+
+        # Each route's logs are sorted by the first query of the route after logs are added
+        queryier.get_many_routes_stats(uuids)
+
+        def route_logs_pages():
+            cursor = None
+            for page in range(3):
+                logs, cursor = queryier.get_route_logs(random.choice(uuids), cursor=cursor)
+                if cursor is None:
+                    break
+
+        result = {
+            "logs": log_count,
+            "routes": route_count,
+            "route_stats": _time_queries(lambda: queryier.get_route_stats(random.choice(uuids), "day"), queries),
+            "many_routes_stats": _time_queries(
+                lambda: queryier.get_many_routes_stats(random.sample(uuids, min(STATS_BATCH_SIZE, route_count)), "week"),
+                queries),
+            "route_logs": _time_queries(route_logs_pages, queries),
+            "route_timeseries": _time_queries(lambda: queryier.get_route_timeseries(random.choice(uuids), "hour"), queries)
+        }
+        results.append(result)
+
+        print(f"{log_count:>9} logs: " + ", ".join(
+            f"{query} p50 {result[query]['p50_ms']:.3f}ms"
+            for query in ("route_stats", "many_routes_stats", "route_logs", "route_timeseries")
+        ))
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks route statistics and logs queries")
+    parser.add_argument("--logs", help="Numbers of logs to benchmark at", type=int, nargs="+",
+        default=[100000, 1000000])
+    parser.add_argument("--routes", help="Number of routes the logs are spread over", type=int, default=1000)
+    parser.add_argument("--queries", help="Number of queries to time of each kind at each size", type=int, default=200)
+    parser.add_argument("--seed", help="Seed for generating logs", type=int, default=0)
+    parser.add_argument("--output", help="File to write the results to as JSON")
+
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+
+    results = run(options.logs, options.routes, options.queries)
+
+    if options.output is not None:
+        with open(options.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+
+if __name__ == "__main__":
+    main()
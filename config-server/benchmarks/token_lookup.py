@@ -0,0 +1,154 @@
+"""
+Benchmark of the database lookups used by get_by_token and the user link checks,
+at increasing numbers of routes, with and without the indexes added by migrate_schema.
+
+Run from the config-server directory:
+    python -m benchmarks.token_lookup --sizes 10000 100000 1000000
+"""
+
+import argparse
+import json
+import random
+import secrets
+import statistics
+import time
+import uuid
+
+from peewee import SqliteDatabase
+
+from configserver.migrations import INDEXES, migrate_schema
+from configserver.models import Route, UserLink, proxy_db
+from configserver.RouteDataMapper import TOKEN_ID_LENGTH
+
+INSERT_BATCH_SIZE = 100
+
+def fill_routes(db, count: int, start: int, users: int = 1000):
+    """
+    Inserts routes, linked in turn to the given number of users, until there are count routes. Returns their tokens.
+    """
+    tokens = []
+
+    for batch_start in range(start, count, INSERT_BATCH_SIZE):
+        routes = []
+        links = []
+
+        for i in range(batch_start, min(batch_start + INSERT_BATCH_SIZE, count)):
+            token = secrets.token_urlsafe()
+            route_uuid = str(uuid.uuid4())
+
+            routes.append({
+                "uuid": route_uuid,
+                "name": f"route-{i}",
+                "destination": "http://127.0.0.1",
+                "no_ssl_verification": False,
+                "rate_limit": 30,
+                "token": token,
+                "token_id": token[:TOKEN_ID_LENGTH]
+            })
+            links.append({
+                "user": f"user-{i % users}@example.com",
+                "route": route_uuid
+            })
+            tokens.append(token)
+
+        with db.atomic():
+            Route.insert_many(routes).execute()
+            UserLink.insert_many(links).execute()
+
+    return tokens
+
+def _time_lookups(lookup, keys: list):
+    latencies = []
+
+    for key in keys:
+        start = time.perf_counter()
+        lookup(key)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+
+    return {
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000
+    }
+
+def _lookup_token(token_id: str):
+    return len(Route.select().where(Route.token_id == token_id))
+
+def _lookup_link(link: tuple):
+    user, route_uuid = link
+    return len(UserLink.select().where((UserLink.route == route_uuid) & (UserLink.user == user)))
+
+def _drop_indexes(db):
+    for (model, columns, unique) in INDEXES:
+        table = model._meta.db_table
+        for index in db.get_indexes(table):
+            if set(index.columns) == set(columns):
+                db.execute_sql(f'DROP INDEX "{index.name}"')
+
+def run(sizes: list, lookups: int, database: str):
+    db = SqliteDatabase(database)
+    proxy_db.initialize(db)
+    db.connect()
+    migrate_schema(db)
+
+    results = []
+    token_ids = []
+
+    for size in sorted(sizes):
+        token_ids += [token[:TOKEN_ID_LENGTH] for token in fill_routes(db, size, len(token_ids))]
+
+        sample_token_ids = random.sample(token_ids, min(lookups, len(token_ids)))
+        sample_links = [
+            (link.user, link.route_id)
+            for link in UserLink.select().where(UserLink.route << [
+                route.uuid for route in Route.select(Route.uuid).where(Route.token_id << sample_token_ids[:100])
+            ])
+        ]
+
+        for indexed in (True, False):
+            if indexed:
+                migrate_schema(db)
+            else:
+                _drop_indexes(db)
+
+            # Scans are slow, so fewer lookups are timed without indexes
+            lookup_count = len(sample_token_ids) if indexed else min(len(sample_token_ids), 20)
+
+            result = {
+                "routes": size,
+                "indexed": indexed,
+                "token_lookup": _time_lookups(_lookup_token, sample_token_ids[:lookup_count]),
+                "link_lookup": _time_lookups(_lookup_link, sample_links[:lookup_count])
+            }
+            results.append(result)
+
+            print(f"{size:>9} routes, {'with' if indexed else 'without'} indexes: "
+                  f"token lookup p50 {result['token_lookup']['p50_ms']:.3f}ms, "
+                  f"link lookup p50 {result['link_lookup']['p50_ms']:.3f}ms")
+
+        migrate_schema(db)
+
+    db.close()
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks route token and user link lookups")
+    parser.add_argument("--sizes", help="Numbers of routes to benchmark at", type=int, nargs="+",
+        default=[10000, 100000, 1000000])
+    parser.add_argument("--lookups", help="Number of lookups to time at each size", type=int, default=1000)
+    parser.add_argument("--database", help="SQLite database file to use", default=":memory:")
+    parser.add_argument("--output", help="File to write the results to as JSON")
+
+    options = parser.parse_args()
+
+    results = run(options.sizes, options.lookups, options.database)
+
+    if options.output is not None:
+        with open(options.output, "w") as output_file:
+            json.dump(results, output_file, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,22 @@
 import copy
+import json
+import sys
+import threading
+import time
 from functools import wraps
 from http import HTTPStatus
-from typing import Callable, Type
+from typing import Callable, List, Type
 from urllib.parse import urlparse
 import flask
+from webhookcommon.auth import normal_auth, test_auth
 
 from .errors import *
-from .auth import *
 from .logging import ConfigServerLogger
-from .models import extract_route_dict
-from .RouteDataMapper import RouteDataMapper
-from .StatisticQueryier import StatisticQueryier
+from .metrics import OPERATION_ERRORS, OPERATION_LATENCY
+from .models import ROUTE_UPSERTED, extract_route_dict
+from .RateLimiter import RateLimiter
+from .RouteDataMapper import DEFAULT_CHANGES_LIMIT, RouteDataMapper
+from .StatisticQueryier import DEFAULT_LOGS_PAGE_SIZE, StatisticQueryier
 from .UserLinkDataMapper import UserLinkDataMapper
 
 # Configuration for mapping from the data mapper to the connextion object
@@ -19,13 +25,21 @@ route_data_mapper_mappings = {
     "get_route": "get",
     "patch_route": "update",
     "get_by_token": "get_by_token",
-    "regenerate_token": "regenerate_token"
+    "regenerate_token": "regenerate_token",
+    "get_token_cache_info": "get_token_cache_info"
 }
 user_link_data_mapper_mapppings = {
     "delete_route_link": "remove_user_link",
     "get_all_routes": "get_users_links"
 }
 
+# Operations used by the router, which are authorised by the route token instead of a user
+unauthenticated_operations = {
+    "get_by_token",
+    "resolve_tokens",
+    "acquire_rate_limit_permits"
+}
+
 # Which functions to automatically add status codes to
 # PR for this: https://github.com/zalando/connexion/issues/539
 status_codes = {
@@ -36,6 +50,17 @@ status_codes = {
     "delete_route_link": 204
 }
 
+SNAPSHOT_MIMETYPE = "application/x-ndjson"
+SNAPSHOT_REVISION_HEADER = "X-Revision"
+
+# Errors of items in the results of bulk operations, which match the errors of the single item operations
+INVALID_ROUTE_UUID_RESULT = {"error": "Invalid route UUID", "error_num": 1}
+INVALID_ROUTE_TOKEN_RESULT = {"error": "Invalid route token", "error_num": 2}
+INVALID_URL_RESULT = {"error": "Invalid URL in destination", "error_num": 4}
+
+# How often a long poll of the change feed checks for changes made by other processes
+CHANGE_POLL_INTERVAL = 1
+
 class ConnexionDespatcher:
     """
     Class, who's main function is resolve_name (see below for docs of that function).
@@ -47,13 +72,20 @@ class ConnexionDespatcher:
                         user_link_data_mapper: UserLinkDataMapper,
                         statistic_queryier: StatisticQueryier,
                         logger: ConfigServerLogger,
-                        google_oauth_client_id: str):
+                        google_oauth_client_id: str,
+                        admin_users: List[str] = (),
+                        rate_limiter: RateLimiter = None,
+                        max_long_polls: int = 0):
         self._use_test_auth = use_test_auth
         self._route_data_mapper = route_data_mapper
         self._user_link_data_mapper = user_link_data_mapper
         self._statistic_queryier = statistic_queryier
         self._logger = logger
         self._google_oauth_client_id = google_oauth_client_id
+        self._admin_users = set(admin_users)
+        self._rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        # Long polls of the change feed hold a thread each, so only this many can wait at once
+        self._long_polls = threading.Semaphore(max_long_polls)
 
     def resolve_name(self, name: str):
         """
@@ -79,11 +111,12 @@ class ConnexionDespatcher:
             This also automatically adds NO_CONTENT if needed.
             """
             user = "<NONE>"
+            start = time.monotonic()
             try:
                 # NOTE: Connexion implements oauth, but we can't use it, as it doesn't
                 # work with Google's method of oauth (the token has to be passed in parameters).
                 # See https://github.com/zalando/connexion/issues/555.
-                if name != "get_by_token":
+                if name not in unauthenticated_operations:
                     if self._use_test_auth:
                         user = test_auth()
                     else:
@@ -100,53 +133,168 @@ class ConnexionDespatcher:
                     resp = (resp, code)
             except:
                 resp = "<ERROR>"
+                OPERATION_ERRORS.labels(name, sys.exc_info()[0].__name__).inc()
                 raise
             finally:
+                OPERATION_LATENCY.labels(name).observe(time.monotonic() - start)
                 self._logger.log_swagger_request(name, kwargs, resp, user)
 
             return resp
 
         return connextion_wrapper
 
-    def create_route(self, new_route: object, user: str):
-        # Custom validation and replacement for expected behaviour specified in https://github.com/zalando/connexion/issues/351
+    @staticmethod
+    def _validate_destination(destination: str):
         acceptable_schemes = ["http", "https"]
 
-        new_route = copy.deepcopy(new_route)
-        new_route["no_ssl_verification"]=new_route.get("no_ssl_verification", False)
-        new_route["rate_limit"]=new_route.get("rate_limit", 30)
-
         try:
-            url_ob = urlparse(new_route["destination"])
+            url_ob = urlparse(destination)
         except SyntaxError:
             raise InvalidURLError()
 
         if url_ob.scheme not in acceptable_schemes:
             raise InvalidURLError()
 
+    @staticmethod
+    def _validate_new_route(new_route: object):
+        """
+        Returns a copy of new_route with defaults filled in, raising InvalidURLError if its destination is invalid
+        """
+        # Custom validation and replacement for expected behaviour specified in https://github.com/zalando/connexion/issues/351
+        new_route = copy.deepcopy(new_route)
+        new_route["no_ssl_verification"]=new_route.get("no_ssl_verification", False)
+        new_route["rate_limit"]=new_route.get("rate_limit", 30)
+
+        ConnexionDespatcher._validate_destination(new_route["destination"])
+
+        return new_route
+
+    def create_route(self, new_route: object, user: str):
         route = self._route_data_mapper.add(
             user=user,
-            **new_route)
+            **ConnexionDespatcher._validate_new_route(new_route))
 
         return route
 
+    def create_routes(self, new_routes: List[object], user: str):
+        """
+        Creates many routes in one transaction. Invalid routes are given an error in their place
+        in the results, and the rest are still created.
+        """
+        results = [None] * len(new_routes)
+        valid_routes = []
+
+        for (i, new_route) in enumerate(new_routes):
+            try:
+                valid_routes.append((i, ConnexionDespatcher._validate_new_route(new_route)))
+            except InvalidURLError:
+                results[i] = dict(INVALID_URL_RESULT)
+
+        routes = self._route_data_mapper.add_many(user, [new_route for (_, new_route) in valid_routes])
+
+        for ((i, _), route) in zip(valid_routes, routes):
+            results[i] = {"route": route}
+
+        return results
+
+    def update_routes(self, updates: List[object]):
+        """
+        Updates many routes in one transaction. Routes that don't exist or have an invalid
+        destination are given an error in their place in the results, and the rest are still updated.
+        If a route is given more than once, its updates are applied in order.
+        """
+        results = [None] * len(updates)
+        valid_updates = {}
+
+        for (i, update) in enumerate(updates):
+            try:
+                if "destination" in update:
+                    ConnexionDespatcher._validate_destination(update["destination"])
+            except InvalidURLError:
+                results[i] = {"uuid": update["uuid"], **INVALID_URL_RESULT}
+            else:
+                valid_updates.setdefault(update["uuid"], {}).update(
+                    (key, value) for (key, value) in update.items() if key != "uuid")
+
+        updated_uuids = set(self._route_data_mapper.update_many(valid_updates))
+
+        for (i, update) in enumerate(updates):
+            if results[i] is not None:
+                continue
+
+            if update["uuid"] in updated_uuids:
+                results[i] = {"uuid": update["uuid"]}
+            else:
+                results[i] = {"uuid": update["uuid"], **INVALID_ROUTE_UUID_RESULT}
+
+        return results
+
+    def delete_routes(self, uuids: List[str]):
+        """
+        Deletes many routes in one transaction. Like delete_route, this succeeds for routes that don't exist.
+        """
+        self._route_data_mapper.delete_many(uuids)
+
+        return [{"uuid": uuid} for uuid in uuids]
+
 
     def add_route_link(self, user: str, uuid: str):
-        # This also checks if the uuid exists
-        route = self._route_data_mapper.get(uuid)
+        return self._user_link_data_mapper.link_route(user, uuid)
+
+    def resolve_tokens(self, tokens: List[str]):
+        """
+        Resolves many route tokens in one request. Tokens that are invalid are given
+        the same error as get_by_token would give (see ConfigServer._set_error_handlers)
+        """
+        routes = self._route_data_mapper.get_many_by_token(tokens)
 
-        self._user_link_data_mapper.add_user_link(user, uuid)
+        results = []
+        for token in tokens:
+            if token in routes:
+                results.append({
+                    "token": token,
+                    "route": routes[token]
+                })
+            else:
+                results.append({"token": token, **INVALID_ROUTE_TOKEN_RESULT})
 
-        return route
+        return results
 
-    def get_all_routes_stats(self, user: str):
+    def acquire_rate_limit_permits(self, permit_requests: List[object]):
+        """
+        Takes permits for webhooks to many routes in one request, so the rate limits of routes hold
+        across every router. Routes are given by their token, like resolve_tokens, so only holders of
+        a route's token can use up its permits.
+        """
+        routes = self._route_data_mapper.get_many_by_token([request["token"] for request in permit_requests])
+
+        granted = iter(self._rate_limiter.acquire([
+            (routes[request["token"]]["uuid"], request.get("permits", 1), routes[request["token"]]["rate_limit"])
+            for request in permit_requests
+            if request["token"] in routes
+        ]))
+
+        results = []
+        for request in permit_requests:
+            if request["token"] in routes:
+                results.append({
+                    "token": request["token"],
+                    "granted": next(granted),
+                    "rate_limit": routes[request["token"]]["rate_limit"]
+                })
+            else:
+                results.append({"token": request["token"], **INVALID_ROUTE_TOKEN_RESULT})
+
+        return results
+
+    def get_all_routes_stats(self, user: str, period: str = None):
         user_routes = self._user_link_data_mapper.get_users_links(user)
         uuids = [route["uuid"] for route in user_routes]
 
         if len(uuids) == 0:
             return []
 
-        stats = self._statistic_queryier.get_many_routes_stats(uuids)
+        stats = self._statistic_queryier.get_many_routes_stats(uuids, period)
 
         for (i, stat) in enumerate(stats):
             stat["uuid"] = uuids[i]
@@ -154,19 +302,87 @@ class ConnexionDespatcher:
         return stats
 
     def get_route_link(self, user: str, uuid: str):
-        if not self._user_link_data_mapper.has_user_link(user, uuid):
-            raise RouteLinkNotFound()
+        return self._user_link_data_mapper.get_linked_route(user, uuid)
 
-        return self._route_data_mapper.get(uuid)
+    def get_route_logs(self, uuid: str, page_size: int = DEFAULT_LOGS_PAGE_SIZE, cursor: str = None,
+                       outcome: str = "failure", since: str = None, until: str = None, fields: List[str] = None):
+        # make sure the uuid is actually valid
+        self._route_data_mapper.check_exists(uuid)
+
+        logs, next_cursor = self._statistic_queryier.get_route_logs(
+            uuid, page_size, cursor, outcome, since, until, fields)
+
+        if next_cursor is None:
+            return logs
+
+        # The cursor is returned as a header, so the response stays a list of logs
+        return logs, 200, {"X-Next-Cursor": next_cursor}
 
-    def get_route_logs(self, uuid: str):
+    def get_route_stats(self, uuid: str, period: str = None):
         # make sure the uuid is actually valid
-        self._route_data_mapper.get(uuid)
+        self._route_data_mapper.check_exists(uuid)
 
-        return self._statistic_queryier.get_route_logs(uuid)
+        return self._statistic_queryier.get_route_stats(uuid, period)
 
-    def get_route_stats(self, uuid: str):
+
+    def get_route_timeseries(self, uuid: str, interval: str = "hour", since: str = None):
         # make sure the uuid is actually valid
-        self._route_data_mapper.get(uuid)
+        self._route_data_mapper.check_exists(uuid)
+
+        return self._statistic_queryier.get_route_timeseries(uuid, interval, since)
+
+    def _auth_admin(self, user: str):
+        if user not in self._admin_users:
+            raise NotAuthorisedError()
+
+    def get_route_changes(self, user: str, since: int = 0, timeout: float = 0, limit: int = DEFAULT_CHANGES_LIMIT):
+        """
+        Change feed of routes, for consumers that keep their own copy of every route.
+        If there are no changes after since, waits up to timeout seconds for one (long polling),
+        unless max_long_polls requests are already waiting, in which case it returns straight away.
+        """
+        self._auth_admin(user)
+
+        long_polling = timeout > 0 and self._long_polls.acquire(blocking=False)
+        try:
+            deadline = time.monotonic() + (timeout if long_polling else 0)
+
+            while True:
+                changes = self._route_data_mapper.get_changes(since, limit)
+
+                remaining = deadline - time.monotonic()
+                if len(changes) != 0 or remaining <= 0:
+                    break
+
+                self._route_data_mapper.wait_for_change(min(remaining, CHANGE_POLL_INTERVAL))
+        finally:
+            if long_polling:
+                self._long_polls.release()
+
+        feed_changes = []
+        for (change, revision, value) in changes:
+            if change == ROUTE_UPSERTED:
+                feed_changes.append({"type": change, "revision": revision, "route": value})
+            else:
+                feed_changes.append({"type": change, "revision": revision, "uuid": value})
+
+        return {
+            "revision": changes[-1][1] if len(changes) != 0 else since,
+            "more": len(changes) >= limit,
+            "changes": feed_changes
+        }
+
+    def get_routes_snapshot(self, user: str):
+        """
+        Streams every route as JSON lines, with the revision of the change feed the snapshot starts from
+        in the X-Revision header. Routes are read in pages (see RouteDataMapper.iter_snapshot), so this isn't
+        a snapshot of one point in time, and consumers need to apply the change feed from X-Revision afterwards.
+        """
+        self._auth_admin(user)
+
+        revision = self._route_data_mapper.get_revision()
+        lines = (json.dumps(route) + "\n" for route in self._route_data_mapper.iter_snapshot())
 
-        return self._statistic_queryier.get_route_stats(uuid)
+        # The request (and its database connection) lasts until the last line is sent
+        return flask.Response(flask.stream_with_context(lines), mimetype=SNAPSHOT_MIMETYPE,
+            headers={SNAPSHOT_REVISION_HEADER: str(revision)})
@@ -0,0 +1,335 @@
+import bisect
+import datetime
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, List, Tuple
+
+import dateutil.parser
+from elasticsearch import Elasticsearch
+from elasticsearch_dsl import Search
+
+from .metrics import ES_QUERY_LATENCY
+
+# Time series intervals, as (elasticsearch interval, length in milliseconds)
+TIMESERIES_INTERVALS = {
+    "minute": ("1m", 60 * 1000),
+    "hour": ("1h", 60 * 60 * 1000),
+    "day": ("1d", 24 * 60 * 60 * 1000)
+}
+
+# Text fields can't be aggregated on, so the keyword version of the field is used
+ROUTE_UUID_KEYWORD_FIELD = "uuid.keyword"
+
+class LogStore(ABC):
+    """
+    Where the router's logs are queried from. Each log has the uuid of its route, whether routing
+    succeeded (success) and when it was logged (@timestamp). Times are in epoch milliseconds.
+
+    Logs are ordered newest first, with ties broken by an id, and the sort values of a log
+    ([timestamp, id]) can be passed as search_after to get the logs after it.
+    """
+    @abstractmethod
+    def check_connection(self):
+        """
+        Raises if the store isn't usable
+        """
+
+    @abstractmethod
+    def count_outcomes(self, uuids: List[str], since: int = None) -> Dict[str, dict]:
+        """
+        Counts the successes and failures of each route, only counting logs from since onwards if it's given.
+        Returns a dict from uuid to {"successes": ..., "failures": ...}, which may leave out routes without logs.
+        """
+
+    @abstractmethod
+    def get_logs(self, uuid: str, page_size: int, search_after: list = None, success: bool = None,
+                 since: int = None, until: int = None, fields: List[str] = None) -> Tuple[List[dict], list]:
+        """
+        Gets up to page_size logs of a route, newest first, optionally filtered by success and time.
+        fields limits which fields of each log are returned.
+
+        Returns (logs, sort values of the last log), where the sort values are None if there are no more logs.
+        """
+
+    @abstractmethod
+    def count_timeseries(self, uuid: str, interval: str, since: int) -> Dict[int, dict]:
+        """
+        Counts the successes and failures of a route from since onwards, in buckets of interval
+        (a key of TIMESERIES_INTERVALS). Returns a dict from bucket start to the bucket's counts,
+        which may leave out buckets without logs.
+        """
+
+class ElasticsearchLogStore(LogStore):
+    def __init__(self, elasticurl: str, index: str = "whr_routing_server*") -> None:
+        self._es = Elasticsearch(elasticurl)
+        self._index = index
+
+    def check_connection(self):
+        """
+        Raises if elasticsearch isn't usable, and creates the index if it doesn't exist
+        """
+        health = self._es.cluster.health()
+        if health["status"] == "red":
+            raise ConnectionError("Elasticsearch cluster health is red")
+
+        self._es.indices.create(index=self._index, ignore=400)
+
+    @staticmethod
+    def _count_outcome_buckets(outcome_buckets):
+        counts = {"successes": 0, "failures": 0}
+
+        for outcome_bucket in outcome_buckets:
+            if outcome_bucket.key_as_string == "true":
+                counts["successes"] = outcome_bucket.doc_count
+            else:
+                counts["failures"] = outcome_bucket.doc_count
+
+        return counts
+
+    def count_outcomes(self, uuids: List[str], since: int = None) -> Dict[str, dict]:
+        """
+        Uses a terms aggregation on the route uuid with a sub aggregation on success, in one request
+        """
+        search = Search(using=self._es, index=self._index) \
+            .filter("terms", **{ROUTE_UUID_KEYWORD_FIELD: uuids}) \
+            .extra(size=0)
+
+        if since is not None:
+            search = search.filter("range", **{"@timestamp": {"gte": since, "format": "epoch_millis"}})
+
+        search.aggs \
+            .bucket("routes", "terms", field=ROUTE_UUID_KEYWORD_FIELD, size=len(uuids)) \
+            .bucket("outcomes", "terms", field="success")
+
+        with ES_QUERY_LATENCY.labels("routes_stats").time():
+            response = search.execute()
+
+        return {
+            route_bucket.key: ElasticsearchLogStore._count_outcome_buckets(route_bucket.outcomes.buckets)
+            for route_bucket in response.aggregations.routes.buckets
+        }
+
+    def get_logs(self, uuid: str, page_size: int, search_after: list = None, success: bool = None,
+                 since: int = None, until: int = None, fields: List[str] = None) -> Tuple[List[dict], list]:
+        search = Search(using=self._es, index=self._index).query("match", uuid=uuid)
+
+        if success is not None:
+            search = search.query("match", success=success)
+
+        time_range = {}
+        if since is not None:
+            time_range["gte"] = since
+        if until is not None:
+            time_range["lt"] = until
+        if len(time_range) != 0:
+            search = search.filter("range", **{"@timestamp": {**time_range, "format": "epoch_millis"}})
+
+        if fields is not None:
+            search = search.source(fields)
+
+        # _id breaks ties between logs with the same timestamp
+        search = search.sort("-@timestamp", "_id").extra(size=page_size)
+
+        if search_after is not None:
+            search = search.extra(search_after=search_after)
+
+        with ES_QUERY_LATENCY.labels("route_logs").time():
+            hits = search.execute().hits
+
+        logs = [hit.to_dict() for hit in hits]
+
+        if len(hits) == page_size:
+            return logs, list(hits[-1].meta.sort)
+        else:
+            return logs, None
+
+    def count_timeseries(self, uuid: str, interval: str, since: int) -> Dict[int, dict]:
+        search = Search(using=self._es, index=self._index) \
+            .query("match", uuid=uuid) \
+            .filter("range", **{"@timestamp": {"gte": since, "format": "epoch_millis"}}) \
+            .extra(size=0)
+
+        search.aggs \
+            .bucket("buckets", "date_histogram", field="@timestamp", interval=TIMESERIES_INTERVALS[interval][0]) \
+            .bucket("outcomes", "terms", field="success")
+
+        with ES_QUERY_LATENCY.labels("route_timeseries").time():
+            response = search.execute()
+
+        return {
+            int(time_bucket.key): ElasticsearchLogStore._count_outcome_buckets(time_bucket.outcomes.buckets)
+            for time_bucket in response.aggregations.buckets.buckets
+        }
+
+def _timestamp_to_millis(timestamp) -> int:
+    """
+    Converts a log's @timestamp (epoch milliseconds, or an ISO 8601 string, in UTC if it has no timezone)
+    """
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+
+    parsed_time = dateutil.parser.parse(timestamp)
+    if parsed_time.tzinfo is None:
+        parsed_time = parsed_time.replace(tzinfo=datetime.timezone.utc)
+
+    return int(parsed_time.timestamp() * 1000)
+
+class _RouteLogs:
+    """
+    Logs of one route, kept in the store's sort order (newest first, then by id)
+    """
+    def __init__(self) -> None:
+        self.logs = [] # type: List[Tuple[int, str, bool, dict]]
+        self.is_sorted = True
+
+        # Built by prepare
+        self.keys = [] # type: List[Tuple[int, str]]
+        self.negated_timestamps = [] # type: List[int]
+        self.success_counts = [0] # type: List[int]
+
+    def prepare(self):
+        """
+        Sorts logs added since the last call, and rebuilds the lookup lists
+        """
+        if self.is_sorted:
+            return
+
+        self.logs.sort(key=lambda log: (-log[0], log[1]))
+        self.keys = [(-timestamp, log_id) for (timestamp, log_id, _, _) in self.logs]
+        self.negated_timestamps = [-timestamp for (timestamp, _, _, _) in self.logs]
+
+        # success_counts[i] is the number of successes in logs[:i]
+        self.success_counts = [0]
+        for (_, _, success, _) in self.logs:
+            self.success_counts.append(self.success_counts[-1] + (1 if success else 0))
+
+        self.is_sorted = True
+
+    def newer_than(self, since: int = None) -> int:
+        """
+        Returns how many of the logs (which are newest first) are from since onwards
+        """
+        if since is None:
+            return len(self.logs)
+
+        return bisect.bisect_right(self.negated_timestamps, -since)
+
+class MemoryLogStore(LogStore):
+    """
+    Log store that keeps logs in memory, for tests and benchmarks that shouldn't need elasticsearch.
+
+    Logs are grouped by route and sorted (when they're next queried after being added), so counting
+    outcomes is a binary search, and paging through logs doesn't look at logs before the page.
+    """
+    def __init__(self) -> None:
+        self._routes = {} # type: Dict[str, _RouteLogs]
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def add_logs(self, logs: Iterable[dict]):
+        """
+        Adds logs, which need uuid, success and @timestamp fields
+        """
+        with self._lock:
+            for log in logs:
+                route_logs = self._routes.get(log["uuid"])
+                if route_logs is None:
+                    route_logs = _RouteLogs()
+                    self._routes[log["uuid"]] = route_logs
+
+                # Zero padded, so ids sort in the order logs were added
+                log_id = f"{self._next_id:020d}"
+                self._next_id += 1
+
+                route_logs.logs.append((_timestamp_to_millis(log["@timestamp"]), log_id, bool(log["success"]), log))
+                route_logs.is_sorted = False
+
+    def _get_route_logs(self, uuid: str) -> _RouteLogs:
+        """
+        Returns the prepared logs of the route, or None if it has no logs. Must be called with the lock held.
+        """
+        route_logs = self._routes.get(uuid)
+
+        if route_logs is not None:
+            route_logs.prepare()
+
+        return route_logs
+
+    def check_connection(self):
+        pass
+
+    def count_outcomes(self, uuids: List[str], since: int = None) -> Dict[str, dict]:
+        counts = {}
+
+        with self._lock:
+            for uuid in uuids:
+                route_logs = self._get_route_logs(uuid)
+                if route_logs is None:
+                    continue
+
+                count = route_logs.newer_than(since)
+                successes = route_logs.success_counts[count]
+
+                counts[uuid] = {
+                    "successes": successes,
+                    "failures": count - successes
+                }
+
+        return counts
+
+    def get_logs(self, uuid: str, page_size: int, search_after: list = None, success: bool = None,
+                 since: int = None, until: int = None, fields: List[str] = None) -> Tuple[List[dict], list]:
+        page = []
+
+        with self._lock:
+            route_logs = self._get_route_logs(uuid)
+            if route_logs is None:
+                return [], None
+
+            start = 0
+            if until is not None:
+                start = bisect.bisect_right(route_logs.negated_timestamps, -until)
+            if search_after is not None:
+                start = max(start, bisect.bisect_right(route_logs.keys, (-int(search_after[0]), str(search_after[1]))))
+
+            end = route_logs.newer_than(since)
+
+            for i in range(start, end):
+                log = route_logs.logs[i]
+
+                if success is None or log[2] == success:
+                    page.append(log)
+
+                    if len(page) == page_size:
+                        break
+
+        if fields is None:
+            logs = [dict(doc) for (_, _, _, doc) in page]
+        else:
+            logs = [{field: doc[field] for field in fields if field in doc} for (_, _, _, doc) in page]
+
+        if len(page) == page_size:
+            return logs, [page[-1][0], page[-1][1]]
+        else:
+            return logs, None
+
+    def count_timeseries(self, uuid: str, interval: str, since: int) -> Dict[int, dict]:
+        interval_ms = TIMESERIES_INTERVALS[interval][1]
+        buckets = {}
+
+        with self._lock:
+            route_logs = self._get_route_logs(uuid)
+            if route_logs is None:
+                return {}
+
+            for (timestamp, _, success, _) in route_logs.logs[:route_logs.newer_than(since)]:
+                bucket_start = timestamp // interval_ms * interval_ms
+
+                counts = buckets.get(bucket_start)
+                if counts is None:
+                    counts = {"successes": 0, "failures": 0}
+                    buckets[bucket_start] = counts
+
+                counts["successes" if success else "failures"] += 1
+
+        return buckets
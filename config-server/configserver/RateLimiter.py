@@ -0,0 +1,143 @@
+"""Rate limiting of webhooks to each route, with a token bucket for each route kept in a RateLimitStore"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import List, Tuple
+
+from cachetools import TTLCache
+from playhouse.shortcuts import case
+
+from .metrics import DB_QUERY_LATENCY
+from .models import RateLimitBucket, insert_or_ignore, proxy_db
+
+# Webhooks to a route can burst to this many seconds' worth of its rate limit
+DEFAULT_BURST_SECONDS = 1
+DEFAULT_MAX_BUCKETS = 100000
+# Buckets written by each statement of DatabaseRateLimitStore, so statements stay under SQLite's limit of 999 variables
+BUCKET_BATCH_SIZE = 150
+
+def take_permits(tokens: float, updated: float, now: float, permits: int, rate: float, capacity: float):
+    """
+    Refills a token bucket, which had tokens when it was last refilled at updated, by rate tokens a second
+    up to capacity, then takes up to permits whole tokens from it.
+    Returns (permits granted, tokens left, when the bucket was refilled).
+    """
+    # Clocks of different servers may disagree, so a bucket is never refilled for time before its last refill
+    refilled = max(updated, now)
+    tokens = min(capacity, tokens + (refilled - updated) * rate)
+    granted = max(0, min(permits, int(tokens)))
+
+    return granted, tokens - granted, refilled
+
+class RateLimitStore(ABC):
+    """
+    Where the token buckets of routes are kept. Buckets that aren't stored are full.
+    """
+    @abstractmethod
+    def acquire(self, requests: List[Tuple[str, int, float, float]], now: float) -> List[int]:
+        """
+        For each (key, permits, rate, capacity), takes up to permits tokens from the key's bucket
+        (see take_permits), so that callers sharing the store never grant the same token twice.
+        Returns the number of permits granted for each request, in order.
+        """
+
+class MemoryRateLimitStore(RateLimitStore):
+    """
+    Keeps buckets in this process, so limits only hold for one config server process.
+    Buckets are dropped once they've been idle for idle_ttl seconds, which needs to be at least
+    the time a bucket takes to refill (the burst seconds of the RateLimiter).
+    """
+    def __init__(self, max_buckets: int = DEFAULT_MAX_BUCKETS, idle_ttl: float = DEFAULT_BURST_SECONDS) -> None:
+        self._buckets = TTLCache(maxsize=max_buckets, ttl=idle_ttl)
+        # cachetools caches aren't thread safe
+        self._lock = threading.Lock()
+
+    def acquire(self, requests: List[Tuple[str, int, float, float]], now: float) -> List[int]:
+        granted = []
+
+        with self._lock:
+            for (key, permits, rate, capacity) in requests:
+                (tokens, updated) = self._buckets.get(key, (capacity, now))
+                (count, tokens, updated) = take_permits(tokens, updated, now, permits, rate, capacity)
+
+                self._buckets[key] = (tokens, updated)
+                granted.append(count)
+
+        return granted
+
+class DatabaseRateLimitStore(RateLimitStore):
+    """
+    Keeps buckets in the database, so limits hold across every config server (and every process of one).
+    The buckets of a call are read (and locked, on Postgres) then written back in one transaction,
+    with a few statements for each batch of buckets rather than for each bucket.
+    """
+    def acquire(self, requests: List[Tuple[str, int, float, float]], now: float) -> List[int]:
+        if len(requests) == 0:
+            return []
+
+        capacities = {key: capacity for (key, _, _, capacity) in requests}
+        # Sorted, so concurrent calls lock rows in the same order and can't deadlock
+        keys = sorted(capacities)
+        buckets = {}
+
+        with proxy_db.atomic():
+            for start in range(0, len(keys), BUCKET_BATCH_SIZE):
+                batch = keys[start:start + BUCKET_BATCH_SIZE]
+
+                # Buckets that don't exist yet are full
+                with DB_QUERY_LATENCY.labels("add_rate_limit_buckets").time():
+                    insert_or_ignore(RateLimitBucket, [
+                        {"route_uuid": key, "tokens": capacities[key], "updated": now}
+                        for key in batch
+                    ])
+
+                query = RateLimitBucket.select() \
+                    .where(RateLimitBucket.route_uuid << batch) \
+                    .order_by(RateLimitBucket.route_uuid)
+                if proxy_db.for_update:
+                    query = query.for_update()
+
+                with DB_QUERY_LATENCY.labels("get_rate_limit_buckets").time():
+                    for bucket in query:
+                        buckets[bucket.route_uuid] = (bucket.tokens, bucket.updated)
+
+            granted = []
+            for (key, permits, rate, capacity) in requests:
+                (tokens, updated) = buckets[key]
+                (count, tokens, updated) = take_permits(tokens, updated, now, permits, rate, capacity)
+
+                buckets[key] = (tokens, updated)
+                granted.append(count)
+
+            for start in range(0, len(keys), BUCKET_BATCH_SIZE):
+                batch = keys[start:start + BUCKET_BATCH_SIZE]
+
+                with DB_QUERY_LATENCY.labels("update_rate_limit_buckets").time():
+                    RateLimitBucket.update({
+                        RateLimitBucket.tokens: case(RateLimitBucket.route_uuid, [(key, buckets[key][0]) for key in batch]),
+                        RateLimitBucket.updated: case(RateLimitBucket.route_uuid, [(key, buckets[key][1]) for key in batch])
+                    }).where(RateLimitBucket.route_uuid << batch).execute()
+
+        return granted
+
+class RateLimiter:
+    """
+    Limits webhooks to each route to its rate_limit a second, allowing bursts of up to burst_seconds' worth.
+    Routers ask for permits for many routes at once, so they don't need a request for every webhook.
+    """
+    def __init__(self, store: RateLimitStore = None, burst_seconds: float = DEFAULT_BURST_SECONDS) -> None:
+        self._store = store if store is not None else MemoryRateLimitStore(idle_ttl=burst_seconds)
+        self._burst_seconds = burst_seconds
+
+    def acquire(self, requests: List[Tuple[str, int, int]]) -> List[int]:
+        """
+        For each (route uuid, permits, rate limit), takes up to permits permits for the route.
+        Returns the number of permits granted for each request, in order.
+        """
+        if len(requests) == 0:
+            return []
+
+        return self._store.acquire(
+            [(uuid, permits, rate_limit, rate_limit * self._burst_seconds) for (uuid, permits, rate_limit) in requests],
+            time.time())
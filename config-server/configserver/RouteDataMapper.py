@@ -1,16 +1,53 @@
+import base64
+import hashlib
 import logging
 import secrets
+import threading
 import uuid
+from typing import Dict, Iterator, List, Tuple
 
-from peewee import DoesNotExist
+from peewee import DoesNotExist, fn
+from playhouse.shortcuts import case
 
 from .errors import *
-from .models import Route, extract_route_dict
+from .metrics import DB_QUERY_LATENCY
+from .models import (ROUTE_DELETED, ROUTE_UPSERTED, RateLimitBucket, Route, RouteChange, change_finished,
+                     change_revision, extract_route_dict, finished_changes, proxy_db, replica_router)
+from .TokenCache import TokenCache
 from .UserLinkDataMapper import UserLinkDataMapper
 
 logger = logging.getLogger("config_server.route_data_mapper")
 
 TOKEN_ID_LENGTH = 10
+DEFAULT_CHANGES_LIMIT = 1000
+DEFAULT_SNAPSHOT_BATCH_SIZE = 1000
+# Rows written by each statement of a bulk operation, so statements stay under SQLite's limit of 999 variables
+BULK_BATCH_SIZE = 50
+# Fields of a route that can be changed by update and update_many
+UPDATABLE_FIELDS = ["name", "destination", "no_ssl_verification", "rate_limit"]
+# Random bytes in each half of a token, as secrets.token_urlsafe uses by default
+TOKEN_BYTES = 32
+
+def _batches(items: list, batch_size: int = BULK_BATCH_SIZE):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def extract_route_feed_dict(route: Route):
+    """
+    Returns a dict of a route for consumers of the change feed, with a hash of the token instead of the token
+    """
+    route_dict = extract_route_dict(route)
+    del route_dict["token"]
+
+    return {
+        **route_dict,
+        "token_id": route.token_id,
+        "token_hash": hash_token(route.token),
+        "revision": route.revision
+    }
 
 class RouteDataMapper:
     """
@@ -18,12 +55,16 @@ class RouteDataMapper:
     NOTE: This may be called by ConnextionDespatcher, so naming of arguments is important.
     NOTE: user_link_datamapper property needs to be instantiated before this class can be used
     """
-    def __init__(self, user_link_datamapper: UserLinkDataMapper):
+    def __init__(self, user_link_datamapper: UserLinkDataMapper, token_cache: TokenCache = None):
         self._user_link_datamapper = user_link_datamapper
+        self._token_cache = token_cache if token_cache is not None else TokenCache()
+        # Notified when this process changes a route, see wait_for_change
+        self._change_condition = threading.Condition()
 
     def _get_route_from_uuid(self, uuid: str) -> Route:
         try:
-            return Route.get(Route.uuid == uuid)
+            with DB_QUERY_LATENCY.labels("get_route").time():
+                return Route.get(Route.uuid == uuid)
         except DoesNotExist as e:
             raise InvalidRouteUUIDError() from e
 
@@ -38,60 +79,451 @@ class RouteDataMapper:
 
         return token, token_id
 
+    @staticmethod
+    def _generate_new_tokens(count: int) -> List[Tuple[str, str]]:
+        """
+        Batch version of _generate_new_token, using one read of the system's random source
+        """
+        random_bytes = secrets.token_bytes(count * 2 * TOKEN_BYTES)
+        encoded = [
+            base64.urlsafe_b64encode(random_bytes[start:start + TOKEN_BYTES]).rstrip(b"=").decode()
+            for start in range(0, len(random_bytes), TOKEN_BYTES)
+        ]
+
+        tokens = []
+        for i in range(count):
+            token_id = encoded[2 * i][:TOKEN_ID_LENGTH]
+            tokens.append((token_id + encoded[2 * i + 1], token_id))
+
+        return tokens
+
+    @staticmethod
+    def _record_change(uuid: str, change: str) -> int:
+        """
+        Adds a change to the change feed, returning its revision. Must be called in a transaction.
+        """
+        with DB_QUERY_LATENCY.labels("get_change_revision").time():
+            revision = change_revision()
+
+        with DB_QUERY_LATENCY.labels("add_route_change").time():
+            RouteChange.create(route_uuid=uuid, change=change, revision=revision)
+
+        return revision
+
+    @staticmethod
+    def _record_changes(uuids: List[str], change: str) -> int:
+        """
+        Batch version of _record_change. The changes share the revision of the transaction.
+        """
+        with DB_QUERY_LATENCY.labels("get_change_revision").time():
+            revision = change_revision()
+
+        for batch in _batches(uuids):
+            with DB_QUERY_LATENCY.labels("add_route_changes").time():
+                RouteChange.insert_many([
+                    {"route_uuid": uuid, "change": change, "revision": revision}
+                    for uuid in batch
+                ]).execute()
+
+        return revision
+
+    def _notify_change(self):
+        with self._change_condition:
+            self._change_condition.notify_all()
+
     def update(self, uuid: str, new_info: object):
-        route = self._get_route_from_uuid(uuid)
-        for key in new_info:
-            setattr(route, key, new_info[key])
+        """
+        Changes the route's UPDATABLE_FIELDS that are in new_info, with one UPDATE (returning the token id
+        on Postgres, and after selecting it elsewhere)
+        """
+        new_values = {getattr(Route, key): value for (key, value) in new_info.items() if key in UPDATABLE_FIELDS}
+
+        with proxy_db.atomic():
+            # Rolled back (with the change) if the route doesn't exist
+            new_values[Route.revision] = RouteDataMapper._record_change(uuid, ROUTE_UPSERTED)
+            query = Route.update(new_values).where(Route.uuid == uuid)
 
-        route.save()
+            with DB_QUERY_LATENCY.labels("update_route").time():
+                if proxy_db.returning_clause:
+                    token_ids = [token_id for (token_id,) in query.returning(Route.token_id).tuples()]
+                else:
+                    token_ids = [route.token_id for route in Route.select(Route.token_id).where(Route.uuid == uuid)]
+                    if len(token_ids) != 0:
+                        query.execute()
+
+            if len(token_ids) == 0:
+                raise InvalidRouteUUIDError()
+
+        replica_router.mark_written(("route", uuid), ("token", token_ids[0]))
+        self._token_cache.invalidate(token_ids[0])
+        self._notify_change()
 
     def delete(self, uuid: str):
-        try:
-            route = self._get_route_from_uuid(uuid)
-        except InvalidRouteUUIDError:
-            pass # Make this idempotent
-        else:
-            route.delete_instance()
+        with proxy_db.atomic():
+            try:
+                route = self._get_route_from_uuid(uuid)
+            except InvalidRouteUUIDError:
+                return # Make this idempotent
+
+            with DB_QUERY_LATENCY.labels("delete_route").time():
+                route.delete_instance()
+            with DB_QUERY_LATENCY.labels("delete_rate_limit_buckets").time():
+                RateLimitBucket.delete().where(RateLimitBucket.route_uuid == uuid).execute()
+            RouteDataMapper._record_change(uuid, ROUTE_DELETED)
+
+        replica_router.mark_written(("route", uuid), ("token", route.token_id))
+        self._token_cache.invalidate(route.token_id)
+        self._notify_change()
 
     def get(self, uuid: str):
-        return extract_route_dict(self._get_route_from_uuid(uuid))
+        with DB_QUERY_LATENCY.labels("get_route").time():
+            routes = list(replica_router.read(Route.select().where(Route.uuid == uuid), [("route", uuid)]))
+
+        if len(routes) == 0:
+            raise InvalidRouteUUIDError()
+
+        return extract_route_dict(routes[0])
+
+    def check_exists(self, uuid: str):
+        """
+        Raises InvalidRouteUUIDError if the route doesn't exist, without fetching it
+        """
+        with DB_QUERY_LATENCY.labels("route_exists").time():
+            exists = replica_router.read(Route.select().where(Route.uuid == uuid), [("route", uuid)]).exists()
+
+        if not exists:
+            raise InvalidRouteUUIDError()
+
+    def _sync_token_cache(self):
+        """
+        Drops the cached routes that have changed since the token cache was last synced with the
+        change feed, so tokens regenerated or deleted by other processes stop resolving here too
+        """
+        if not self._token_cache.start_sync():
+            return
+
+        revision = None
+        try:
+            if self._token_cache.synced_revision is None:
+                revision = self.get_revision()
+                # Routes cached before the first sync could be of any age
+                self._token_cache.clear()
+            else:
+                # Every committed change is dropped, even those that a long running transaction holds back
+                # from the change feed (see change_finished), but only finished changes are synced past,
+                # so those held back are read again until they're finished.
+                # Read from the primary, as a replica might not have the latest changes
+                with DB_QUERY_LATENCY.labels("get_token_cache_changes").time():
+                    changes = list(RouteChange
+                        .select(RouteChange.revision, RouteChange.route_uuid, change_finished())
+                        .where(RouteChange.revision > self._token_cache.synced_revision)
+                        .tuples())
+
+                self._token_cache.invalidate_routes(route_uuid for (_, route_uuid, _) in changes)
+                revision = max([
+                    self._token_cache.synced_revision,
+                    *(change_revision for (change_revision, _, finished) in changes if finished)
+                ])
+        finally:
+            self._token_cache.finish_sync(revision)
 
     def get_by_token(self, token: str):
+        self._sync_token_cache()
+
         token_id = token[:TOKEN_ID_LENGTH]
-        routes = Route.select().where(Route.token_id == token_id)
+        route = self._token_cache.get(token_id)
 
-        if len(routes) != 1:
-            raise InvalidRouteTokenError()
+        if route is None:
+            with DB_QUERY_LATENCY.labels("get_route_by_token").time():
+                routes = list(replica_router.read(Route.select().where(Route.token_id == token_id), [("token", token_id)]))
+
+            if len(routes) != 1:
+                raise InvalidRouteTokenError()
+
+            route = extract_route_dict(routes[0])
+            self._token_cache.set(token_id, route)
+
+        if secrets.compare_digest(route["token"], token):
+            return dict(route)
         else:
-            if secrets.compare_digest(routes[0].token, token):
-                return extract_route_dict(routes[0])
+            raise InvalidRouteTokenError()
+
+    def get_many_by_token(self, tokens: List[str]) -> Dict[str, dict]:
+        """
+        Batch version of get_by_token. Resolves every token using one query for all the
+        token ids that aren't cached. Returns a dict from each valid token to its route,
+        invalid tokens are left out.
+        """
+        self._sync_token_cache()
+
+        routes_by_token_id = {}
+        uncached_token_ids = set()
+
+        for token in tokens:
+            token_id = token[:TOKEN_ID_LENGTH]
+            if token_id in routes_by_token_id or token_id in uncached_token_ids:
+                continue
+
+            route = self._token_cache.get(token_id)
+            if route is None:
+                uncached_token_ids.add(token_id)
             else:
-                raise InvalidRouteTokenError()
+                routes_by_token_id[token_id] = route
+
+        if len(uncached_token_ids) != 0:
+            duplicate_token_ids = set()
+
+            with DB_QUERY_LATENCY.labels("get_routes_by_tokens").time():
+                routes = list(replica_router.read(
+                    Route.select().where(Route.token_id << list(uncached_token_ids)),
+                    [("token", token_id) for token_id in uncached_token_ids]))
+
+            for route in routes:
+                if route.token_id in routes_by_token_id:
+                    duplicate_token_ids.add(route.token_id)
+                else:
+                    routes_by_token_id[route.token_id] = extract_route_dict(route)
+
+            # Same as get_by_token, ambiguous token ids are invalid
+            for token_id in duplicate_token_ids:
+                del routes_by_token_id[token_id]
+
+            for token_id in uncached_token_ids - duplicate_token_ids:
+                if token_id in routes_by_token_id:
+                    self._token_cache.set(token_id, routes_by_token_id[token_id])
+
+        resolved = {}
+        for token in tokens:
+            route = routes_by_token_id.get(token[:TOKEN_ID_LENGTH])
+
+            if route is not None and secrets.compare_digest(route["token"], token):
+                resolved[token] = dict(route)
+
+        return resolved
+
+    def get_token_cache_info(self):
+        return self._token_cache.info()
 
     def add(self, user: str, **kwargs):
         route_uuid = str(uuid.uuid4())
         token, token_id = RouteDataMapper._generate_new_token()
 
-        route = Route(
-            **kwargs,
-            uuid=route_uuid,
-            token=token,
-            token_id=token_id)
+        with proxy_db.atomic():
+            route = Route(
+                **kwargs,
+                uuid=route_uuid,
+                token=token,
+                token_id=token_id,
+                revision=RouteDataMapper._record_change(route_uuid, ROUTE_UPSERTED))
+
+            with DB_QUERY_LATENCY.labels("add_route").time():
+                route.save()
+            replica_router.mark_written(("route", route_uuid), ("token", token_id))
 
-        route.save()
+            self._user_link_datamapper.add_user_link(user, route_uuid)
 
-        self._user_link_datamapper.add_user_link(user, route_uuid)
+        self._notify_change()
 
         return extract_route_dict(route)
 
+    def add_many(self, user: str, new_routes: List[dict]) -> List[dict]:
+        """
+        Batch version of add, creating the routes (and linking them to user) in one transaction,
+        with a few inserts for all of the routes instead of a few for each.
+        Returns the new routes, in the same order as new_routes.
+        """
+        if len(new_routes) == 0:
+            return []
+
+        rows = [
+            {**new_route, "uuid": str(uuid.uuid4()), "token": token, "token_id": token_id}
+            for (new_route, (token, token_id)) in zip(new_routes, RouteDataMapper._generate_new_tokens(len(new_routes)))
+        ]
+        route_uuids = [row["uuid"] for row in rows]
+
+        with proxy_db.atomic():
+            revision = RouteDataMapper._record_changes(route_uuids, ROUTE_UPSERTED)
+
+            for batch in _batches(rows):
+                with DB_QUERY_LATENCY.labels("add_routes").time():
+                    Route.insert_many([{**row, "revision": revision} for row in batch]).execute()
+
+            self._user_link_datamapper.add_new_user_links(user, route_uuids)
+
+        replica_router.mark_written(
+            *[("route", row["uuid"]) for row in rows],
+            *[("token", row["token_id"]) for row in rows])
+        self._notify_change()
+
+        return [extract_route_dict(Route(**row)) for row in rows]
+
+    def update_many(self, updates: Dict[str, dict]) -> List[str]:
+        """
+        Batch version of update, taking a dict from uuid to the new values of that route's UPDATABLE_FIELDS.
+        Each batch of routes is changed by one UPDATE, in one transaction.
+        Returns the uuids of the routes that were updated, leaving out ones that don't exist.
+        """
+        if len(updates) == 0:
+            return []
+
+        with proxy_db.atomic():
+            with DB_QUERY_LATENCY.labels("get_routes").time():
+                routes = list(Route.select(Route.uuid, Route.token_id).where(Route.uuid << list(updates)))
+
+            updated_uuids = [route.uuid for route in routes]
+            revision = RouteDataMapper._record_changes(updated_uuids, ROUTE_UPSERTED)
+
+            for batch in _batches(updated_uuids):
+                # CASE uuid WHEN ... THEN <new value> ... ELSE <current value> END, for each changed field
+                new_values = {
+                    Route.revision: revision
+                }
+                for field_name in UPDATABLE_FIELDS:
+                    field = getattr(Route, field_name)
+                    changes = [(uuid, updates[uuid][field_name]) for uuid in batch if field_name in updates[uuid]]
+
+                    if len(changes) != 0:
+                        new_values[field] = case(Route.uuid, changes, field)
+
+                with DB_QUERY_LATENCY.labels("update_routes").time():
+                    Route.update(new_values).where(Route.uuid << batch).execute()
+
+        replica_router.mark_written(
+            *[("route", route.uuid) for route in routes],
+            *[("token", route.token_id) for route in routes])
+        for route in routes:
+            self._token_cache.invalidate(route.token_id)
+        self._notify_change()
+
+        return updated_uuids
+
+    def delete_many(self, uuids: List[str]):
+        """
+        Batch version of delete, deleting the routes in one transaction. Routes that don't exist are ignored.
+        """
+        if len(uuids) == 0:
+            return
+
+        with proxy_db.atomic():
+            with DB_QUERY_LATENCY.labels("get_routes").time():
+                routes = list(Route.select(Route.uuid, Route.token_id).where(Route.uuid << list(uuids)))
+
+            deleted_uuids = [route.uuid for route in routes]
+
+            for batch in _batches(deleted_uuids):
+                with DB_QUERY_LATENCY.labels("delete_routes").time():
+                    Route.delete().where(Route.uuid << batch).execute()
+                with DB_QUERY_LATENCY.labels("delete_rate_limit_buckets").time():
+                    RateLimitBucket.delete().where(RateLimitBucket.route_uuid << batch).execute()
+
+            RouteDataMapper._record_changes(deleted_uuids, ROUTE_DELETED)
+
+        replica_router.mark_written(
+            *[("route", route.uuid) for route in routes],
+            *[("token", route.token_id) for route in routes])
+        for route in routes:
+            self._token_cache.invalidate(route.token_id)
+        self._notify_change()
+
     def regenerate_token(self, uuid: str):
-        route = self._get_route_from_uuid(uuid)
-        new_token, new_token_id = RouteDataMapper._generate_new_token()
-        route.token = new_token
-        route.token_id = new_token_id
-        route.save()
+        with proxy_db.atomic():
+            route = self._get_route_from_uuid(uuid)
+            new_token, new_token_id = RouteDataMapper._generate_new_token()
+            old_token_id = route.token_id
+            route.token = new_token
+            route.token_id = new_token_id
+            route.revision = RouteDataMapper._record_change(uuid, ROUTE_UPSERTED)
+            with DB_QUERY_LATENCY.labels("update_route_token").time():
+                route.save()
+
+        replica_router.mark_written(("route", uuid), ("token", old_token_id), ("token", new_token_id))
+        self._token_cache.invalidate(old_token_id)
+        self._notify_change()
 
         return {
             **extract_route_dict(route),
             "token": new_token
         }
+
+    def get_revision(self) -> int:
+        """
+        Returns the revision of the latest change in the change feed, of the transactions that have finished
+        """
+        with DB_QUERY_LATENCY.labels("get_revision").time():
+            return finished_changes(RouteChange.select(fn.MAX(RouteChange.revision))).scalar() or 0
+
+    def get_changes(self, since: int, limit: int = DEFAULT_CHANGES_LIMIT):
+        """
+        Returns the routes changed after revision since, oldest change first, with at most limit routes
+        (or more, as the changes of a transaction are never split, since they share a revision).
+        Routes changed more than once are only returned once, with their current state.
+        Changes are held back while any transaction that started before them is running (see change_finished).
+
+        Returns a list of ("upsert", revision, route feed dict) or ("delete", revision, uuid).
+        """
+        query = finished_changes(RouteChange
+            .select(RouteChange.route_uuid, fn.MAX(RouteChange.revision))
+            .where(RouteChange.revision > since)
+            .group_by(RouteChange.route_uuid))
+
+        with DB_QUERY_LATENCY.labels("get_route_changes").time():
+            latest_changes = list(query.order_by(fn.MAX(RouteChange.revision)).limit(limit).tuples())
+
+            if len(latest_changes) == 0:
+                return []
+
+            if len(latest_changes) == limit:
+                # Add the rest of the last revision's changes, so consumers don't skip them by passing it as since
+                last_revision = latest_changes[-1][1]
+                returned_uuids = set(route_uuid for (route_uuid, _) in latest_changes)
+
+                latest_changes.extend(
+                    (route_uuid, revision)
+                    for (route_uuid, revision) in query.having(fn.MAX(RouteChange.revision) == last_revision).tuples()
+                    if route_uuid not in returned_uuids)
+
+            routes = {
+                route.uuid: route
+                for route in Route.select().where(Route.uuid << [uuid for (uuid, _) in latest_changes])
+            }
+
+        changes = []
+        for (route_uuid, revision) in latest_changes:
+            route = routes.get(route_uuid)
+
+            if route is not None:
+                changes.append((ROUTE_UPSERTED, revision, extract_route_feed_dict(route)))
+            else:
+                changes.append((ROUTE_DELETED, revision, route_uuid))
+
+        return changes
+
+    def iter_snapshot(self, batch_size: int = DEFAULT_SNAPSHOT_BATCH_SIZE) -> Iterator[dict]:
+        """
+        Yields the feed dict of every route, in batches of batch_size routes fetched after the last
+        route's id, so memory use doesn't grow with the number of routes.
+
+        Routes changed while iterating may be yielded in their new state, or not at all if they are deleted,
+        so consumers should apply the change feed from get_revision (called before iterating) afterwards.
+        """
+        last_id = 0
+
+        while True:
+            with DB_QUERY_LATENCY.labels("get_routes_snapshot").time():
+                routes = list(Route.select().where(Route.id > last_id).order_by(Route.id).limit(batch_size))
+
+            for route in routes:
+                yield extract_route_feed_dict(route)
+
+            if len(routes) < batch_size:
+                return
+
+            last_id = routes[-1].id
+
+    def wait_for_change(self, timeout: float):
+        """
+        Waits up to timeout seconds for this process to change a route.
+        Changes made by other processes aren't waited for, so callers need to poll as well.
+        """
+        with self._change_condition:
+            self._change_condition.wait(timeout)
@@ -1,72 +1,148 @@
+import base64
+import binascii
+import datetime
 import json
-import os
+import time
 from typing import List
-import sys
 
-from elasticsearch import Elasticsearch
-from elasticsearch_dsl import MultiSearch, Search
-from elasticsearch.exceptions import NotFoundError
+import dateutil.parser
 
-from .models import extract_route_dict
+from .errors import InvalidLogCursorError, InvalidTimeError
+from .LogStore import TIMESERIES_INTERVALS, ElasticsearchLogStore, LogStore
+from .StatisticRollupCache import StatisticRollupCache
 
+# Length in milliseconds of each period statistics can be filtered by
+STATISTIC_PERIODS = {
+    "hour": 60 * 60 * 1000,
+    "day": 24 * 60 * 60 * 1000,
+    "week": 7 * 24 * 60 * 60 * 1000
+}
+
+DEFAULT_LOGS_PAGE_SIZE = 10
+
+DEFAULT_TIMESERIES_BUCKETS = 24
+MAX_TIMESERIES_BUCKETS = 1000
+# How long after a bucket ends before it's treated as closed, as logs reach the log store late
+TIMESERIES_SETTLE_DELAY_MS = 60 * 1000
 
 class StatisticQueryier:
-    def __init__(self, elasticurl: str) -> None:
-        self._es = Elasticsearch(elasticurl)
-        self._index = "whr_routing_server*"
+    """
+    Queries statistics and logs of routes from a LogStore, which is elasticsearch at elasticurl
+    unless log_store is given
+    """
+    def __init__(self, elasticurl: str = None, log_store: LogStore = None) -> None:
+        self._log_store = log_store if log_store is not None else ElasticsearchLogStore(elasticurl)
+        self._rollup_cache = StatisticRollupCache()
+
+    def check_connection(self):
+        """
+        Raises if the log store isn't usable
+        """
+        self._log_store.check_connection()
 
-        # create the index if it doesn't exist
-        self._es.indices.create(index=self._index, ignore=400)
+    @staticmethod
+    def _encode_cursor(sort_values: list) -> str:
+        return base64.urlsafe_b64encode(json.dumps(sort_values).encode()).decode()
 
-    def _logs_query(self, uuid: str, success: bool):
-        search = Search(using=self._es, index=self._index)
+    @staticmethod
+    def _decode_cursor(cursor: str) -> list:
+        try:
+            sort_values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+            raise InvalidLogCursorError() from e
 
-        return search \
-            .query("match", uuid=uuid) \
-            .query("match", success=success)
+        if not isinstance(sort_values, list) or len(sort_values) != 2:
+            raise InvalidLogCursorError()
 
-    def get_route_logs(self, uuid: str):
-        """
-        Get failure logs from elasticsearch
-        """
+        return sort_values
 
-        # NOTE: this only returns the 10 most recent searches
-        # see https://elasticsearch-py.readthedocs.io/en/master/api.html#elasticsearch.Elasticsearch.search
-        return [x for x in self._logs_query(uuid, False).sort("-@timestamp").execute().hits]
+    @staticmethod
+    def _parse_millis(time_string: str) -> int:
+        return int(StatisticQueryier._parse_time(time_string).timestamp() * 1000)
 
-    def get_route_stats(self, uuid: str):
+    def get_route_logs(self, uuid: str, page_size: int = DEFAULT_LOGS_PAGE_SIZE, cursor: str = None,
+                       outcome: str = "failure", since: str = None, until: str = None, fields: List[str] = None):
+        """
+        Get a page of logs, newest first, using search_after for pagination.
+        outcome is one of "success", "failure" or "all", and fields limits which fields
+        of each log are returned.
+
+        Returns (logs, cursor), where cursor can be passed back to get the next page.
+        cursor is None if there are no more pages.
+        """
+        logs, last_sort_values = self._log_store.get_logs(
+            uuid,
+            page_size,
+            search_after=StatisticQueryier._decode_cursor(cursor) if cursor is not None else None,
+            success=None if outcome == "all" else outcome == "success",
+            since=StatisticQueryier._parse_millis(since) if since is not None else None,
+            until=StatisticQueryier._parse_millis(until) if until is not None else None,
+            fields=fields
+        )
+
+        if last_sort_values is not None:
+            return logs, StatisticQueryier._encode_cursor(last_sort_values)
+        else:
+            return logs, None
+
+    def get_route_stats(self, uuid: str, period: str = None):
         """
         Gets statistics for one route
         """
 
-        successes = self._logs_query(uuid, True).count()
-        failures = self._logs_query(uuid, False).count()
+        return self.get_many_routes_stats([uuid], period)[0]
 
-        return {
-            "successes": successes,
-            "failures": failures
-        }
-
-    def get_many_routes_stats(self, uuids: List[str]):
+    def get_many_routes_stats(self, uuids: List[str], period: str = None):
         """
-        Batch query of statistics for many routes. Only returns number of successes and failures
+        Batch query of statistics for many routes, in one request. Only returns number of successes and failures.
+        period is an optional key of STATISTIC_PERIODS, which only counts logs from within that period.
         """
+        if period is not None:
+            since = int(time.time() * 1000) - STATISTIC_PERIODS[period]
+        else:
+            since = None
 
-        msearch = MultiSearch(using=self._es, index=self._index)
+        counts = self._log_store.count_outcomes(uuids, since)
 
-        for uuid in uuids:
-            msearch = msearch.add(self._logs_query(uuid, True))
-            msearch = msearch.add(self._logs_query(uuid, False))
+        return [dict(counts.get(uuid, {"successes": 0, "failures": 0})) for uuid in uuids]
 
-        responses = msearch.execute()
+    @staticmethod
+    def _parse_time(time_string: str) -> datetime.datetime:
+        try:
+            parsed_time = dateutil.parser.parse(time_string)
+        except (ValueError, OverflowError) as e:
+            raise InvalidTimeError() from e
 
-        assert len(responses) == len(uuids) * 2
+        # Times without a timezone are in UTC
+        if parsed_time.tzinfo is None:
+            parsed_time = parsed_time.replace(tzinfo=datetime.timezone.utc)
 
-        route_stats = []
-        for i in range(len(uuids)):
-            route_stats.append({
-                "successes": responses[i*2].hits.total,
-                "failures": responses[i*2 + 1].hits.total
-            })
+        return parsed_time
 
-        return route_stats
+    def get_route_timeseries(self, uuid: str, interval: str, since: str = None):
+        """
+        Gets the number of successes and failures of a route in each interval (a key of TIMESERIES_INTERVALS)
+        from since until now, oldest first. Closed buckets are memoised, so only recent buckets are queried.
+        """
+        interval_ms = TIMESERIES_INTERVALS[interval][1]
+        now = int(time.time() * 1000)
+        end = (now // interval_ms + 1) * interval_ms
+
+        if since is None:
+            start = end - DEFAULT_TIMESERIES_BUCKETS * interval_ms
+        else:
+            start = StatisticQueryier._parse_millis(since) // interval_ms * interval_ms
+        start = max(start, end - MAX_TIMESERIES_BUCKETS * interval_ms)
+
+        closed_limit = (now - TIMESERIES_SETTLE_DELAY_MS) // interval_ms * interval_ms
+
+        buckets = self._rollup_cache.get_buckets((uuid, interval), interval_ms, start, closed_limit, end,
+            lambda query_from: self._log_store.count_timeseries(uuid, interval, query_from))
+
+        return [
+            {
+                "timestamp": datetime.datetime.utcfromtimestamp(bucket_start / 1000).isoformat() + "Z",
+                **buckets.get(bucket_start, {"successes": 0, "failures": 0})
+            }
+            for bucket_start in range(start, end, interval_ms)
+        ]
@@ -0,0 +1,74 @@
+import threading
+from typing import Callable, Dict
+
+from cachetools import LRUCache
+
+DEFAULT_MAX_SERIES = 1000
+DEFAULT_MAX_BUCKETS = 1000
+
+class _RolledUpSeries:
+    def __init__(self, covered_from: int) -> None:
+        # Every closed bucket in [covered_from, closed_until) is in buckets (if it has any logs)
+        self.covered_from = covered_from
+        self.closed_until = covered_from
+        self.buckets = {} # type: Dict[int, dict]
+
+class StatisticRollupCache:
+    """
+    Memoises the closed buckets of route time series, so that polling a time series only
+    queries elasticsearch for the buckets that can still change.
+
+    Times are integer milliseconds since the epoch, and buckets are keyed by their start time.
+    """
+    def __init__(self, max_series: int = DEFAULT_MAX_SERIES, max_buckets: int = DEFAULT_MAX_BUCKETS) -> None:
+        self._series = LRUCache(maxsize=max_series)
+        self._max_buckets = max_buckets
+        self._lock = threading.Lock()
+
+    def get_buckets(self, key, interval_ms: int, start: int, closed_limit: int, end: int,
+                    query: Callable[[int], Dict[int, dict]]) -> Dict[int, dict]:
+        """
+        Returns the buckets in [start, end) for the series identified by key.
+        Buckets starting before closed_limit are treated as closed, meaning they won't change.
+
+        query(query_from) is called to get the buckets from query_from onwards that aren't memoised.
+        Buckets without logs can be left out by query, and are left out of the returned value.
+        """
+        with self._lock:
+            series = self._series.get(key)
+
+            # A series starting after start, or ending before it (which would leave a gap), is started again
+            if series is None or series.covered_from > start or series.closed_until < start:
+                series = _RolledUpSeries(start)
+                self._series[key] = series
+
+            query_from = max(start, series.closed_until)
+
+        fresh_buckets = query(query_from)
+
+        with self._lock:
+            for (bucket_start, bucket) in fresh_buckets.items():
+                if bucket_start < closed_limit:
+                    series.buckets[bucket_start] = bucket
+
+            series.closed_until = max(series.closed_until, closed_limit)
+
+            # Forget the oldest buckets
+            oldest_kept = series.closed_until - self._max_buckets * interval_ms
+            if series.covered_from < oldest_kept:
+                series.covered_from = oldest_kept
+                series.buckets = {
+                    bucket_start: bucket for (bucket_start, bucket) in series.buckets.items()
+                    if bucket_start >= oldest_kept
+                }
+
+            buckets = {
+                bucket_start: bucket for (bucket_start, bucket) in series.buckets.items()
+                if start <= bucket_start < query_from
+            }
+
+        for (bucket_start, bucket) in fresh_buckets.items():
+            if max(start, query_from) <= bucket_start < end:
+                buckets[bucket_start] = bucket
+
+        return buckets
@@ -0,0 +1,120 @@
+import threading
+import time
+from typing import Iterable
+
+from cachetools import TTLCache
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 60
+DEFAULT_SYNC_INTERVAL = 1
+DEFAULT_CHANGED_TTL = 5
+
+class TokenCache:
+    """
+    Bounded LRU cache, with entries expiring after a TTL, which maps a token id to the
+    resolved route dict. Used by RouteDataMapper.get_by_token to avoid querying the database
+    for every webhook the router receives.
+
+    NOTE: the cached route dict contains the full token, so callers still need to compare
+    the token they were given against it.
+
+    Each process has its own cache, so routes changed by other processes are dropped by syncing
+    with the change feed, which RouteDataMapper does at most once every sync_interval seconds
+    (see start_sync). Routes changed by other processes aren't cached for changed_ttl seconds
+    afterwards, so a lookup that raced with the sync (or read from a lagging replica) can't cache
+    the old route again.
+    """
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, ttl: float = DEFAULT_TTL,
+                 sync_interval: float = DEFAULT_SYNC_INTERVAL, changed_ttl: float = DEFAULT_CHANGED_TTL) -> None:
+        self._cache = TTLCache(maxsize=max_size, ttl=ttl)
+        self._changed_uuids = TTLCache(maxsize=max_size, ttl=changed_ttl)
+        # cachetools caches aren't thread safe
+        self._lock = threading.Lock()
+
+        self._sync_interval = sync_interval
+        self._next_sync = 0
+        self._syncing = False
+        # The revision of the change feed the cache has been synced to, None until the first sync
+        self.synced_revision = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token_id: str):
+        """
+        Returns the cached route dict for the token id, or None if it isn't cached
+        """
+        with self._lock:
+            route = self._cache.get(token_id)
+
+            if route is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return route
+
+    def set(self, token_id: str, route: dict):
+        with self._lock:
+            if route["uuid"] not in self._changed_uuids:
+                self._cache[token_id] = route
+
+    def invalidate(self, token_id: str):
+        with self._lock:
+            self._cache.pop(token_id, None)
+
+    def invalidate_routes(self, uuids: Iterable[str]):
+        """
+        Drops the routes with the given uuids, which have been changed by another process
+        """
+        uuids = set(uuids)
+        if len(uuids) == 0:
+            return
+
+        with self._lock:
+            for uuid in uuids:
+                self._changed_uuids[uuid] = True
+
+            for token_id in [token_id for (token_id, route) in self._cache.items() if route["uuid"] in uuids]:
+                del self._cache[token_id]
+
+    def start_sync(self) -> bool:
+        """
+        Returns whether the cache is due to be synced with the change feed, in which case the
+        caller must call finish_sync once it has, or has failed to
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            if self._syncing or now < self._next_sync:
+                return False
+
+            self._syncing = True
+            return True
+
+    def finish_sync(self, revision: int = None):
+        """
+        Records that the cache has been synced to the given revision (None if syncing failed)
+        """
+        with self._lock:
+            if revision is not None:
+                self.synced_revision = revision
+            self._syncing = False
+            self._next_sync = time.monotonic() + self._sync_interval
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def info(self):
+        """
+        Returns the hit/miss counters and the size of the cache, for sizing the cache
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": self._cache.currsize,
+                "max_size": self._cache.maxsize,
+                "ttl": self._cache.ttl
+            }
@@ -1,11 +1,15 @@
 import logging
 from abc import ABC, ABCMeta
+from typing import List
 
-from peewee import DoesNotExist
+from peewee import DoesNotExist, PostgresqlDatabase
 
 from .errors import *
-from .models import Route, UserLink, extract_route_dict
+from .metrics import DB_QUERY_LATENCY
+from .models import Route, UserLink, extract_route_dict, insert_or_ignore, proxy_db, replica_router
 
+# Links inserted by each statement of add_new_user_links, so statements stay under SQLite's limit of 999 variables
+BULK_INSERT_BATCH_SIZE = 400
 
 class UserLinkDataMapper:
     """
@@ -14,29 +18,76 @@ class UserLinkDataMapper:
     """
 
     def _try_get_link(self, user: str, uuid: str):
-        return UserLink.get((UserLink.route == uuid) & (UserLink.user == user))
+        with DB_QUERY_LATENCY.labels("get_user_link").time():
+            return UserLink.get((UserLink.route == uuid) & (UserLink.user == user))
 
     def add_user_link(self, user: str, uuid: str):
-        try:
-            link = self._try_get_link(user, uuid)
-        except DoesNotExist:
-            link = UserLink(
-                user=user,
-                route=uuid
-            )
+        """
+        Links the route to the user, doing nothing if they're already linked, in one statement
+        """
+        with DB_QUERY_LATENCY.labels("add_user_link").time():
+            insert_or_ignore(UserLink, [{"user": user, "route": uuid}])
 
-            link.save()
+        replica_router.mark_written(("user", user))
 
-    def has_user_link(self, user: str, uuid: str):
-        try:
-            self._try_get_link(user, uuid)
-        except DoesNotExist:
-            return False
+    def link_route(self, user: str, uuid: str):
+        """
+        Links the route to the user like add_user_link, returning the route, or raising InvalidRouteUUIDError
+        if it doesn't exist. On Postgres this is one statement, which reads the route and inserts the link.
+        """
+        with DB_QUERY_LATENCY.labels("link_route").time():
+            if isinstance(proxy_db.obj, PostgresqlDatabase):
+                routes = list(Route.raw(
+                    f'WITH "linked_route" AS (SELECT * FROM "{Route._meta.db_table}" WHERE "uuid" = %s), '
+                    f'"link" AS (INSERT INTO "{UserLink._meta.db_table}" ("user", "route_id") '
+                    f'SELECT %s, "uuid" FROM "linked_route" ON CONFLICT DO NOTHING) '
+                    f'SELECT * FROM "linked_route"',
+                    uuid, user))
+            else:
+                # SQLite can't insert from a WITH clause
+                with proxy_db.atomic():
+                    routes = list(Route.select().where(Route.uuid == uuid))
+                    if len(routes) > 0:
+                        insert_or_ignore(UserLink, [{"user": user, "route": uuid}])
+
+        if len(routes) == 0:
+            raise InvalidRouteUUIDError()
+
+        replica_router.mark_written(("user", user))
+
+        return extract_route_dict(routes[0])
+
+    def add_new_user_links(self, user: str, uuids: List[str]):
+        """
+        Batch version of add_user_link, for routes that can't already be linked to the user (as they've
+        just been created), so conflicts aren't handled
+        """
+        for start in range(0, len(uuids), BULK_INSERT_BATCH_SIZE):
+            with DB_QUERY_LATENCY.labels("add_user_links").time():
+                UserLink.insert_many([
+                    {"user": user, "route": uuid}
+                    for uuid in uuids[start:start + BULK_INSERT_BATCH_SIZE]
+                ]).execute()
+
+        replica_router.mark_written(("user", user))
+
+    def get_linked_route(self, user: str, uuid: str):
+        """
+        Gets the route if it's linked to the user, with one query joining the route to the link
+        """
+        with DB_QUERY_LATENCY.labels("get_linked_route").time():
+            routes = list(replica_router.read(
+                Route.select().join(UserLink).where((UserLink.user == user) & (Route.uuid == uuid)).limit(1),
+                [("user", user), ("route", uuid)]))
+
+        if len(routes) == 0:
+            raise RouteLinkNotFound()
 
-        return True
+        return extract_route_dict(routes[0])
 
     def get_users_links(self, user: str):
-        routes = Route.select().join(UserLink).where(UserLink.user == user)
+        with DB_QUERY_LATENCY.labels("get_users_routes").time():
+            routes = list(replica_router.read(Route.select().join(UserLink).where(UserLink.user == user), [("user", user)]))
 
         return [extract_route_dict(route) for route in routes]
 
@@ -46,4 +97,6 @@ class UserLinkDataMapper:
         except DoesNotExist as e:
             pass # Make this idempotent
         else:
-            link.delete_instance()
+            with DB_QUERY_LATENCY.labels("remove_user_link").time():
+                link.delete_instance()
+            replica_router.mark_written(("user", user))
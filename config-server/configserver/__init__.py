@@ -1,2 +1,3 @@
-from .auth import test_auth
-from .configserver import ConfigServer, get_postgres_db, main, start_server
+from webhookcommon.auth import test_auth
+from .configserver import (ConfigServer, get_postgres_db, get_replica_dbs, main, start_prefork_server,
+                           start_server)
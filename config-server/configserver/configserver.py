@@ -1,67 +1,110 @@
 import argparse
+import functools
 import json
 import os
 from functools import partial
 from http import HTTPStatus
-from typing import Callable, Type, Any
-import time
+from typing import Any, Callable, List, Type
 import logging
 
 import connexion
+from connexion.decorators.response import ResponseValidator
 import flask
+import tornado.wsgi
 from flask_cors import CORS
-from peewee import Database, PostgresqlDatabase, SqliteDatabase, OperationalError
+from peewee import Database, PostgresqlDatabase, SqliteDatabase
+from playhouse.pool import PooledDatabase, PooledPostgresqlDatabase
+from webhookcommon.auth import (DEFAULT_IDENTITY_CACHE_EXPIRY, DEFAULT_REJECTED_TOKEN_CACHE_EXPIRY,
+                                configure_identity_cache)
+from webhookcommon.launcher import PreforkLauncher
 
-from .auth import *
 from .ConnexionDespatcher import ConnexionDespatcher
 from .errors import *
 from .logging import *
-from .models import Route, UserLink, proxy_db
+from .LogStore import ElasticsearchLogStore, LogStore
+from .metrics import METRICS_PATH, metrics_response
+from .migrations import migrate_schema
+from .models import DEFAULT_REPLICA_LAG_ALLOWANCE, Route, UserLink, proxy_db, replica_router
+from .RateLimiter import DEFAULT_BURST_SECONDS, DatabaseRateLimitStore, MemoryRateLimitStore, RateLimiter
+from .readiness import ReadinessMonitor
 from .RouteDataMapper import RouteDataMapper
+from .serving import ExecutorWSGIContainer, run_executor_server
 from .StatisticQueryier import StatisticQueryier
+from .TokenCache import DEFAULT_MAX_SIZE, DEFAULT_SYNC_INTERVAL, DEFAULT_TTL, TokenCache
 from .UserLinkDataMapper import UserLinkDataMapper
 
 logger = ConfigServerLogger()
-DB_CONNECT_RETRY_ATTEMPTS = 10
+DATABASE_SERVICE = "database"
+LOG_STORE_SERVICE = "log_store"
+HEALTH_PATH = "/health"
+DEFAULT_DB_MAX_CONNECTIONS = 20
+DEFAULT_DB_STALE_TIMEOUT = 300
+
+class StreamedResponseValidator(ResponseValidator):
+    """
+    Validates responses like connexion's validator, except for streamed responses (such as the
+    route snapshot), which it would read into memory to validate
+    """
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(request):
+            response = function(request)
+
+            if response.is_streamed:
+                return response
+
+            return ResponseValidator.__call__(self, lambda _: response)(request)
+
+        return wrapper
 
 class ConfigServer:
     """
-    Main class for serving requests
+    Main class for serving requests.
+    Route logs and statistics come from log_store, or from elasticsearch at ELASTICSEARCH_HOST if it isn't given.
+    Change feed requests only long poll when served by async_workers threads, and at most maxLongPolls of them
+    (by default half the threads) wait at once.
     """
-    def __init__(self, use_test_auth: bool, db: Database, config_JSON: any) -> None:
+    def __init__(self, use_test_auth: bool, db: Database, config_JSON: any, replica_dbs: List[Database] = (),
+                 log_store: LogStore = None, async_workers: int = 0) -> None:
         self._db = db
+        self._replica_dbs = list(replica_dbs)
 
-        # wait until the database is up until we create tables if not present
-        # and start the server
-        for i in range(DB_CONNECT_RETRY_ATTEMPTS):
-            try:
-                db.connect()
-            except OperationalError:
-                logger.warning("Failed connecting to database.", extra={
-                    "attempts": i + 1,
-                    "maximum_attempts": DB_CONNECT_RETRY_ATTEMPTS
-                })
-
-                if i + 1 == DB_CONNECT_RETRY_ATTEMPTS - 1:
-                    raise
-            else:
-                logger.info("Connected to the database.")
-                break
-
-            time.sleep(1)
+        configure_identity_cache(
+            expiry=config_JSON.get("authCacheExpiry", DEFAULT_IDENTITY_CACHE_EXPIRY),
+            rejected_expiry=config_JSON.get("authRejectedCacheExpiry", DEFAULT_REJECTED_TOKEN_CACHE_EXPIRY)
+        )
 
         proxy_db.initialize(db)
-        db.create_tables([Route, UserLink], safe=True)
-        db.close()
+
+        replica_router.initialize(
+            self._replica_dbs,
+            config_JSON.get("database", {}).get("replicaLagAllowance", DEFAULT_REPLICA_LAG_ALLOWANCE)
+        )
 
         user_link_dm = UserLinkDataMapper()
-        route_dm = RouteDataMapper(user_link_dm)
+        token_cache = TokenCache(
+            max_size=config_JSON.get("tokenCacheSize", DEFAULT_MAX_SIZE),
+            ttl=config_JSON.get("tokenCacheTTL", DEFAULT_TTL),
+            sync_interval=config_JSON.get("tokenCacheSyncInterval", DEFAULT_SYNC_INTERVAL),
+            # Routes read from a replica could be this old
+            changed_ttl=config_JSON.get("database", {}).get("replicaLagAllowance", DEFAULT_REPLICA_LAG_ALLOWANCE)
+        )
+        route_dm = RouteDataMapper(user_link_dm, token_cache)
 
-        if "ELASTICSEARCH_USER" in os.environ:
-            password_prefix = f"{os.environ['ELASTICSEARCH_USER']}:{os.environ['ELASTICSEARCH_PASSWORD']}@"
-        else:
-            password_prefix = ""
-        stat_queryier = StatisticQueryier(f"http://{password_prefix}{os.environ['ELASTICSEARCH_HOST']}:9200")
+        if log_store is None:
+            if "ELASTICSEARCH_USER" in os.environ:
+                password_prefix = f"{os.environ['ELASTICSEARCH_USER']}:{os.environ['ELASTICSEARCH_PASSWORD']}@"
+            else:
+                password_prefix = ""
+            log_store = ElasticsearchLogStore(f"http://{password_prefix}{os.environ['ELASTICSEARCH_HOST']}:9200")
+        stat_queryier = StatisticQueryier(log_store=log_store)
+
+        # The server starts straight away, and requests that need the database are refused until
+        # it's up and its tables have been created
+        self.readiness = ReadinessMonitor()
+        self.readiness.add_check(DATABASE_SERVICE, self._check_db, on_ready=self._migrate_db)
+        self.readiness.add_check(LOG_STORE_SERVICE, stat_queryier.check_connection, required=False)
+        self.readiness.start()
 
         self.depatcher = ConnexionDespatcher(
             use_test_auth,
@@ -69,16 +112,23 @@ class ConfigServer:
             user_link_dm,
             stat_queryier,
             logger,
-            config_JSON["googleClientId"]
+            config_JSON["googleClientId"],
+            config_JSON.get("adminUsers", []),
+            ConfigServer._create_rate_limiter(config_JSON),
+            config_JSON.get("maxLongPolls", async_workers // 2) if async_workers > 0 else 0
         )
 
         self.app = connexion.App(__name__, specification_dir=".", server='tornado', auth_all_paths=(not use_test_auth))
-        CORS(self.app.app, origins=f"{config_JSON['frontEnd']}*")
+        CORS(self.app.app, origins=f"{config_JSON['frontEnd']}*", expose_headers=["X-Next-Cursor"])
 
         self._set_error_handlers()
         self._setup_logging()
 
         self.app.app.after_request(self.on_after_request)
+        self.app.app.before_request(self._on_before_request)
+        self.app.app.teardown_request(self._on_teardown_request)
+        self.app.app.add_url_rule(HEALTH_PATH, "health", self._health)
+        self.app.app.add_url_rule(METRICS_PATH, "metrics", metrics_response)
 
         standard_securities = [
             {
@@ -91,12 +141,27 @@ class ConfigServer:
             '../swagger.yaml',
             resolver=connexion.Resolver(self.depatcher.resolve_name),
             validate_responses=True,
+            validator_map={"response": StreamedResponseValidator},
             arguments={
                 "securities": [] if use_test_auth else standard_securities,
                 "use_security": not use_test_auth
             }
         )
 
+    @staticmethod
+    def _create_rate_limiter(config_JSON: Any) -> RateLimiter:
+        """
+        Rate limits are kept in the database (so they hold across every config server), unless rateLimitStore is "memory"
+        """
+        burst_seconds = config_JSON.get("rateLimitBurstSeconds", DEFAULT_BURST_SECONDS)
+
+        if config_JSON.get("rateLimitStore", "database") == "memory":
+            store = MemoryRateLimitStore(idle_ttl=burst_seconds)
+        else:
+            store = DatabaseRateLimitStore()
+
+        return RateLimiter(store, burst_seconds)
+
     def _setup_logging(self):
         """
         Code that sets up hooks for logging requests.
@@ -111,6 +176,47 @@ class ConfigServer:
         # This is needed, as flask logs aren't propogated to the root logger
         add_file_log_handler(self.app.app.logger)
 
+    def _check_db(self):
+        # Runs on the readiness thread, which has its own connection
+        self._db.connect()
+        try:
+            self._db.execute_sql("SELECT 1")
+        finally:
+            self._db.close()
+
+    def _migrate_db(self):
+        self._db.connect()
+        try:
+            migrate_schema(self._db)
+        finally:
+            self._db.close()
+
+    def _health(self):
+        status = self.readiness.status()
+
+        return flask.make_response(flask.jsonify(status),
+            HTTPStatus.OK if status["ready"] else HTTPStatus.SERVICE_UNAVAILABLE)
+
+    def _on_before_request(self):
+        if flask.request.path in (HEALTH_PATH, METRICS_PATH):
+            return
+
+        if not self.readiness.is_ready(DATABASE_SERVICE):
+            raise ServiceUnavailableError("The database isn't available yet.")
+
+        replica_router.start_request()
+
+        # Each request gets a connection (from the pool, if pooling is enabled) ...
+        if self._db.is_closed():
+            self._db.connect()
+
+    def _on_teardown_request(self, exception):
+        # ... which is given back at the end of the request.
+        # Replicas are connected to when they're first used by a request
+        for db in [self._db, *self._replica_dbs]:
+            if not db.is_closed():
+                db.close()
+
     @staticmethod
     def on_after_request(response):
         logger.log_http_request(response)
@@ -136,36 +242,131 @@ class ConfigServer:
         self._set_error_handler(InvalidURLError, 4, "Invalid URL in destination", HTTPStatus.BAD_REQUEST)
         self._set_error_handler(InvalidCredentialsError, 5, "Invalid credentials", HTTPStatus.BAD_REQUEST)
         self._set_error_handler(RouteLinkNotFound, 6, "Route link doesn't exist", HTTPStatus.NOT_FOUND)
+        self._set_error_handler(InvalidLogCursorError, 7, "Invalid logs cursor", HTTPStatus.BAD_REQUEST)
+        self._set_error_handler(InvalidTimeError, 8, "Invalid time", HTTPStatus.BAD_REQUEST)
+        self._set_error_handler(ServiceUnavailableError, 9, "Service unavailable", HTTPStatus.SERVICE_UNAVAILABLE)
 
     def close(self):
-        self._db.close()
-
-def get_postgres_db():
-    return PostgresqlDatabase(
-            os.environ["POSTGRES_DB"],
-            user=os.environ["POSTGRES_USER"],
-            password=os.environ["POSTGRES_PASSWORD"],
-            host=os.environ["POSTGRES_HOST"],
-            autorollback=True
+        self.readiness.stop()
+
+        for db in [self._db, *self._replica_dbs]:
+            # Connections are opened by the readiness checks and requests on other threads, so this
+            # thread may never have connected
+            if not db.is_closed():
+                db.close()
+
+            if isinstance(db, PooledDatabase):
+                db.close_all()
+
+class HealthCheckedPooledPostgresqlDatabase(PooledPostgresqlDatabase):
+    """
+    Connection pool which checks that a pooled connection still works before handing it out,
+    so connections that the server dropped aren't given to requests
+    """
+    def _is_closed(self, key, conn):
+        if super()._is_closed(key, conn):
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except Exception:
+            logger.warning("Discarding unhealthy pooled database connection.")
+            return True
+
+        return False
+
+def get_postgres_db(config_JSON: Any = None, host: str = None):
+    """
+    Returns the postgres database (at POSTGRES_HOST, unless host is given). If the "database" section
+    of config_JSON has "pool" set, connections are pooled, with up to "maxConnections" connections
+    that are recycled after "staleTimeout" seconds.
+    """
+    db_config = (config_JSON or {}).get("database", {})
+
+    db_args = [os.environ["POSTGRES_DB"]]
+    db_kwargs = {
+        "user": os.environ["POSTGRES_USER"],
+        "password": os.environ["POSTGRES_PASSWORD"],
+        "host": host if host is not None else os.environ["POSTGRES_HOST"],
+        "autorollback": True
+    }
+
+    if db_config.get("pool", False):
+        return HealthCheckedPooledPostgresqlDatabase(
+            *db_args,
+            max_connections=db_config.get("maxConnections", DEFAULT_DB_MAX_CONNECTIONS),
+            stale_timeout=db_config.get("staleTimeout", DEFAULT_DB_STALE_TIMEOUT),
+            **db_kwargs
         )
+    else:
+        return PostgresqlDatabase(*db_args, **db_kwargs)
+
+def get_replica_dbs(config_JSON: Any):
+    """
+    Returns the read replicas listed (as hostnames) in "replicas" of the "database" section of config_JSON
+    """
+    return [
+        get_postgres_db(config_JSON, host=replica_host)
+        for replica_host in config_JSON.get("database", {}).get("replicas", [])
+    ]
+
+def _create_server(debug: bool, config_JSON: Any, async_workers: int):
+    return ConfigServer(
+        use_test_auth=debug,
+        db=get_postgres_db(config_JSON),
+        config_JSON=config_JSON,
+        replica_dbs=get_replica_dbs(config_JSON),
+        async_workers=async_workers
+    )
+
+def start_prefork_server(debug: bool, port: int, host: str, config_JSON: Any, workers: int,
+                         async_workers: int = 0, max_requests: int = 0, max_memory_mb: int = 0):
+    """
+    Serves requests from worker processes, each with their own database connections
+    """
+    if async_workers > 0:
+        container_factory = lambda wsgi_app: ExecutorWSGIContainer(wsgi_app, async_workers)
+    else:
+        container_factory = tornado.wsgi.WSGIContainer
 
-def start_server(debug: bool, port: int, host: str, config_JSON: Any):
+    logger.info("Server running", extra={
+        "port": port,
+        "host": host,
+        "workers": workers,
+        "async_workers": async_workers
+    })
+
+    PreforkLauncher(
+        lambda: _create_server(debug, config_JSON, async_workers).app.app,
+        host,
+        port,
+        workers,
+        container_factory=container_factory,
+        max_requests=max_requests,
+        max_memory_mb=max_memory_mb,
+        after_fork=logger.after_fork,
+        logger=logging.getLogger("config_server.launcher")
+    ).run()
+
+def start_server(debug: bool, port: int, host: str, config_JSON: Any, async_workers: int = 0):
     # client_id = config_JSON.get("clientId")
 
     # if not debug and not client_id:
     #     raise TypeError("server: main(...) - test=False requires client_id to have a value")
-    server = ConfigServer(
-        use_test_auth=debug,
-        db=get_postgres_db(),
-        config_JSON=config_JSON
-    )
+    server = _create_server(debug, config_JSON, async_workers)
 
     logger.info("Server running", extra={
         "port": port,
-        "host": host
+        "host": host,
+        "async_workers": async_workers
     })
 
-    server.app.run(port=port, host=host)
+    if async_workers > 0:
+        run_executor_server(server.app.app, host, port, async_workers)
+    else:
+        server.app.run(port=port, host=host)
 
 def main():
     parser = argparse.ArgumentParser(description='Generates CWL files from the GATK documentation')
@@ -174,6 +375,12 @@ def main():
     parser.add_argument("--port", help="Port to serve requests over", type=int, default=8081)
     parser.add_argument("--host", help="Host to serve requests from", default="127.0.0.1")
     parser.add_argument("--config-JSON", help="Location of a JSON file which contains non secret configuration information", default="config.json")
+    parser.add_argument("--async-workers", help="Handle requests on this many threads, so slow requests don't block others. "
+        "When database pooling is enabled, maxConnections should be at least this many", type=int, default=0)
+    parser.add_argument("--workers", help="Serve requests from this many processes. "
+        "SIGHUP restarts the workers without dropping requests", type=int, default=0)
+    parser.add_argument("--max-requests", help="Replace a worker process after it has served this many requests", type=int, default=0)
+    parser.add_argument("--max-memory", help="Replace a worker process once it has used this many megabytes of memory", type=int, default=0)
 
     options = parser.parse_args()
 
@@ -186,7 +393,11 @@ def main():
     if options.debug:
         logger.warning("Debug mode is active (THIS IS NOT SECURE).")
 
-    start_server(options.debug, options.port, options.host, config_JSON)
+    if options.workers > 0:
+        start_prefork_server(options.debug, options.port, options.host, config_JSON, options.workers,
+            options.async_workers, options.max_requests, options.max_memory)
+    else:
+        start_server(options.debug, options.port, options.host, config_JSON, options.async_workers)
 
 if __name__ == "__main__":
     main()
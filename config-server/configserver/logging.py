@@ -1,15 +1,59 @@
+import atexit
+import collections
+import datetime
+import json
 import logging
+import re
+import threading
 
 import flask
 from pythonjsonlogger import jsonlogger
-from cmreslogging.handlers import CMRESHandler
 import os
-import sys
 import requests
 import time
 
+from .metrics import ES_LOG_DROPPED_RECORDS
+
 LOGGING_CONFIG = "(asctime) (message) (levelname)"
 
+ES_LOG_BATCH_SIZE = 500
+ES_LOG_FLUSH_INTERVAL = 1
+ES_LOG_MAX_QUEUE_BYTES = 10 * 1024 * 1024
+ES_LOG_REQUEST_TIMEOUT = 10
+ES_LOG_SHUTDOWN_TIMEOUT = 5
+
+# LogRecord attributes that aren't worth indexing
+_UNINDEXED_RECORD_FIELDS = {"args", "msg", "msecs", "relativeCreated", "levelno", "created", "exc_info"}
+
+# Route tokens are secrets, so they're redacted from these fields (at any depth) and from urls
+_TOKEN_FIELDS = {"token", "tokens"}
+_TOKEN_URL_PATH = re.compile(r"(/routes/token/)[^/?#]+")
+REDACTED = "[redacted]"
+
+# Failures sending logs to elasticsearch can't be logged there, so they're logged to stderr
+_shipper_logger = logging.getLogger("es_log_shipper")
+_shipper_logger.propagate = False
+_shipper_logger.setLevel(logging.INFO)
+_shipper_stderr_handler = logging.StreamHandler()
+_shipper_stderr_handler.setFormatter(jsonlogger.JsonFormatter(LOGGING_CONFIG))
+_shipper_logger.addHandler(_shipper_stderr_handler)
+
+def redact_tokens(value):
+    """
+    Copies value (such as a record's fields), replacing any route tokens in it with REDACTED
+    """
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key in _TOKEN_FIELDS else redact_tokens(item)
+            for (key, item) in value.items()
+        }
+    elif isinstance(value, (list, tuple)):
+        return [redact_tokens(item) for item in value]
+    elif isinstance(value, str):
+        return _TOKEN_URL_PATH.sub(r"\g<1>" + REDACTED, value)
+    else:
+        return value
+
 def add_file_log_handler(logger):
     """
     Configures the given logger to output to the log file "logs.log", in order to be picked up
@@ -20,6 +64,181 @@ def add_file_log_handler(logger):
     handler.setFormatter(json_formatter)
     logger.addHandler(handler)
 
+class BulkElasticsearchHandler(logging.Handler):
+    """
+    Logging handler that queues records and ships them to elasticsearch's _bulk api from a
+    background thread, so logging never waits on elasticsearch.
+
+    Records are redacted and serialized as they're logged, so later changes to the objects they
+    reference aren't shipped, and the queue's size is known.
+    A batch is sent once batch_size records are queued, or every flush_interval seconds.
+    The queue holds at most max_queue_bytes of serialized records, after which the oldest records
+    are dropped and counted in ES_LOG_DROPPED_RECORDS.
+    """
+    def __init__(self, url: str, index_name: str, auth=None,
+                 batch_size: int = ES_LOG_BATCH_SIZE,
+                 flush_interval: float = ES_LOG_FLUSH_INTERVAL,
+                 max_queue_bytes: int = ES_LOG_MAX_QUEUE_BYTES) -> None:
+        super().__init__()
+        self._bulk_url = f"{url}/_bulk"
+        self._index_name = index_name
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_queue_bytes = max_queue_bytes
+
+        self._session = requests.Session()
+        self._auth = auth
+        self._session.auth = auth
+
+        self._queue = collections.deque()
+        self._queued_bytes = 0
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._closed = False
+
+        self._start_shipper()
+
+        atexit.register(self.close)
+
+    def _start_shipper(self):
+        self._shipper = threading.Thread(target=self._ship_forever, name="es-log-shipper", daemon=True)
+        self._shipper.start()
+
+    def after_fork(self):
+        """
+        Restarts shipping in a forked child process, which doesn't inherit the shipper thread.
+        Records queued before the fork are left to the parent to send
+        """
+        self._session = requests.Session()
+        self._session.auth = self._auth
+        self._condition = threading.Condition()
+        self._queue.clear()
+        self._queued_bytes = 0
+        self._in_flight = 0
+        self._start_shipper()
+
+    def _record_to_doc(self, record: logging.LogRecord):
+        doc = {
+            key: value for (key, value) in record.__dict__.items()
+            if key not in _UNINDEXED_RECORD_FIELDS and value is not None
+        }
+        doc["message"] = record.getMessage()
+        doc["timestamp"] = datetime.datetime.utcfromtimestamp(record.created).isoformat() + "Z"
+
+        return doc
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            doc = json.dumps(redact_tokens(self._record_to_doc(record)), default=str)
+        except Exception:
+            self.handleError(record)
+            return
+
+        with self._condition:
+            self._queue.append(doc)
+            # json.dumps escapes non ASCII characters, so the length of a doc is its size in bytes
+            self._queued_bytes += len(doc)
+            self._drop_oldest()
+
+            if len(self._queue) >= self._batch_size:
+                self._condition.notify_all()
+
+    def _drop_oldest(self):
+        """
+        Drops the oldest records until the queue fits in max_queue_bytes. Needs the condition's lock
+        """
+        dropped = 0
+        while self._queued_bytes > self._max_queue_bytes:
+            self._queued_bytes -= len(self._queue.popleft())
+            dropped += 1
+
+        if dropped != 0:
+            ES_LOG_DROPPED_RECORDS.inc(dropped)
+
+    def _requeue(self, batch):
+        """
+        Puts a batch that failed to send back at the front of the queue,
+        dropping the oldest records if there isn't room for all of them
+        """
+        with self._condition:
+            self._queue.extendleft(reversed(batch))
+            self._queued_bytes += sum(len(doc) for doc in batch)
+            self._drop_oldest()
+
+    def _send(self, batch):
+        index = f"{self._index_name}-{datetime.datetime.utcnow():%Y.%m.%d}"
+        action = json.dumps({"index": {"_index": index, "_type": "python_log"}})
+
+        body = "".join(f"{action}\n{doc}\n" for doc in batch)
+
+        response = self._session.post(self._bulk_url,
+            data=body.encode(),
+            headers={"Content-Type": "application/x-ndjson"},
+            timeout=ES_LOG_REQUEST_TIMEOUT
+        )
+        response.raise_for_status()
+
+    def _ship_forever(self):
+        while True:
+            with self._condition:
+                if not self._closed and len(self._queue) < self._batch_size:
+                    self._condition.wait(self._flush_interval)
+
+                batch = [self._queue.popleft() for _ in range(min(self._batch_size, len(self._queue)))]
+                self._queued_bytes -= sum(len(doc) for doc in batch)
+                closed = self._closed
+                self._in_flight = len(batch)
+
+            failed = False
+            if len(batch) != 0:
+                try:
+                    self._send(batch)
+                except Exception as e:
+                    failed = True
+                    _shipper_logger.error("Failed sending logs to elasticsearch.", extra={
+                        "error": repr(e),
+                        "records": len(batch)
+                    })
+
+                    if not closed:
+                        self._requeue(batch)
+
+            with self._condition:
+                self._in_flight = 0
+                self._condition.notify_all()
+
+                if closed and (failed or len(self._queue) == 0):
+                    return
+
+            if failed and not closed:
+                # Back off, so that a down elasticsearch isn't hammered with requests
+                time.sleep(self._flush_interval)
+
+    def flush(self, timeout: float = ES_LOG_SHUTDOWN_TIMEOUT):
+        """
+        Waits (up to timeout seconds) until every queued record has been sent
+        """
+        deadline = time.monotonic() + timeout
+
+        with self._condition:
+            self._condition.notify_all()
+
+            while (len(self._queue) != 0 or self._in_flight != 0) and self._shipper.is_alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                self._condition.wait(remaining)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        self._shipper.join(ES_LOG_SHUTDOWN_TIMEOUT)
+
+        super().close()
+
 class ConfigServerLogger:
     def __init__(self):
         logger = logging.getLogger("config_server")
@@ -31,46 +250,35 @@ class ConfigServerLogger:
         stdout_handler.setFormatter(json_formatter)
         logger.addHandler(stdout_handler)
 
-        # Wait for elastic search to boot before starting
-
-        first_time_check = True
-        while True:
-            try:
-                es_json = requests.get(f"""http://{os.environ["ELASTICSEARCH_HOST"]}:9200/_cluster/health""").json()
-                if es_json["status"] != "red":
-                    logger.info(f"Elasticsearch is up with status {es_json['status']}!")
-                    break
-            except requests.exceptions.ConnectionError:
-                pass
-
-            if first_time_check:
-                logger.warn("Elasticsearch is not avaliable, will wait for it to launch ...")
+        # Records are queued until elasticsearch is up, so there's no need to wait for it here
+        if "ELASTICSEARCH_HOST" in os.environ:
+            if "ELASTICSEARCH_USER" in os.environ:
+                es_auth = (os.environ["ELASTICSEARCH_USER"], os.environ["ELASTICSEARCH_PASSWORD"])
             else:
-                logger.debug("Failed poll of elasticsearch")
-            first_time_check = False
-
-            time.sleep(1)
-
-
-        print("Adding logger ...", file=sys.stderr)
-        es_handler = CMRESHandler(
-            hosts=[{
-                'host': os.environ["ELASTICSEARCH_HOST"],
-                'port': 9200
-            }],
-            auth_type=CMRESHandler.AuthType.BASIC_AUTH,
-            es_index_name="whr_config_server"
-        )
-        logger.addHandler(es_handler)
-        logger.warn("Test log")
-        print("Added logger", file=sys.stderr)
+                es_auth = None
 
+            es_handler = BulkElasticsearchHandler(
+                f"http://{os.environ['ELASTICSEARCH_HOST']}:9200",
+                "whr_config_server",
+                auth=es_auth
+            )
+            logger.addHandler(es_handler)
+        else:
+            es_handler = None
 
         self.logger = logger
+        self.es_handler = es_handler
         self.info = logger.info
         self.warning = logger.warning
         self.error = logger.error
 
+    def after_fork(self):
+        """
+        Restarts sending logs to elasticsearch in a forked child process
+        """
+        if self.es_handler is not None:
+            self.es_handler.after_fork()
+
     def log_http_request(self, response: flask.Response):
         request = flask.request
         if response.status_code < 400:
@@ -0,0 +1,38 @@
+"""Prometheus metrics for the config server, exposed at /metrics"""
+
+import os
+
+import flask
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest)
+from prometheus_client import multiprocess
+
+METRICS_PATH = "/metrics"
+
+# Token resolution is expected to take a few milliseconds, so the buckets start small
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+OPERATION_LATENCY = Histogram("config_server_operation_duration_seconds",
+    "Time taken handling API operations", ["operation"], buckets=LATENCY_BUCKETS)
+OPERATION_ERRORS = Counter("config_server_operation_errors_total",
+    "API operations that raised an error", ["operation", "error"])
+
+DB_QUERY_LATENCY = Histogram("config_server_db_query_duration_seconds",
+    "Time taken by database queries made by the data mappers", ["query"], buckets=LATENCY_BUCKETS)
+ES_QUERY_LATENCY = Histogram("config_server_elasticsearch_query_duration_seconds",
+    "Time taken by elasticsearch queries", ["query"], buckets=LATENCY_BUCKETS)
+ES_LOG_DROPPED_RECORDS = Counter("config_server_elasticsearch_log_records_dropped_total",
+    "Log records dropped because the queue of records to send to elasticsearch was full")
+
+def metrics_response():
+    """
+    Flask view with the metrics in the Prometheus text format.
+    When running several worker processes, prometheus_multiproc_dir needs to be set so every worker is counted.
+    """
+    if "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return flask.Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
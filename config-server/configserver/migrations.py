@@ -0,0 +1,114 @@
+"""Lightweight schema migrations, which bring existing databases up to date with the models"""
+
+import logging
+
+from peewee import SQL, BigIntegerField, Database, IntegrityError, Model, Param, fn
+from playhouse.migrate import SchemaMigrator, migrate
+
+from .models import ROUTE_UPSERTED, RateLimitBucket, Route, RouteChange, UserLink, change_revision
+
+logger = logging.getLogger("config_server.migrations")
+
+# Indexes added after the first release, as (model, columns, unique, deduplicate).
+# Databases created since then get these from create_tables.
+# Rows that break a unique index are deleted first if deduplicate is set (as they're copies of each other),
+# otherwise the migration fails until they're fixed.
+INDEXES = [
+    (Route, ["token_id"], True, False),
+    (UserLink, ["user", "route_id"], True, True)
+]
+
+# Columns added after the first release, as (model, column, field)
+COLUMNS = [
+    (Route, "revision", BigIntegerField(default=0))
+]
+
+def _has_column(db: Database, table: str, column: str):
+    return any(column_metadata.name == column for column_metadata in db.get_columns(table))
+
+def _has_index(db: Database, table: str, columns: list):
+    # Postgres doesn't report the columns of an index in order
+    return any(set(index.columns) == set(columns) for index in db.get_indexes(table))
+
+def _delete_duplicates(model: Model, columns: list):
+    """
+    Deletes all but the first row of each set of rows with the same values in columns
+    """
+    primary_key = model._meta.primary_key
+    first_rows = model.select(fn.MIN(primary_key)).group_by(*[model._meta.columns[column] for column in columns])
+
+    return model.delete().where(primary_key.not_in(first_rows)).execute()
+
+def _add_index(db: Database, migrator: SchemaMigrator, model: Model, columns: list, unique: bool, deduplicate: bool):
+    table = model._meta.db_table
+
+    with db.atomic():
+        if deduplicate:
+            deleted = _delete_duplicates(model, columns)
+            if deleted > 0:
+                logger.warning("Deleted duplicate rows.", extra={
+                    "table": table,
+                    "columns": columns,
+                    "rows": deleted
+                })
+
+        try:
+            migrate(migrator.add_index(table, columns, unique))
+        except IntegrityError:
+            logger.error("Existing rows aren't unique, so the index can't be added until they're fixed.", extra={
+                "table": table,
+                "columns": columns
+            })
+            raise
+
+def _add_route_changes(db: Database):
+    """
+    Adds a change for every route, for databases that had routes before the change feed, so consumers
+    reading the feed from the start get every route
+    """
+    with db.atomic():
+        revision = change_revision()
+
+        RouteChange.insert_from(
+            [RouteChange.route_uuid, RouteChange.change, RouteChange.revision],
+            Route.select(Route.uuid, Param(ROUTE_UPSERTED), SQL(str(int(revision))))).execute()
+        count = Route.update(revision=revision).execute()
+
+    logger.info("Added a change for every existing route.", extra={
+        "routes": count
+    })
+
+def migrate_schema(db: Database):
+    """
+    Creates any missing tables, then adds any columns and indexes that are missing from existing tables.
+    Safe to run every time the server starts.
+    """
+    has_route_changes = RouteChange._meta.db_table in db.get_tables()
+
+    db.create_tables([Route, UserLink, RouteChange, RateLimitBucket], safe=True)
+
+    migrator = SchemaMigrator.from_database(db)
+
+    for (model, column, field) in COLUMNS:
+        table = model._meta.db_table
+
+        if not _has_column(db, table, column):
+            logger.info("Adding column.", extra={
+                "table": table,
+                "column": column
+            })
+            with db.atomic():
+                migrate(migrator.add_column(table, column, field))
+
+    for (model, columns, unique, deduplicate) in INDEXES:
+        table = model._meta.db_table
+
+        if not _has_index(db, table, columns):
+            logger.info("Adding index.", extra={
+                "table": table,
+                "columns": columns
+            })
+            _add_index(db, migrator, model, columns, unique, deduplicate)
+
+    if not has_route_changes:
+        _add_route_changes(db)
@@ -1,9 +1,66 @@
-from peewee import (BooleanField, CharField, Database, DoesNotExist,
-                    ForeignKeyField, IntegerField, Model, Proxy,
-                    SqliteDatabase)
+import itertools
+import threading
+from typing import Iterable, List
+
+from cachetools import TTLCache
+from peewee import (BigIntegerField, BooleanField, CharField, Database, DoesNotExist, DoubleField,
+                    ForeignKeyField, IntegerField, Model, PostgresqlDatabase, Proxy, SelectQuery,
+                    SQL, SqliteDatabase, fn)
+
+DEFAULT_REPLICA_LAG_ALLOWANCE = 5
+MAX_RECENT_WRITES = 10000
 
 proxy_db = Proxy()
 
+class ReplicaRouter:
+    """
+    Sends read queries to read replicas (round robin), while writes stay on the primary (proxy_db).
+
+    So that reads see earlier writes, a read goes to the primary if the current request has written,
+    or if any of the keys it depends on (such as ("route", uuid)) were written to within the replica
+    lag allowance.
+    """
+    def __init__(self) -> None:
+        self.replicas = [] # type: List[Database]
+        self._next_replica = itertools.count()
+        self._recent_writes = TTLCache(maxsize=MAX_RECENT_WRITES, ttl=DEFAULT_REPLICA_LAG_ALLOWANCE)
+        self._lock = threading.Lock()
+        self._request_state = threading.local()
+
+    def initialize(self, replicas: List[Database], lag_allowance: float = DEFAULT_REPLICA_LAG_ALLOWANCE):
+        self.replicas = list(replicas)
+        self._recent_writes = TTLCache(maxsize=MAX_RECENT_WRITES, ttl=lag_allowance)
+
+    def start_request(self):
+        self._request_state.has_written = False
+
+    def mark_written(self, *keys):
+        """
+        Records that the current request has written to the primary, changing data identified by keys
+        """
+        self._request_state.has_written = True
+
+        with self._lock:
+            for key in keys:
+                self._recent_writes[key] = True
+
+    def read(self, query: SelectQuery, keys: Iterable = ()) -> SelectQuery:
+        """
+        Makes query run on a replica, if it doesn't need to read from the primary
+        """
+        if len(self.replicas) == 0 or getattr(self._request_state, "has_written", False):
+            return query
+
+        with self._lock:
+            if any(key in self._recent_writes for key in keys):
+                return query
+
+        query.database = self.replicas[next(self._next_replica) % len(self.replicas)]
+
+        return query
+
+replica_router = ReplicaRouter()
+
 class Route(Model):
     uuid = CharField(unique=True)
     name = CharField()
@@ -12,7 +69,9 @@ class Route(Model):
     rate_limit = IntegerField()
     token = CharField()
     # tokenId: A starting bit of the token, which is used for querying the token in the database
-    token_id = CharField()
+    token_id = CharField(unique=True)
+    # revision: The revision of the route's last change in the change feed (see RouteChange)
+    revision = BigIntegerField(default=0)
 
     class Meta:
         database = proxy_db
@@ -29,9 +88,95 @@ def extract_route_dict(route: Route):
 
     return new_ob
 
+ROUTE_UPSERTED = "upsert"
+ROUTE_DELETED = "delete"
+
+class RouteChange(Model):
+    """
+    Entry in the change feed of routes, recorded in the same transaction as the change.
+
+    The revision of a change is the id of the transaction that made it (see change_revision), so
+    revisions follow the order transactions first wrote in, rather than the order they commit in.
+    Consumers ask for the changes after a revision, and are only given changes of transactions
+    that have finished (see finished_changes), so a change can't be committed behind a revision
+    that a consumer has already read past.
+    """
+    revision = BigIntegerField(index=True)
+    # Not a foreign key, as deleted routes keep their changes
+    route_uuid = CharField(index=True)
+    change = CharField()
+
+    class Meta:
+        database = proxy_db
+
+def change_revision() -> int:
+    """
+    Returns the revision of changes made by the current transaction: the transaction's id on Postgres,
+    or one after the latest revision on other databases, which only run one write transaction at a time
+    """
+    if isinstance(proxy_db.obj, PostgresqlDatabase):
+        return proxy_db.execute_sql("SELECT txid_current()").fetchone()[0]
+    else:
+        return (RouteChange.select(fn.MAX(RouteChange.revision)).scalar() or 0) + 1
+
+def change_finished():
+    """
+    Returns a condition on RouteChange that's true for changes made by transactions that have finished.
+    On Postgres, every transaction with an id below the xmin of the current snapshot has finished,
+    and transactions that start later get higher ids.
+
+    NOTE: xmin is the oldest transaction still running anywhere in the Postgres cluster, so one long
+    running transaction (even on another database) holds back every change made after it started,
+    for as long as it runs. Setting idle_in_transaction_session_timeout (and statement_timeout) bounds
+    how long that can be. The token cache doesn't wait for changes to finish (see RouteDataMapper._sync_token_cache).
+    """
+    if isinstance(proxy_db.obj, PostgresqlDatabase):
+        return RouteChange.revision < fn.txid_snapshot_xmin(fn.txid_current_snapshot())
+    else:
+        return SQL("1 = 1")
+
+def finished_changes(query: SelectQuery) -> SelectQuery:
+    """
+    Restricts a query of RouteChange to changes made by transactions that have finished (see change_finished)
+    """
+    return query.where(change_finished())
+
 class UserLink(Model):
     user = CharField()
     route = ForeignKeyField(Route, to_field="uuid", on_delete="CASCADE")
 
     class Meta:
         database = proxy_db
+        indexes = (
+            # used for looking up a user's links, and whether a user has a link to a route
+            (("user", "route"), True),
+        )
+
+class RateLimitBucket(Model):
+    """
+    Token bucket of a route, used by DatabaseRateLimitStore so every config server shares rate limits
+    """
+    route_uuid = CharField(primary_key=True)
+    # FloatField is a 4 byte REAL on Postgres, which can't hold a timestamp to the second
+    tokens = DoubleField()
+    # When tokens was last refilled, in seconds since the epoch
+    updated = DoubleField()
+
+    class Meta:
+        database = proxy_db
+
+def insert_or_ignore(model_class, rows: List[dict]):
+    """
+    Inserts the rows in one statement, skipping rows that conflict with an existing row
+    """
+    if isinstance(proxy_db.obj, PostgresqlDatabase):
+        # peewee only generates SQLite's INSERT OR IGNORE
+        columns = ", ".join(f'"{model_class._meta.fields[field_name].db_column}"' for field_name in rows[0])
+        row_placeholders = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+
+        proxy_db.execute_sql(
+            f'INSERT INTO "{model_class._meta.db_table}" ({columns}) '
+            f'VALUES {", ".join([row_placeholders] * len(rows))} ON CONFLICT DO NOTHING',
+            [row[field_name] for row in rows for field_name in rows[0]])
+    else:
+        model_class.insert_many(rows).on_conflict("IGNORE").execute()
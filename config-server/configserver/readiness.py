@@ -0,0 +1,151 @@
+"""Checking that the services the config server depends on are up, in the background"""
+
+import logging
+import threading
+import time
+from typing import Callable, Dict
+
+logger = logging.getLogger("config_server.readiness")
+
+INITIAL_RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30
+# How often a service that is up is checked again
+RECHECK_INTERVAL = 30
+
+class _Check:
+    def __init__(self, name: str, check: Callable[[], None], on_ready: Callable[[], None], required: bool) -> None:
+        self.name = name
+        self.check = check
+        self.on_ready = on_ready
+        self.required = required
+
+        self.ready = False
+        self.has_been_ready = False
+        self.error = None # type: str
+
+class ReadinessMonitor:
+    """
+    Runs each check on its own background thread until it passes, retrying with exponential
+    backoff, so that the server can start before its dependencies are up.
+
+    A check is a function that raises if its service isn't usable. When a check first passes,
+    its on_ready function (if any) is run, and the check only becomes ready once on_ready succeeds.
+    Checks that have passed are run again every recheck_interval seconds.
+    """
+    def __init__(self, initial_retry_delay: float = INITIAL_RETRY_DELAY,
+                 max_retry_delay: float = MAX_RETRY_DELAY,
+                 recheck_interval: float = RECHECK_INTERVAL) -> None:
+        self._initial_retry_delay = initial_retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._recheck_interval = recheck_interval
+
+        self._checks = {} # type: Dict[str, _Check]
+        self._threads = []
+        self._condition = threading.Condition()
+        self._stopped = False
+
+    def add_check(self, name: str, check: Callable[[], None], on_ready: Callable[[], None] = None, required: bool = True):
+        """
+        Adds a check. Checks that aren't required don't stop the server being ready
+        """
+        self._checks[name] = _Check(name, check, on_ready, required)
+
+    def start(self):
+        for check in self._checks.values():
+            thread = threading.Thread(target=self._run_check, args=(check,), name=f"readiness-{check.name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+
+    def _run_once(self, check: _Check):
+        check.check()
+
+        if not check.has_been_ready and check.on_ready is not None:
+            check.on_ready()
+
+    def _run_check(self, check: _Check):
+        delay = self._initial_retry_delay
+
+        while True:
+            try:
+                self._run_once(check)
+            except Exception as e:
+                if check.ready or check.error is None:
+                    logger.warning("Service is unavailable.", extra={
+                        "service": check.name,
+                        "error": repr(e)
+                    })
+
+                with self._condition:
+                    check.ready = False
+                    check.error = repr(e)
+
+                wait = delay
+                delay = min(delay * 2, self._max_retry_delay)
+            else:
+                if not check.ready:
+                    logger.info("Service is available.", extra={
+                        "service": check.name
+                    })
+
+                with self._condition:
+                    check.ready = True
+                    check.has_been_ready = True
+                    check.error = None
+                    self._condition.notify_all()
+
+                wait = self._recheck_interval
+                delay = self._initial_retry_delay
+
+            with self._condition:
+                if not self._stopped:
+                    self._condition.wait(wait)
+
+                if self._stopped:
+                    return
+
+    def is_ready(self, name: str = None) -> bool:
+        """
+        Returns whether the named check is passing, or without a name, whether every required check is
+        """
+        with self._condition:
+            if name is not None:
+                return self._checks[name].ready
+
+            return all(check.ready for check in self._checks.values() if check.required)
+
+    def wait_until_ready(self, timeout: float = None) -> bool:
+        """
+        Waits for every required check to pass, returning whether they did within the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._condition:
+            while not all(check.ready for check in self._checks.values() if check.required):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+
+                self._condition.wait(remaining)
+
+        return True
+
+    def status(self) -> dict:
+        with self._condition:
+            return {
+                "ready": all(check.ready for check in self._checks.values() if check.required),
+                "services": {
+                    check.name: {
+                        "ready": check.ready,
+                        "required": check.required
+                    }
+                    for check in self._checks.values()
+                }
+            }
@@ -0,0 +1,196 @@
+"""Serving the WSGI app on tornado, with requests handled on a thread pool"""
+
+import concurrent.futures
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado
+import tornado.concurrent
+import tornado.httpserver
+import tornado.ioloop
+import tornado.iostream
+import tornado.wsgi
+from tornado import escape, httputil
+
+logger = logging.getLogger("config_server.serving")
+
+DEFAULT_MAX_PENDING_PER_WORKER = 8
+
+class ExecutorWSGIContainer(tornado.wsgi.WSGIContainer):
+    """
+    WSGIContainer that runs the WSGI app on a bounded thread pool instead of on the IOLoop, so one
+    request blocking on the database, an OAuth provider or elasticsearch doesn't hold up the others.
+
+    At most max_pending requests are queued or running at once, after which requests are
+    answered with 503 Service Unavailable straight from the IOLoop.
+
+    Responses without a Content-Length (such as Flask streaming responses) are sent chunk by chunk
+    as they're produced, rather than read into memory first.
+    """
+    def __init__(self, wsgi_application, max_workers: int, max_pending: int = None) -> None:
+        super().__init__(wsgi_application)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._max_pending = max_pending if max_pending is not None else max_workers * DEFAULT_MAX_PENDING_PER_WORKER
+        self._pending = 0
+
+    def _run_application(self, request, io_loop):
+        """
+        Runs the WSGI app for the request (on a worker thread), returning (status, headers, body),
+        or None if the response has no Content-Length and so has been streamed to the connection already
+        """
+        data = {}
+        response = []
+
+        def start_response(status, response_headers, exc_info=None):
+            data["status"] = status
+            data["headers"] = response_headers
+            return response.append
+
+        app_response = self.wsgi_application(tornado.wsgi.WSGIContainer.environ(request), start_response)
+        try:
+            chunks = iter(app_response)
+            # Generator apps (such as Flask streaming responses) only call start_response once their
+            # first chunk is asked for, so it's taken (to be sent first) before looking at the headers
+            if not data:
+                response.extend(itertools.islice(chunks, 1))
+
+            if data and request.method != "HEAD" and ExecutorWSGIContainer._is_streamed(data["headers"]):
+                self._stream_response(request, io_loop, data["status"], data["headers"], response, chunks)
+                return None
+
+            response.extend(chunks)
+            body = b"".join(response)
+        finally:
+            if hasattr(app_response, "close"):
+                app_response.close()
+
+        if not data:
+            raise Exception("WSGI app did not call start_response")
+
+        return data["status"], data["headers"], body
+
+    @staticmethod
+    def _is_streamed(headers: list) -> bool:
+        return all(key.lower() != "content-length" for (key, value) in headers)
+
+    @staticmethod
+    def _call_on_io_loop(io_loop, function):
+        """
+        Calls function on the IOLoop from a worker thread, and waits for the future it returns (if any)
+        """
+        done = concurrent.futures.Future()
+
+        def callback():
+            try:
+                future = function()
+            except Exception as e:
+                done.set_exception(e)
+                return
+
+            if future is None:
+                done.set_result(None)
+            else:
+                tornado.concurrent.chain_future(future, done)
+
+        io_loop.add_callback(callback)
+        return done.result()
+
+    def _stream_response(self, request, io_loop, status: str, headers: list, written: list, app_response):
+        """
+        Writes each chunk of the body to the connection as the WSGI app produces it, waiting for each
+        write to be flushed, so a large response is never held in memory
+        """
+        start_line, header_obj = ExecutorWSGIContainer._make_headers(status, list(headers), None)
+
+        failed = False
+        try:
+            ExecutorWSGIContainer._call_on_io_loop(io_loop,
+                lambda: request.connection.write_headers(start_line, header_obj))
+
+            for chunk in itertools.chain(written, app_response):
+                if len(chunk) != 0:
+                    ExecutorWSGIContainer._call_on_io_loop(io_loop, lambda: request.connection.write(chunk))
+        except tornado.iostream.StreamClosedError:
+            pass
+        except Exception:
+            logger.exception("Error streaming the response of the WSGI app.")
+            failed = True
+
+        def end_response():
+            # The status has already been sent, so the client can only be told of an error by the
+            # response ending without its last chunk
+            if failed:
+                request.connection.close()
+
+            request.connection.finish()
+            self._log(start_line.code, request)
+
+        io_loop.add_callback(end_response)
+
+    @staticmethod
+    def _make_headers(status: str, headers: list, body: bytes):
+        """
+        Returns the start line and headers of a response, adding the headers WSGIContainer adds.
+        body is None when the response is streamed.
+        """
+        status_code, reason = status.split(" ", 1)
+        status_code = int(status_code)
+        header_set = set(key.lower() for (key, value) in headers)
+
+        if status_code != 304:
+            if "content-length" not in header_set and body is not None:
+                headers.append(("Content-Length", str(len(body))))
+            if "content-type" not in header_set:
+                headers.append(("Content-Type", "text/html; charset=UTF-8"))
+        if "server" not in header_set:
+            headers.append(("Server", f"TornadoServer/{tornado.version}"))
+
+        start_line = httputil.ResponseStartLine("HTTP/1.1", status_code, reason)
+        header_obj = httputil.HTTPHeaders()
+        for (key, value) in headers:
+            header_obj.add(key, value)
+
+        return start_line, header_obj
+
+    def _write_response(self, request, status: str, headers: list, body: bytes):
+        """
+        Writes the response to the connection (on the IOLoop), as WSGIContainer does
+        """
+        body = escape.utf8(body)
+        start_line, header_obj = ExecutorWSGIContainer._make_headers(status, headers, body)
+
+        request.connection.write_headers(start_line, header_obj, chunk=body)
+        request.connection.finish()
+        self._log(start_line.code, request)
+
+    def _on_application_done(self, request, future):
+        self._pending -= 1
+
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception("Error running the WSGI app.")
+            result = ("500 Internal Server Error", [], b"")
+
+        if result is not None:
+            self._write_response(request, *result)
+
+    def __call__(self, request):
+        if self._pending >= self._max_pending:
+            self._write_response(request, "503 Service Unavailable", [], b"")
+            return
+
+        self._pending += 1
+        future = self._executor.submit(self._run_application, request, tornado.ioloop.IOLoop.current())
+        tornado.ioloop.IOLoop.current().add_future(future, lambda future: self._on_application_done(request, future))
+
+def run_executor_server(wsgi_application, host: str, port: int, max_workers: int, max_pending: int = None):
+    """
+    Serves the WSGI app until the process is stopped, running requests on max_workers threads
+    """
+    container = ExecutorWSGIContainer(wsgi_application, max_workers, max_pending)
+    http_server = tornado.httpserver.HTTPServer(container)
+    http_server.listen(port, address=host)
+
+    tornado.ioloop.IOLoop.current().start()
@@ -1,2 +1,2 @@
 # Run the config server
-python -m configserver --host 0.0.0.0 --port 80 --verbose ${DEBUG_CREDENTIALS:+--debug}
\ No newline at end of file
+python -m configserver --host 0.0.0.0 --port 80 --verbose ${DEBUG_CREDENTIALS:+--debug} ${ASYNC_WORKERS:+--async-workers $ASYNC_WORKERS} ${WORKERS:+--workers $WORKERS} ${MAX_REQUESTS:+--max-requests $MAX_REQUESTS}
\ No newline at end of file
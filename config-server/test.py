@@ -1,32 +1,109 @@
 import json
 
 from configserver import ConfigServer, get_postgres_db
-from configserver.errors import InvalidRouteUUIDError
+from configserver.errors import InvalidRouteTokenError, InvalidRouteUUIDError
+from configserver.LogStore import MemoryLogStore
+from configserver.logging import BulkElasticsearchHandler
+from configserver.migrations import migrate_schema
+from configserver.models import ReplicaRouter, Route, RouteChange, UserLink, proxy_db
+from configserver.RateLimiter import DatabaseRateLimitStore, MemoryRateLimitStore
+from configserver.readiness import ReadinessMonitor
+from configserver.RouteDataMapper import RouteDataMapper
+from configserver.serving import ExecutorWSGIContainer
+from configserver.StatisticQueryier import StatisticQueryier
+from configserver.StatisticRollupCache import StatisticRollupCache
+from configserver.TokenCache import TokenCache
+from configserver.UserLinkDataMapper import UserLinkDataMapper
 from flask.testing import FlaskClient
 import pytest
-from peewee import SqliteDatabase
+from peewee import PostgresqlDatabase, SqliteDatabase
+from prometheus_client import REGISTRY
 import logging
 from uuid import uuid4
+import contextlib
 import functools
+import hashlib
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterable
 
+import tornado.ioloop
+import tornado.testing
+from tornado.httpserver import HTTPServer
+
 @pytest.fixture(autouse=True)
 def no_logs():
     logging.getLogger().setLevel(logging.WARNING)
 
+ADMIN_USER = "test_admin@example.ac.uk"
+admin_auth = {
+    "headers": {
+        "user": ADMIN_USER
+    }
+}
+
 @pytest.fixture()
 def webhook_server():
     with open("config.json") as config_file:
         config_JSON = json.load(config_file)
 
+    config_JSON["adminUsers"] = [ADMIN_USER]
+
     server = ConfigServer(
         use_test_auth=True,
         db=get_postgres_db(),
         config_JSON=config_JSON
     )
+    assert server.readiness.wait_until_ready(timeout=60)
+    yield server
+    server.close()
+
+@pytest.fixture()
+def pooled_webhook_server():
+    with open("config.json") as config_file:
+        config_JSON = json.load(config_file)
+
+    config_JSON["database"] = {
+        "pool": True,
+        "maxConnections": 2
+    }
+
+    server = ConfigServer(
+        use_test_auth=True,
+        db=get_postgres_db(config_JSON),
+        config_JSON=config_JSON
+    )
+    assert server.readiness.wait_until_ready(timeout=60)
     yield server
     server.close()
 
+@pytest.fixture()
+def scratch_db():
+    """
+    An empty database of the test's own (which the models use while the test runs), for tests that change
+    the schema, so they don't change the shared test database
+    """
+    db = get_postgres_db()
+    name = f"test_{uuid4().hex}"
+
+    # CREATE DATABASE can't be run in a transaction
+    db.get_conn().autocommit = True
+    db.execute_sql(f'CREATE DATABASE "{name}"')
+
+    scratch_db = PostgresqlDatabase(name, **db.connect_kwargs)
+    previous_db = proxy_db.obj
+    proxy_db.initialize(scratch_db)
+    try:
+        yield scratch_db
+    finally:
+        proxy_db.initialize(previous_db)
+        scratch_db.close()
+
+        db.execute_sql(f'DROP DATABASE "{name}"')
+        db.close()
+
 @pytest.fixture()
 def user_auth():
     return {
@@ -84,6 +161,240 @@ def test_get_by_token(router_app: FlaskClient, test_route_uuid: str):
 
     assert router_app.get(f"/routes/token/{token}").status_code == 200
 
+def test_get_by_token_after_regenerate(router_app: FlaskClient, test_route_uuid: str):
+    prev_token = json.loads(router_app.get(f"/routes/{test_route_uuid}").data)["token"]
+
+    # populate the token cache
+    assert router_app.get(f"/routes/token/{prev_token}").status_code == 200
+
+    new_token = json.loads(router_app.post(f"/routes/{test_route_uuid}/regenerate").data)["token"]
+
+    assert router_app.get(f"/routes/token/{prev_token}").status_code == 404
+    assert router_app.get(f"/routes/token/{new_token}").status_code == 200
+
+def test_get_by_token_after_delete(router_app: FlaskClient, test_route_uuid: str):
+    token = json.loads(router_app.get(f"/routes/{test_route_uuid}").data)["token"]
+
+    assert router_app.get(f"/routes/token/{token}").status_code == 200
+
+    router_app.delete(f"/routes/{test_route_uuid}")
+
+    assert router_app.get(f"/routes/token/{token}").status_code == 404
+
+def test_get_by_token_after_patch(router_app: FlaskClient, test_route_uuid: str):
+    token = json.loads(router_app.get(f"/routes/{test_route_uuid}").data)["token"]
+
+    assert router_app.get(f"/routes/token/{token}").status_code == 200
+
+    router_app.patch(
+        f"/routes/{test_route_uuid}",
+        data=json.dumps({
+            "name": "new-name"
+        }),
+        content_type='application/json',
+    )
+
+    assert json.loads(router_app.get(f"/routes/token/{token}").data)["name"] == "new-name"
+
+def test_get_by_token_after_regenerate_by_other_process(webhook_server: ConfigServer, router_app: FlaskClient,
+                                                         test_route_uuid: str):
+    prev_token = json.loads(router_app.get(f"/routes/{test_route_uuid}").data)["token"]
+
+    # Another process, with its own token cache
+    other_route_dm = RouteDataMapper(UserLinkDataMapper(), TokenCache(sync_interval=0))
+
+    webhook_server._db.connect()
+    try:
+        assert other_route_dm.get_by_token(prev_token)["uuid"] == test_route_uuid
+
+        router_app.post(f"/routes/{test_route_uuid}/regenerate")
+
+        with pytest.raises(InvalidRouteTokenError):
+            other_route_dm.get_by_token(prev_token)
+    finally:
+        webhook_server._db.close()
+
+def test_get_by_token_during_long_transaction(webhook_server: ConfigServer, router_app: FlaskClient,
+                                              test_route_uuid: str):
+    prev_token = json.loads(router_app.get(f"/routes/{test_route_uuid}").data)["token"]
+    other_route_dm = RouteDataMapper(UserLinkDataMapper(), TokenCache(sync_interval=0))
+    long_transaction_db = get_postgres_db()
+
+    webhook_server._db.connect()
+    try:
+        assert other_route_dm.get_by_token(prev_token)["uuid"] == test_route_uuid
+        revision = other_route_dm.get_revision()
+
+        # A transaction that started before the regeneration, and is still running
+        with long_transaction_db.atomic():
+            long_transaction_db.execute_sql("SELECT txid_current()")
+
+            router_app.post(f"/routes/{test_route_uuid}/regenerate")
+
+            # The change feed is held back until the transaction finishes, but the token cache isn't
+            assert other_route_dm.get_changes(revision) == []
+            with pytest.raises(InvalidRouteTokenError):
+                other_route_dm.get_by_token(prev_token)
+
+        assert [change[2]["uuid"] for change in other_route_dm.get_changes(revision)] == [test_route_uuid]
+    finally:
+        long_transaction_db.close()
+        webhook_server._db.close()
+
+def test_resolve_tokens(router_app: FlaskClient, test_route_uuid: str):
+    token = json.loads(router_app.get(f"/routes/{test_route_uuid}").data)["token"]
+
+    resp = router_app.post(
+        "/routes/tokens:resolve",
+        data=json.dumps([token, "invalid-token", token]),
+        content_type='application/json'
+    )
+
+    assert resp.status_code == 200
+
+    results = json.loads(resp.data)
+    assert [result["token"] for result in results] == [token, "invalid-token", token]
+    assert results[0]["route"]["uuid"] == test_route_uuid
+    assert results[1]["error_num"] == 2
+    assert results[2]["route"]["uuid"] == test_route_uuid
+
+def test_token_cache_info(router_app: FlaskClient, test_route_uuid: str):
+    token = json.loads(router_app.get(f"/routes/{test_route_uuid}").data)["token"]
+
+    router_app.get(f"/routes/token/{token}")
+    router_app.get(f"/routes/token/{token}")
+
+    resp = router_app.get("/token-cache/statistics")
+
+    assert resp.status_code == 200
+    info = json.loads(resp.data)
+    assert info["hits"] >= 1 and info["misses"] >= 1
+
+def test_health(router_app: FlaskClient):
+    resp = router_app.get("/health")
+
+    assert resp.status_code == 200
+    health = json.loads(resp.data)
+    assert health["ready"]
+    assert health["services"]["database"]["ready"]
+
+def test_metrics(router_app: FlaskClient, test_route_uuid: str):
+    token = json.loads(router_app.get(f"/routes/{test_route_uuid}").data)["token"]
+    router_app.get(f"/routes/token/{token}")
+
+    resp = router_app.get("/metrics")
+
+    assert resp.status_code == 200
+    metrics = resp.data.decode()
+    assert 'config_server_operation_duration_seconds_count{operation="get_by_token"}' in metrics
+    assert 'config_server_db_query_duration_seconds_count{query="get_route"}' in metrics
+
+def test_readiness_monitor_retries():
+    attempts = []
+    ready_calls = []
+
+    def flaky_check():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise ConnectionError()
+
+    monitor = ReadinessMonitor(initial_retry_delay=0.05)
+    monitor.add_check("flaky", flaky_check, on_ready=lambda: ready_calls.append(True))
+    monitor.add_check("down", lambda: 1 / 0, required=False)
+
+    assert not monitor.is_ready()
+    monitor.start()
+
+    try:
+        assert monitor.wait_until_ready(timeout=5)
+        assert len(attempts) == 3
+        assert ready_calls == [True]
+        # The retry delay doubles
+        assert attempts[2] - attempts[1] > attempts[1] - attempts[0]
+
+        status = monitor.status()
+        assert status["ready"]
+        assert not status["services"]["down"]["ready"]
+    finally:
+        monitor.stop()
+
+def test_bulk_routes(router_app: FlaskClient):
+    create_resp = router_app.post(
+        "/routes:bulkCreate",
+        data=json.dumps([
+            {"name": "route-1", "destination": "http://127.0.0.1"},
+            {"name": "route-2", "destination": "ftp://127.0.0.1"},
+            {"name": "route-3", "destination": "https://127.0.0.1", "rate_limit": 5}
+        ]),
+        content_type='application/json'
+    )
+    assert create_resp.status_code == 200
+
+    created = json.loads(create_resp.data)
+    assert created[1]["error_num"] == 4
+    uuids = [created[0]["route"]["uuid"], created[2]["route"]["uuid"]]
+    assert created[2]["route"]["rate_limit"] == 5
+    assert router_app.get(f"/routes/token/{created[0]['route']['token']}").status_code == 200
+    assert {route["uuid"] for route in json.loads(router_app.get("/routes").data)} >= set(uuids)
+
+    update_resp = router_app.post(
+        "/routes:bulkUpdate",
+        data=json.dumps([
+            {"uuid": uuids[0], "name": "renamed"},
+            {"uuid": uuids[1], "destination": "ftp://127.0.0.1"},
+            {"uuid": "not-a-route", "name": "renamed"}
+        ]),
+        content_type='application/json'
+    )
+    assert [result.get("error_num") for result in json.loads(update_resp.data)] == [None, 4, 1]
+    assert json.loads(router_app.get(f"/routes/{uuids[0]}").data)["name"] == "renamed"
+    assert json.loads(router_app.get(f"/routes/{uuids[1]}").data)["destination"] == "https://127.0.0.1"
+
+    delete_resp = router_app.post("/routes:bulkDelete", data=json.dumps(uuids), content_type='application/json')
+    assert delete_resp.status_code == 200
+    for uuid in uuids:
+        assert router_app.get(f"/routes/{uuid}").status_code == 404
+
+@contextlib.contextmanager
+def _count_queries(db):
+    """
+    Counts the queries made through db by this thread (requests made with a test client run on it)
+    """
+    queries = []
+    execute_sql = db.execute_sql
+    thread_id = threading.get_ident()
+
+    def counting_execute_sql(sql, *args, **kwargs):
+        if threading.get_ident() == thread_id:
+            queries.append(sql)
+
+        return execute_sql(sql, *args, **kwargs)
+
+    db.execute_sql = counting_execute_sql
+    try:
+        yield queries
+    finally:
+        del db.execute_sql
+
+def test_queries_per_operation(webhook_server: ConfigServer, router_app: FlaskClient, test_route_uuid: str):
+    operations = [
+        (lambda: router_app.get(f"/routes/{test_route_uuid}"), 1),
+        (lambda: router_app.get(f"/links/{test_route_uuid}"), 1),
+        # Getting the route to return and adding the link are one statement
+        (lambda: router_app.post(f"/links/{test_route_uuid}"), 1),
+        # Getting the revision and adding to the change feed, and updating the route
+        (lambda: router_app.patch(
+            f"/routes/{test_route_uuid}",
+            data=json.dumps({"name": "renamed"}),
+            content_type='application/json'
+        ), 3)
+    ]
+
+    for (request, expected_queries) in operations:
+        with _count_queries(webhook_server._db) as queries:
+            assert request().status_code < 400
+
+        assert len(queries) == expected_queries, queries
 
 def test_patch(router_app: FlaskClient, test_route_uuid: str):
     assert router_app.patch(
@@ -158,12 +469,413 @@ def test_remove_user_link(router_app: FlaskClient, test_route_uuid: str):
 def test_get_route_stats(router_app: FlaskClient, test_route_uuid: str):
     assert router_app.get(f"/routes/{test_route_uuid}/statistics").status_code == 200
 
+def test_get_route_stats_for_period(router_app: FlaskClient, test_route_uuid: str):
+    resp = router_app.get(f"/routes/{test_route_uuid}/statistics?period=day")
+
+    assert resp.status_code == 200
+    assert json.loads(resp.data) == {"successes": 0, "failures": 0}
+
+def test_get_route_timeseries(router_app: FlaskClient, test_route_uuid: str):
+    resp = router_app.get(f"/routes/{test_route_uuid}/statistics/timeseries?interval=minute")
+
+    assert resp.status_code == 200
+    assert len(json.loads(resp.data)) == 24
+
+    # The closed buckets are now memoised
+    assert router_app.get(f"/routes/{test_route_uuid}/statistics/timeseries?interval=minute").status_code == 200
+
+def test_get_route_timeseries_invalid_since(router_app: FlaskClient, test_route_uuid: str):
+    resp = router_app.get(f"/routes/{test_route_uuid}/statistics/timeseries?since=not-a-time")
+
+    assert resp.status_code == 400
+
 def test_get_route_logs(router_app: FlaskClient, test_route_uuid: str):
     assert router_app.get(f"/routes/{test_route_uuid}/logs").status_code == 200
 
+def test_get_route_logs_page(router_app: FlaskClient, test_route_uuid: str):
+    resp = router_app.get(f"/routes/{test_route_uuid}/logs?page_size=5&outcome=all&fields=message,success")
+
+    assert resp.status_code == 200
+    assert len(json.loads(resp.data)) <= 5
+
+def test_get_route_logs_invalid_cursor(router_app: FlaskClient, test_route_uuid: str):
+    resp = router_app.get(f"/routes/{test_route_uuid}/logs?cursor=not-a-cursor")
+
+    assert resp.status_code == 400
+    assert json.loads(resp.data)["error_num"] == 7
+
 @pytest.mark.usefixtures("test_route_uuid")
 def test_all_routes_stats(router_app: FlaskClient):
     assert router_app.get(f"/routes/statistics").status_code == 200
 
+@pytest.mark.usefixtures("test_route_uuid")
+def test_all_routes_stats_for_period(router_app: FlaskClient):
+    resp = router_app.get(f"/routes/statistics?period=week")
+
+    assert resp.status_code == 200
+    assert len(json.loads(resp.data)) == 1
+
 def test_all_routes_stats_with_no_stats(router_app: FlaskClient):
-    assert router_app.get(f"/routes/statistics").status_code == 200
\ No newline at end of file
+    assert router_app.get(f"/routes/statistics").status_code == 200
+
+def _get_latest_revision(test_client) -> int:
+    revision = 0
+    while True:
+        feed = json.loads(test_client.get(f"/routes/changes?since={revision}", **admin_auth).data)
+        revision = feed["revision"]
+
+        if not feed["more"]:
+            return revision
+
+def test_route_changes(webhook_server: ConfigServer, router_app: FlaskClient, test_route_uuid: str):
+    test_client = webhook_server.app.app.test_client()
+    revision = _get_latest_revision(test_client)
+
+    assert router_app.patch(
+        f"/routes/{test_route_uuid}",
+        data=json.dumps({"name": "renamed"}),
+        content_type='application/json'
+    ).status_code == 204
+
+    feed = json.loads(test_client.get(f"/routes/changes?since={revision}", **admin_auth).data)
+    assert [change["type"] for change in feed["changes"]] == ["upsert"]
+    route = feed["changes"][0]["route"]
+    assert route["uuid"] == test_route_uuid
+    assert route["name"] == "renamed"
+    assert "token" not in route
+
+    token = json.loads(router_app.get(f"/routes/{test_route_uuid}").data)["token"]
+    assert route["token_hash"] == hashlib.sha256(token.encode()).hexdigest()
+
+    router_app.delete(f"/routes/{test_route_uuid}")
+
+    feed = json.loads(test_client.get(f"/routes/changes?since={feed['revision']}", **admin_auth).data)
+    assert feed["changes"] == [{"type": "delete", "revision": feed["revision"], "uuid": test_route_uuid}]
+
+    # Without async workers, there's no long polling
+    start = time.monotonic()
+    feed = json.loads(test_client.get(f"/routes/changes?since={feed['revision']}&timeout=1", **admin_auth).data)
+    assert feed["changes"] == []
+    assert time.monotonic() - start < 0.5
+
+def test_route_changes_long_polls_are_limited():
+    with open("config.json") as config_file:
+        config_JSON = json.load(config_file)
+
+    config_JSON["adminUsers"] = [ADMIN_USER]
+    config_JSON["maxLongPolls"] = 1
+
+    server = ConfigServer(
+        use_test_auth=True,
+        db=get_postgres_db(),
+        config_JSON=config_JSON,
+        async_workers=4
+    )
+    try:
+        assert server.readiness.wait_until_ready(timeout=60)
+        test_client = server.app.app.test_client()
+        revision = _get_latest_revision(test_client)
+
+        def long_poll():
+            start = time.monotonic()
+            feed = json.loads(test_client.get(f"/routes/changes?since={revision}&timeout=1", **admin_auth).data)
+            assert feed["changes"] == []
+            return time.monotonic() - start
+
+        # Long polling returns once the timeout is reached, if nothing changes, but only one request can wait
+        with ThreadPoolExecutor(2) as executor:
+            durations = sorted(executor.map(lambda _: long_poll(), range(2)))
+
+        assert durations[0] < 0.5
+        assert durations[1] >= 1
+    finally:
+        server.close()
+
+def test_route_changes_not_admin(router_app: FlaskClient):
+    assert router_app.get("/routes/changes").status_code == 403
+
+def test_routes_snapshot(webhook_server: ConfigServer, router_app: FlaskClient, test_route_uuid: str):
+    test_client = webhook_server.app.app.test_client()
+    snapshot_resp = test_client.get("/routes/snapshot", **admin_auth)
+
+    assert snapshot_resp.status_code == 200
+    assert int(snapshot_resp.headers["X-Revision"]) == _get_latest_revision(test_client)
+
+    routes = {
+        route["uuid"]: route
+        for route in map(json.loads, snapshot_resp.data.decode().splitlines())
+    }
+    assert routes[test_route_uuid]["name"] == "route"
+    assert "token" not in routes[test_route_uuid]
+
+    assert router_app.get("/routes/snapshot").status_code == 403
+
+def test_rate_limit_permits(router_app: FlaskClient, test_route_uuid: str):
+    token = json.loads(router_app.get(f"/routes/{test_route_uuid}").data)["token"]
+
+    def acquire(permits):
+        return json.loads(router_app.post(
+            "/routes/rate-limits:acquire",
+            data=json.dumps([{"token": token, "permits": permits}, {"token": "not-a-token"}]),
+            content_type='application/json'
+        ).data)
+
+    # The route's bucket starts with rate_limit (30) permits, and refills at 30 a second
+    first_results = acquire(20)
+    assert first_results[0] == {"token": token, "granted": 20, "rate_limit": 30}
+    assert first_results[1]["error_num"] == 2
+    assert 10 <= acquire(20)[0]["granted"] < 20
+
+@pytest.mark.parametrize("store_class", [MemoryRateLimitStore, DatabaseRateLimitStore])
+def test_rate_limit_store(webhook_server: ConfigServer, store_class):
+    store = store_class()
+    key = str(uuid4())
+
+    webhook_server._db.connect()
+    try:
+        # (key, permits, rate, capacity), so the bucket holds 4 permits and refills 2 a second
+        assert store.acquire([(key, 3, 2, 4), (key, 3, 2, 4)], now=100) == [3, 1]
+        assert store.acquire([(key, 3, 2, 4)], now=100.5) == [1]
+        assert store.acquire([(key, 10, 2, 4)], now=110) == [4]
+        # Time before the last refill (such as from a server with a slow clock) doesn't refill the bucket
+        assert store.acquire([(key, 1, 2, 4)], now=109) == [0]
+    finally:
+        webhook_server._db.close()
+
+def test_memory_log_store():
+    log_store = MemoryLogStore()
+    now = int(time.time() * 1000)
+    log_store.add_logs(
+        {"uuid": "route", "success": i % 3 != 0, "@timestamp": now - i * 60 * 1000, "message": str(i)}
+        for i in range(30)
+    )
+    log_store.add_logs([{"uuid": "other", "success": False, "@timestamp": "2017-01-01T00:00:00Z"}])
+    queryier = StatisticQueryier(log_store=log_store)
+
+    assert queryier.get_many_routes_stats(["route", "other", "no_logs"], "hour") == [
+        {"successes": 20, "failures": 10},
+        {"successes": 0, "failures": 0},
+        {"successes": 0, "failures": 0}
+    ]
+    assert queryier.get_route_stats("other") == {"successes": 0, "failures": 1}
+
+    # Newest failures first, in pages
+    logs, cursor = queryier.get_route_logs("route", page_size=4, fields=["message"])
+    assert logs == [{"message": "0"}, {"message": "3"}, {"message": "6"}, {"message": "9"}]
+    logs, cursor = queryier.get_route_logs("route", page_size=4, cursor=cursor, fields=["message"])
+    assert logs == [{"message": "12"}, {"message": "15"}, {"message": "18"}, {"message": "21"}]
+    logs, cursor = queryier.get_route_logs("route", page_size=4, cursor=cursor, fields=["message"])
+    assert logs == [{"message": "24"}, {"message": "27"}]
+    assert cursor is None
+
+    timeseries = queryier.get_route_timeseries("route", "minute")
+    # The oldest log can fall outside the last 24 minutes if a minute passes during the test
+    assert sum(bucket["successes"] + bucket["failures"] for bucket in timeseries) in (23, 24)
+
+def test_statistic_rollup_cache_late_then_early_start():
+    cache = StatisticRollupCache()
+    # A bucket every 10ms
+    all_buckets = {bucket_start: {"successes": 1, "failures": 0} for bucket_start in range(0, 100, 10)}
+    queried_from = []
+
+    def query(query_from):
+        queried_from.append(query_from)
+        return {bucket_start: bucket for (bucket_start, bucket) in all_buckets.items() if bucket_start >= query_from}
+
+    def expected(start):
+        return {bucket_start: bucket for (bucket_start, bucket) in all_buckets.items() if bucket_start >= start}
+
+    assert cache.get_buckets("key", 10, 0, 30, 100, query) == expected(0)
+    # Starting after the closed buckets of the series
+    assert cache.get_buckets("key", 10, 50, 90, 100, query) == expected(50)
+    # Then earlier again, which needs the buckets between the two
+    assert cache.get_buckets("key", 10, 20, 90, 100, query) == expected(20)
+    assert queried_from == [0, 50, 20]
+    # Which are memoised now
+    assert cache.get_buckets("key", 10, 20, 90, 100, query) == expected(20)
+    assert queried_from == [0, 50, 20, 90]
+
+def test_es_log_handler_redacts_tokens_and_bounds_queue():
+    # Nothing listens on this port, and nothing is sent until the handler is closed
+    handler = BulkElasticsearchHandler("http://127.0.0.1:1", "test", flush_interval=60, max_queue_bytes=2000)
+    try:
+        record = logging.LogRecord("test", logging.INFO, __file__, 0, "Swagger access", None, None)
+        record.url = "http://localhost/routes/token/secret-token?a=b"
+        record.params = {"requests": [{"token": "secret-token", "permits": 1}]}
+        record.response = {"uuid": "route-uuid", "token": "secret-token"}
+
+        handler.emit(record)
+        # Changes made after logging aren't shipped
+        record.response["name"] = "changed"
+
+        doc = handler._queue[-1]
+        assert "secret-token" not in doc
+        assert json.loads(doc)["response"] == {"uuid": "route-uuid", "token": "[redacted]"}
+
+        dropped = REGISTRY.get_sample_value("config_server_elasticsearch_log_records_dropped_total")
+        for _ in range(10):
+            handler.emit(record)
+
+        assert handler._queued_bytes <= 2000
+        assert REGISTRY.get_sample_value("config_server_elasticsearch_log_records_dropped_total") > dropped
+    finally:
+        handler.close()
+
+def test_pooled_database(pooled_webhook_server: ConfigServer, user_auth):
+    test_client = pooled_webhook_server.app.app.test_client()  # type: FlaskClient
+
+    # More requests than connections, so connections must be given back to the pool
+    for i in range(5):
+        assert test_client.get("/routes", **user_auth).status_code == 200
+
+    assert pooled_webhook_server._db.is_closed()
+
+def test_migrate_schema_is_idempotent(webhook_server: ConfigServer):
+    # ConfigServer has already migrated the database
+    migrate_schema(webhook_server._db)
+
+    route_indexes = webhook_server._db.get_indexes("route")
+    assert any(index.columns == ["token_id"] and index.unique for index in route_indexes)
+
+def test_migrate_schema_adds_route_changes(scratch_db):
+    # Such as a database from before the change feed
+    scratch_db.create_tables([Route, UserLink])
+    Route.insert(uuid="route-uuid", name="route", destination="http://127.0.0.1", no_ssl_verification=False,
+                 rate_limit=30, token="token", token_id="token-id").execute()
+
+    migrate_schema(scratch_db)
+
+    changes = list(RouteChange.select())
+    assert [(change.route_uuid, change.change) for change in changes] == [("route-uuid", "upsert")]
+    assert Route.get(Route.uuid == "route-uuid").revision == changes[0].revision
+
+def test_migrate_schema_deletes_duplicate_links(scratch_db):
+    # Such as a database from before links were unique (create_table doesn't add the model's indexes)
+    scratch_db.create_tables([Route, RouteChange])
+    scratch_db.create_table(UserLink)
+    Route.insert(uuid="route-uuid", name="route", destination="http://127.0.0.1", no_ssl_verification=False,
+                 rate_limit=30, token="token", token_id="token-id").execute()
+    UserLink.insert_many([{"user": "user", "route": "route-uuid"}] * 2).execute()
+
+    migrate_schema(scratch_db)
+
+    assert UserLink.select().count() == 1
+    assert any(set(index.columns) == {"user", "route_id"} and index.unique
+               for index in scratch_db.get_indexes("userlink"))
+
+def test_replica_router():
+    replica = SqliteDatabase(":memory:")
+    router = ReplicaRouter()
+    router.initialize([replica], lag_allowance=60)
+
+    router.start_request()
+    assert router.read(Route.select(), [("route", "a")]).database is replica
+
+    router.mark_written(("route", "a"))
+    # the request that wrote reads its own writes from the primary
+    assert router.read(Route.select(), [("route", "b")]).database is not replica
+
+    router.start_request()
+    # as do later requests reading what was written
+    assert router.read(Route.select(), [("route", "a")]).database is not replica
+    assert router.read(Route.select(), [("route", "b")]).database is replica
+
+def test_routes_with_replica(user_auth):
+    with open("config.json") as config_file:
+        config_JSON = json.load(config_file)
+
+    # Writes are only read from the primary for a moment, so the reads below go to the replica
+    config_JSON["database"] = {
+        "replicaLagAllowance": 0.1
+    }
+
+    # The primary doubles as the replica
+    replica_db = get_postgres_db()
+    server = ConfigServer(
+        use_test_auth=True,
+        db=get_postgres_db(),
+        config_JSON=config_JSON,
+        replica_dbs=[replica_db]
+    )
+    assert server.readiness.wait_until_ready(timeout=60)
+
+    try:
+        test_client = server.app.app.test_client()  # type: FlaskClient
+
+        route = json.loads(test_client.post(
+            "/create-route",
+            data=json.dumps({
+                "name": "route",
+                "destination": "http://127.0.0.1"
+            }),
+            content_type='application/json',
+            **user_auth
+        ).data)
+        time.sleep(0.2)
+
+        with _count_queries(replica_db) as replica_queries:
+            assert test_client.get(f"/routes/token/{route['token']}").status_code == 200
+            assert test_client.get(f"/routes/{route['uuid']}", **user_auth).status_code == 200
+            assert len(json.loads(test_client.get("/routes", **user_auth).data)) == 1
+
+        assert len(replica_queries) == 3
+
+        test_client.delete(f"/routes/{route['uuid']}", **user_auth)
+    finally:
+        server.close()
+
+def test_executor_wsgi_container():
+    def slow_app(environ, start_response):
+        time.sleep(0.5)
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"ok"]
+
+    sock, port = tornado.testing.bind_unused_port()
+    io_loop = tornado.ioloop.IOLoop()
+
+    def serve():
+        io_loop.make_current()
+        HTTPServer(ExecutorWSGIContainer(slow_app, max_workers=4)).add_sockets([sock])
+        io_loop.start()
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    def get(i):
+        # The response has no Content-Length so it's streamed. It's read to the end so its worker is done
+        # with it before the IOLoop is stopped
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/") as response:
+            return response.status, response.read()
+
+    try:
+        start = time.monotonic()
+        with ThreadPoolExecutor(4) as executor:
+            responses = list(executor.map(get, range(4)))
+
+        # The requests were handled at the same time
+        assert responses == [(200, b"ok")] * 4
+        assert time.monotonic() - start < 1.5
+    finally:
+        io_loop.add_callback(io_loop.stop)
+
+def test_executor_wsgi_container_streams():
+    def streaming_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "application/x-ndjson")])
+        for i in range(3):
+            yield f"{i}\n".encode()
+
+    sock, port = tornado.testing.bind_unused_port()
+    io_loop = tornado.ioloop.IOLoop()
+
+    def serve():
+        io_loop.make_current()
+        HTTPServer(ExecutorWSGIContainer(streaming_app, max_workers=1)).add_sockets([sock])
+        io_loop.start()
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/") as response:
+            assert response.headers["Transfer-Encoding"] == "chunked"
+            assert response.read() == b"0\n1\n2\n"
+    finally:
+        io_loop.add_callback(io_loop.stop)
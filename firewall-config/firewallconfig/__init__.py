@@ -1,2 +1,2 @@
 from .firewallconfig import FirewallConfigServer, ConfigInterface
-from .auth import test_auth
\ No newline at end of file
+from webhookcommon.auth import test_auth
\ No newline at end of file
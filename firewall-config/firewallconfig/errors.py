@@ -1,5 +1,4 @@
-class InvalidCredentialsError(Exception):
-    pass
+from webhookcommon.errors import InvalidCredentialsError, ServiceUnavailableError
 
 
 class NotAuthorisedError(Exception):
@@ -19,4 +18,8 @@ class InvalidURLError(Exception):
 
 
 class InvalidRouteTokenError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class InvalidConfigError(Exception):
+    pass
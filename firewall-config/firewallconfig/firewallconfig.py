@@ -1,18 +1,34 @@
 import argparse
+import bisect
+import hashlib
 import ipaddress
 import json
-import socket
+import logging
+import os
+import stat
 import sys
-from functools import partial
+import tempfile
+import threading
+import time
+from functools import partial, wraps
 from http import HTTPStatus
+from typing import Dict, List, Tuple
 from urllib.parse import urlparse
 
 import connexion
 import flask
 from flask_cors import CORS
+from webhookcommon.auth import (DEFAULT_IDENTITY_CACHE_EXPIRY,
+                                DEFAULT_REJECTED_TOKEN_CACHE_EXPIRY,
+                                configure_identity_cache, normal_auth)
+from webhookcommon.launcher import PreforkLauncher
 
-from .auth import normal_auth
 from .errors import *
+from .metrics import METRICS_PATH, OPERATION_ERRORS, OPERATION_LATENCY, metrics_response
+from .resolver import DEFAULT_TIMEOUT as DEFAULT_DNS_TIMEOUT
+from .resolver import CachingResolver, ResolutionError, default_port
+
+logger = logging.getLogger("firewall_config")
 
 
 class Rule:
@@ -20,59 +36,290 @@ class Rule:
         self.from_port = from_port
         self.to_port = to_port
         self.cidr = cidr
+        self.network = ipaddress.ip_network(cidr, strict=False)
 
     def does_pass_rule(self, ip_address: str, port: int):
         has_correct_port = self.from_port <= port <= self.to_port
-        has_correct_ip = ipaddress.ip_address(ip_address) in ipaddress.ip_network(self.cidr, strict=False)
+        has_correct_ip = ipaddress.ip_address(ip_address) in self.network
 
         return has_correct_port and has_correct_ip
 
+    def to_dict(self):
+        return {
+            "from_port": self.from_port,
+            "to_port": self.to_port,
+            "cidr": self.cidr
+        }
+
+class CompiledRules:
+    """
+    Index of firewall rules for fast lookups. Rules are grouped by their port range, and each group
+    has a sorted list of non overlapping address ranges for each IP version, so finding the rule
+    that allows an address is a binary search.
+    Port ranges can overlap, so ports are split into segments at the start and end of every range,
+    each with the groups that cover it, so finding the groups for a port is a binary search too.
+
+    A host is allowed if every one of its addresses is allowed by a rule, which doesn't need to be
+    the same rule for each address.
+
+    Addresses of an IP version that no rule is for aren't allowed, so a host that also has an IPv6
+    address isn't allowed by a config with only IPv4 rules (and vice versa).
+    """
+    def __init__(self, rules: List[Rule]):
+        ranges_by_port_range = {} # type: Dict[Tuple[int, int], Dict[int, list]]
+
+        for rule in rules:
+            ranges = ranges_by_port_range.setdefault((rule.from_port, rule.to_port), {4: [], 6: []})
+            ranges[rule.network.version].append(
+                (int(rule.network.network_address), int(rule.network.broadcast_address), rule))
+
+        groups = []
+        for (port_range, ranges) in sorted(ranges_by_port_range.items()):
+            groups.append((port_range, {
+                version: CompiledRules._compile_ranges(version_ranges)
+                for (version, version_ranges) in ranges.items()
+            }))
+
+        # Segment i is the ports from self._segment_starts[i] up to the start of the next segment
+        self._segment_starts = sorted(set(
+            port for ((from_port, to_port), _) in groups for port in (from_port, to_port + 1)))
+        self._segment_groups = [
+            [compiled_ranges for ((from_port, to_port), compiled_ranges) in groups if from_port <= start <= to_port]
+            for start in self._segment_starts
+        ]
+
+    @staticmethod
+    def _compile_ranges(ranges: list):
+        """
+        Returns the start of each range and the ranges, sorted and without overlaps.
+        CIDR networks are either nested or disjoint, so overlaps are removed by dropping nested networks.
+        """
+        ranges = sorted(ranges, key=lambda address_range: (address_range[0], -address_range[1]))
+
+        disjoint_ranges = []
+        for address_range in ranges:
+            if len(disjoint_ranges) == 0 or address_range[0] > disjoint_ranges[-1][1]:
+                disjoint_ranges.append(address_range)
+
+        return [address_range[0] for address_range in disjoint_ranges], disjoint_ranges
+
+    @staticmethod
+    def _find_in_ranges(compiled_ranges, address: int):
+        starts, ranges = compiled_ranges
+        i = bisect.bisect_right(starts, address) - 1
+
+        if i >= 0 and address <= ranges[i][1]:
+            return ranges[i][2]
+
+        return None
+
+    @staticmethod
+    def _find_in_groups(groups: list, ip_address):
+        for compiled_ranges in groups:
+            rule = CompiledRules._find_in_ranges(compiled_ranges[ip_address.version], int(ip_address))
+
+            if rule is not None:
+                return rule
+
+        return None
+
+    def find_rule(self, ip_addresses: list, port: int):
+        """
+        Returns a rule that allows the port for the first of the ip addresses, if every one of the addresses
+        is allowed the port by a rule (not necessarily the same rule), or None otherwise.
+        If several rules allow an address, the one with the lowest from_port (then the lowest to_port) wins,
+        then the one with the widest network, then the first in the config.
+        """
+        segment = bisect.bisect_right(self._segment_starts, port) - 1
+        if segment < 0:
+            return None
+
+        rules = [
+            CompiledRules._find_in_groups(self._segment_groups[segment], ip_address)
+            for ip_address in ip_addresses
+        ]
+
+        if len(rules) != 0 and all(rule is not None for rule in rules):
+            return rules[0]
+
+        return None
+
 class ConfigInterface:
-    def __init__(self, config_json):
+    def __init__(self, config_json, resolver: CachingResolver = None):
+        self.resolver = resolver if resolver is not None else CachingResolver()
+
         self.firewallRules = []
         for rule in config_json["firewallRules"]:
             self.firewallRules.append(Rule(**rule))
 
+        self.compiledRules = CompiledRules(self.firewallRules)
+
         self.adminUsers = config_json["adminUsers"]
 
     def is_admin(self, user: str):
         return user in self.adminUsers
 
+    def _find_rule(self, parsed_url, ip_addresses):
+        port = parsed_url.port if parsed_url.port is not None else default_port(parsed_url.scheme)
+
+        return self.compiledRules.find_rule(ip_addresses, port)
+
     def is_url_valid(self, url: str):
         parsed_url = urlparse(url)
 
-        ip_addresses = socket.gethostbyname_ex(parsed_url.hostname)[2]
-        port = parsed_url.port if parsed_url.port is not None else 80
+        if parsed_url.hostname is None:
+            return False
+
+        try:
+            ip_addresses = self.resolver.resolve(parsed_url.hostname)
+        except ResolutionError:
+            return False
+
+        return self._find_rule(parsed_url, ip_addresses) is not None
+
+    def validate_urls(self, urls: List[str]):
+        """
+        Batch version of is_url_valid. Every distinct hostname is resolved concurrently,
+        then each url is checked against the rules.
+        Returns the verdict for each url, with the rule that allowed it.
+        """
+        parsed_urls = [urlparse(url) for url in urls]
+
+        resolutions = {}
+        for parsed_url in parsed_urls:
+            if parsed_url.hostname is not None and parsed_url.hostname not in resolutions:
+                resolutions[parsed_url.hostname] = self.resolver.resolve_async(parsed_url.hostname)
+
+        results = []
+        for (url, parsed_url) in zip(urls, parsed_urls):
+            result = {
+                "url": url,
+                "valid": False
+            }
+
+            if parsed_url.hostname is None:
+                result["error"] = "No hostname in the url"
+            else:
+                try:
+                    ip_addresses = self.resolver.result(resolutions[parsed_url.hostname])
+                except ResolutionError as e:
+                    result["error"] = str(e)
+                else:
+                    rule = self._find_rule(parsed_url, ip_addresses)
 
-        for rule in self.firewallRules:
-            if all(rule.does_pass_rule(ip_address, port) for ip_address in ip_addresses):
-                return True
+                    if rule is not None:
+                        result["valid"] = True
+                        result["rule"] = rule.to_dict()
 
-        return False
+            results.append(result)
+
+        return results
+
+CONFIG_FILE_POLL_INTERVAL = 1
 
 class FileInterface:
-    def __init__(self, file_name: str):
+    """
+    Reads and writes the firewall config file.
+
+    The contents are memoised, and the file is only re-read when its inode, modification time
+    or size changes, which is checked at most once every poll_interval seconds. Writes replace
+    the file atomically, so other processes never read a partly written config.
+    """
+    def __init__(self, file_name: str, poll_interval: float = CONFIG_FILE_POLL_INTERVAL):
         self.file_name = file_name
+        self._poll_interval = poll_interval
+
+        self._contents = None
+        self._file_id = None
+        self._next_poll = 0
+        self._lock = threading.Lock()
+
+    def _get_file_id(self):
+        file_stat = os.stat(self.file_name)
+
+        return (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
 
     def get(self):
-        with open(self.file_name, "r") as file:
-            return file.read()
+        with self._lock:
+            now = time.monotonic()
+
+            if self._contents is None or now >= self._next_poll:
+                self._next_poll = now + self._poll_interval
+                file_id = self._get_file_id()
+
+                if file_id != self._file_id:
+                    with open(self.file_name, "r") as file:
+                        self._contents = file.read()
+                    self._file_id = file_id
+
+            return self._contents
 
     def set(self, value):
-        with open(self.file_name, "w") as file:
-            file.write(value)
+        directory = os.path.dirname(os.path.abspath(self.file_name))
+        temp_fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".firewall_config.")
+
+        try:
+            with os.fdopen(temp_fd, "w") as file:
+                file.write(value)
+                file.flush()
+                os.fsync(file.fileno())
+
+            if os.path.exists(self.file_name):
+                os.chmod(temp_path, stat.S_IMODE(os.stat(self.file_name).st_mode))
+
+            os.replace(temp_path, self.file_name)
+        except:
+            os.unlink(temp_path)
+            raise
+
+        with self._lock:
+            self._contents = value
+            self._file_id = self._get_file_id()
+            self._next_poll = time.monotonic() + self._poll_interval
 
 class ConnextionDespacher:
-    def __init__(self, ioInterface, auth):
+    def __init__(self, ioInterface, auth, dns_timeout: float = DEFAULT_DNS_TIMEOUT):
         self.ioInterface = ioInterface
         self.auth = auth
+        self.resolver = CachingResolver(timeout=dns_timeout)
+
+        # Increased every time the config changes, see get_current_config
+        self.generation = 0
+        self._config_source = None
+        self._config_lock = threading.Lock()
+        self.get_current_config()
+
+    def get_current_config(self) -> ConfigInterface:
+        """
+        Returns the ConfigInterface of the current config, only recompiling it if the config has changed.
+        If the changed config is invalid (such as after a bad manual edit), the last valid config is kept.
+        """
+        config_source = self.ioInterface.get()
+
+        with self._config_lock:
+            # ioInterface returns the same string until the config changes, so this is normally an identity check
+            if config_source != self._config_source:
+                try:
+                    config = ConfigInterface(json.loads(config_source), self.resolver)
+                except (ValueError, TypeError, KeyError):
+                    if self._config_source is None:
+                        raise
+
+                    logger.exception("Invalid firewall config, using the last valid config.")
+                else:
+                    self.config = config
+                    self.config_digest = hashlib.sha256(config_source.encode()).hexdigest()
+                    self.generation += 1
+
+                # Also recorded when it's invalid, so it's only parsed (and logged) once
+                self._config_source = config_source
 
-        self.config = ConfigInterface(json.loads(ioInterface.get()))
+            return self.config
 
     def auth_admin(self):
         email = self.auth()
 
-        if not self.config.is_admin(email):
+        if not self.get_current_config().is_admin(email):
             raise NotAuthorisedError()
 
     def auth_user(self):
@@ -86,26 +333,56 @@ class ConnextionDespacher:
     def set_config(self, new_config):
         self.auth_admin()
 
+        # Checked before it's saved, as an invalid config would be kept from being used
+        try:
+            ConfigInterface(new_config, self.resolver)
+        except (ValueError, TypeError, KeyError) as e:
+            raise InvalidConfigError() from e
+
         self.ioInterface.set(json.dumps(new_config))
 
-        self.config = ConfigInterface(new_config)
+        self.get_current_config()
 
         return None, 204
 
+    def get_config_generation(self):
+        self.get_current_config()
+
+        return {
+            "generation": self.generation,
+            "digest": self.config_digest
+        }
+
     def is_url_valid(self, url: str):
-        return self.config.is_url_valid(url)
+        return self.get_current_config().is_url_valid(url)
+
+    def validate_urls(self, urls):
+        return self.get_current_config().validate_urls(urls)
 
     def is_admin(self):
         email = self.auth_user()
 
-        return self.config.is_admin(email)
+        return self.get_current_config().is_admin(email)
 
 def eprint(s):
     print(s, file=sys.stderr)
 
 class FirewallConfigServer:
     def resolve_name(self, name: str):
-        return getattr(self.despatcher, name)
+        func = getattr(self.despatcher, name)
+
+        @wraps(func)
+        def timed_operation(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            except:
+                OPERATION_ERRORS.labels(name, sys.exc_info()[0].__name__).inc()
+                raise
+            finally:
+                OPERATION_LATENCY.labels(name).observe(time.monotonic() - start)
+
+        return timed_operation
 
     def _set_error_handler(self, error_class, error_num, error_message, error_code):
         """
@@ -119,17 +396,28 @@ class FirewallConfigServer:
             }), error_code)
         self.app.add_error_handler(error_class, handler)
 
-    def __init__(self, auth, firewall_config_path):
-        ioInterface = FileInterface(firewall_config_path)
-        self.despatcher = ConnextionDespacher(ioInterface, auth)
+    def __init__(self, auth, firewall_config_path: str = None, ioInterface=None,
+                 dns_timeout: float = DEFAULT_DNS_TIMEOUT):
+        """
+        The firewall config is read from and written to firewall_config_path, unless ioInterface
+        (an object with get and set methods, like FileInterface) is given.
+        Urls whose host can't be resolved within dns_timeout seconds are treated as invalid.
+        """
+        if ioInterface is None:
+            ioInterface = FileInterface(firewall_config_path)
+        self.despatcher = ConnextionDespacher(ioInterface, auth, dns_timeout)
 
         self.app = connexion.App(__name__, specification_dir=".", server='tornado')
 
         self._set_error_handler(NotAuthorisedError, 3, "Not Authorised", HTTPStatus.FORBIDDEN)
         self._set_error_handler(InvalidCredentialsError, 5, "Invalid credentials", HTTPStatus.BAD_REQUEST)
+        self._set_error_handler(InvalidConfigError, 6, "Invalid firewall config", HTTPStatus.BAD_REQUEST)
+        self._set_error_handler(ServiceUnavailableError, 7, "Service unavailable", HTTPStatus.SERVICE_UNAVAILABLE)
 
         CORS(self.app.app)
 
+        self.app.app.add_url_rule(METRICS_PATH, "metrics", metrics_response)
+
         self.app.add_api(
             '../swagger.yaml',
             validate_responses=True,
@@ -140,18 +428,42 @@ def main():
     parser = argparse.ArgumentParser(__name__)
     parser.add_argument("--config-file", help="Location of a JSON file which contains non secret configuration information", default="config.json")
     parser.add_argument("--filewall-config-file", help="Location of a JSON which will be used to write the firewall config data", default="firewall_config.json")
+    parser.add_argument("--port", help="Port to serve requests over", type=int, default=80)
+    parser.add_argument("--host", help="Host to serve requests from", default="0.0.0.0")
+    parser.add_argument("--workers", help="Serve requests from this many processes. "
+        "SIGHUP restarts the workers without dropping requests", type=int, default=0)
+    parser.add_argument("--max-requests", help="Replace a worker process after it has served this many requests", type=int, default=0)
+    parser.add_argument("--max-memory", help="Replace a worker process once it has used this many megabytes of memory", type=int, default=0)
     args = parser.parse_args()
 
     # HACK: this is a hack, need to be replaced by a paramterz
     with open(args.config_file) as configJSON_fp:
         configJSON = json.load(configJSON_fp)
 
-    server = FirewallConfigServer(
+    configure_identity_cache(
+        expiry=configJSON.get("authCacheExpiry", DEFAULT_IDENTITY_CACHE_EXPIRY),
+        rejected_expiry=configJSON.get("authRejectedCacheExpiry", DEFAULT_REJECTED_TOKEN_CACHE_EXPIRY)
+    )
+
+    create_server = lambda: FirewallConfigServer(
         partial(normal_auth, configJSON["googleClientId"]),
-        args.filewall_config_file
+        args.filewall_config_file,
+        dns_timeout=configJSON.get("dnsLookupTimeout", DEFAULT_DNS_TIMEOUT)
     )
 
-    server.app.run(port=80, host="0.0.0.0")
+    if args.workers > 0:
+        # Each worker has its own server, so the config file is watched and the resolver is run per process
+        PreforkLauncher(
+            lambda: create_server().app.app,
+            args.host,
+            args.port,
+            args.workers,
+            max_requests=args.max_requests,
+            max_memory_mb=args.max_memory,
+            logger=logger.getChild("launcher")
+        ).run()
+    else:
+        create_server().app.run(port=args.port, host=args.host)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,37 @@
+"""Prometheus metrics for the firewall config server, exposed at /metrics"""
+
+import os
+
+import flask
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest)
+from prometheus_client import multiprocess
+
+METRICS_PATH = "/metrics"
+
+# Url validation is expected to take a few milliseconds, so the buckets start small
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+OPERATION_LATENCY = Histogram("firewall_config_operation_duration_seconds",
+    "Time taken handling API operations", ["operation"], buckets=LATENCY_BUCKETS)
+OPERATION_ERRORS = Counter("firewall_config_operation_errors_total",
+    "API operations that raised an error", ["operation", "error"])
+
+DNS_LOOKUP_LATENCY = Histogram("firewall_config_dns_lookup_duration_seconds",
+    "Time taken by uncached DNS lookups of url hostnames", ["outcome"], buckets=LATENCY_BUCKETS)
+DNS_WAIT_LATENCY = Histogram("firewall_config_dns_wait_duration_seconds",
+    "Time url validations spent waiting for hostnames to be resolved, including cached resolutions",
+    buckets=LATENCY_BUCKETS)
+
+def metrics_response():
+    """
+    Flask view with the metrics in the Prometheus text format.
+    When running several worker processes, prometheus_multiproc_dir needs to be set so every worker is counted.
+    """
+    if "prometheus_multiproc_dir" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return flask.Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
@@ -0,0 +1,147 @@
+"""Caching DNS resolution for validating urls"""
+
+import ipaddress
+import socket
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from typing import Dict, List, Union
+
+from cachetools import TTLCache
+
+from .metrics import DNS_LOOKUP_LATENCY, DNS_WAIT_LATENCY
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_TTL = 60
+DEFAULT_NEGATIVE_TTL = 10
+DEFAULT_TIMEOUT = 2
+DEFAULT_MAX_WORKERS = 8
+
+DEFAULT_PORTS = {
+    "http": 80,
+    "https": 443
+}
+
+class ResolutionError(Exception):
+    pass
+
+def default_port(scheme: str) -> int:
+    """
+    Port used by a url with the given scheme, when it doesn't have a port
+    """
+    return DEFAULT_PORTS.get(scheme, 80)
+
+class CachingResolver:
+    """
+    Resolves hostnames to their IPv4 and IPv6 addresses using getaddrinfo.
+
+    Results (and failures, for a shorter time) are cached, concurrent lookups of the same host
+    share one getaddrinfo call, and lookups run on a thread pool so that a slow DNS server
+    can only stall a request for the timeout.
+    """
+    def __init__(self, cache_size: int = DEFAULT_CACHE_SIZE,
+                 ttl: float = DEFAULT_TTL,
+                 negative_ttl: float = DEFAULT_NEGATIVE_TTL,
+                 timeout: float = DEFAULT_TIMEOUT,
+                 max_workers: int = DEFAULT_MAX_WORKERS) -> None:
+        self._addresses = TTLCache(maxsize=cache_size, ttl=ttl)
+        self._failures = TTLCache(maxsize=cache_size, ttl=negative_ttl)
+        self._in_flight = {} # type: Dict[str, Future]
+        # cachetools caches aren't thread safe
+        self._lock = threading.Lock()
+
+        self._timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    @staticmethod
+    def _getaddrinfo(hostname: str):
+        try:
+            address_infos = socket.getaddrinfo(hostname, None, proto=socket.IPPROTO_TCP)
+        except (socket.gaierror, UnicodeError) as e:
+            raise ResolutionError(f"Failed resolving {hostname}: {e}") from e
+
+        addresses = []
+        for (family, _, _, _, sockaddr) in address_infos:
+            if family in (socket.AF_INET, socket.AF_INET6):
+                address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+                if address not in addresses:
+                    addresses.append(address)
+
+        if len(addresses) == 0:
+            raise ResolutionError(f"{hostname} has no addresses")
+
+        return addresses
+
+    def _lookup(self, hostname: str, future: Future):
+        start = time.monotonic()
+        try:
+            addresses = CachingResolver._getaddrinfo(hostname)
+        except ResolutionError as e:
+            DNS_LOOKUP_LATENCY.labels("failure").observe(time.monotonic() - start)
+            with self._lock:
+                self._failures[hostname] = e
+                del self._in_flight[hostname]
+            future.set_exception(e)
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[hostname]
+            future.set_exception(e)
+        else:
+            DNS_LOOKUP_LATENCY.labels("success").observe(time.monotonic() - start)
+            with self._lock:
+                self._addresses[hostname] = addresses
+                del self._in_flight[hostname]
+            future.set_result(addresses)
+
+    def resolve_async(self, hostname: str) -> Future:
+        """
+        Returns a future of the addresses of hostname
+        """
+        # Hostnames that are ip addresses don't need resolving
+        try:
+            address = ipaddress.ip_address(hostname.strip("[]"))
+        except ValueError:
+            pass
+        else:
+            future = Future()
+            future.set_result([address])
+            return future
+
+        hostname = hostname.lower()
+
+        with self._lock:
+            addresses = self._addresses.get(hostname)
+            failure = self._failures.get(hostname)
+            future = self._in_flight.get(hostname)
+
+            if addresses is None and failure is None and future is None:
+                future = Future()
+                self._in_flight[hostname] = future
+                self._executor.submit(self._lookup, hostname, future)
+
+        if future is None:
+            future = Future()
+            if failure is not None:
+                future.set_exception(failure)
+            else:
+                future.set_result(addresses)
+
+        return future
+
+    def result(self, future: Future) -> List[Union[ipaddress.IPv4Address, ipaddress.IPv6Address]]:
+        """
+        Waits for a future returned by resolve_async.
+        Raises ResolutionError if it couldn't be resolved within the timeout
+        """
+        try:
+            with DNS_WAIT_LATENCY.time():
+                return future.result(self._timeout)
+        except TimeoutError as e:
+            raise ResolutionError("Timed out resolving hostname") from e
+
+    def resolve(self, hostname: str) -> List[Union[ipaddress.IPv4Address, ipaddress.IPv6Address]]:
+        """
+        Returns the IPv4 and IPv6 addresses of hostname.
+        Raises ResolutionError if it couldn't be resolved within the timeout
+        """
+        return self.result(self.resolve_async(hostname))
@@ -1,7 +1,9 @@
+import ipaddress
 import json
 
 from flask.testing import FlaskClient
 from firewallconfig import FirewallConfigServer, test_auth, ConfigInterface
+from firewallconfig.firewallconfig import FileInterface
 import pytest
 
 class InMemIO:
@@ -16,7 +18,7 @@ class InMemIO:
 
 @pytest.fixture()
 def firewallconfig_server():
-    server = FirewallConfigServer(test_auth, InMemIO(json.dumps(
+    server = FirewallConfigServer(test_auth, ioInterface=InMemIO(json.dumps(
         {
             "firewallRules": [],
             "adminUsers": ["test_user@sanger.ac.uk"]
@@ -27,7 +29,7 @@ def firewallconfig_server():
 
 @pytest.fixture()
 def firewallconfig_server_other():
-    server = FirewallConfigServer(test_auth, InMemIO(json.dumps(
+    server = FirewallConfigServer(test_auth, ioInterface=InMemIO(json.dumps(
         {
             "firewallRules": [],
             "adminUsers": ["other_user@sanger.ac.uk"]
@@ -81,6 +83,11 @@ def test_ConfigInterface():
             "cidr": "127.0.0.0/24",
             "from_port": 1,
             "to_port": 90
+        }, {
+            # localhost can resolve to ::1 too, and every address needs allowing
+            "cidr": "::1/128",
+            "from_port": 1,
+            "to_port": 90
         }, {
             "cidr": "128.0.0.0/31",
             "from_port": 300,
@@ -93,4 +100,250 @@ def test_ConfigInterface():
     assert not interface.is_url_valid("http://example.com")
     assert not interface.is_url_valid("http://localhost:100")
 
-    assert interface.is_url_valid("http://128.0.0.1:350")
\ No newline at end of file
+    assert interface.is_url_valid("http://128.0.0.1:350")
+
+def test_ConfigInterface_overlapping_rules():
+    interface = ConfigInterface({
+        "firewallRules": [{
+            "cidr": "10.0.0.0/8",
+            "from_port": 1,
+            "to_port": 90
+        }, {
+            "cidr": "10.1.0.0/16",
+            "from_port": 1,
+            "to_port": 90
+        }, {
+            "cidr": "10.1.2.0/24",
+            "from_port": 100,
+            "to_port": 200
+        }],
+        "adminUsers": []
+    })
+
+    assert interface.is_url_valid("http://10.1.2.3:80")
+    assert interface.is_url_valid("http://10.200.0.1:80")
+    assert interface.is_url_valid("http://10.1.2.3:150")
+    assert not interface.is_url_valid("http://10.1.3.3:150")
+    assert not interface.is_url_valid("http://11.0.0.1:80")
+
+
+def test_ConfigInterface_ipv6_and_default_ports():
+    interface = ConfigInterface({
+        "firewallRules": [{
+            "cidr": "::1/128",
+            "from_port": 443,
+            "to_port": 443
+        }],
+        "adminUsers": []
+    })
+
+    assert interface.is_url_valid("https://[::1]")
+    assert not interface.is_url_valid("http://[::1]")
+    assert not interface.is_url_valid("https://nonexistent.invalid")
+
+def test_ConfigInterface_mixed_ip_versions():
+    interface = ConfigInterface({
+        "firewallRules": [{
+            "cidr": "10.0.0.0/8",
+            "from_port": 1,
+            "to_port": 90
+        }, {
+            "cidr": "fd00::/8",
+            "from_port": 1,
+            "to_port": 90
+        }],
+        "adminUsers": []
+    })
+    ipv4_only = ConfigInterface({
+        "firewallRules": [{
+            "cidr": "10.0.0.0/8",
+            "from_port": 1,
+            "to_port": 90
+        }],
+        "adminUsers": []
+    })
+    addresses = [ipaddress.ip_address("10.0.0.1"), ipaddress.ip_address("fd00::1")]
+
+    # Once there are rules for both versions, every address must be allowed
+    assert interface.compiledRules.find_rule(addresses, 80) is not None
+    assert interface.compiledRules.find_rule([*addresses, ipaddress.ip_address("fe00::1")], 80) is None
+    # Addresses of a version without rules aren't allowed
+    assert ipv4_only.compiledRules.find_rule(addresses[:1], 80) is not None
+    assert ipv4_only.compiledRules.find_rule(addresses, 80) is None
+    assert ipv4_only.compiledRules.find_rule([ipaddress.ip_address("fd00::1")], 80) is None
+
+def test_ConfigInterface_overlapping_port_ranges():
+    interface = ConfigInterface({
+        "firewallRules": [{
+            "cidr": "10.0.0.0/8",
+            "from_port": 80,
+            "to_port": 80
+        }, {
+            "cidr": "10.1.0.0/16",
+            "from_port": 1,
+            "to_port": 1000
+        }, {
+            "cidr": "10.0.0.0/8",
+            "from_port": 443,
+            "to_port": 8080
+        }],
+        "adminUsers": []
+    })
+    in_both = [ipaddress.ip_address("10.1.0.1")]
+    in_one = [ipaddress.ip_address("10.2.0.1")]
+
+    # The range with the lowest from_port wins
+    assert interface.compiledRules.find_rule(in_both, 80).from_port == 1
+    assert interface.compiledRules.find_rule(in_one, 80).from_port == 80
+    assert interface.compiledRules.find_rule(in_both, 500).from_port == 1
+    assert interface.compiledRules.find_rule(in_one, 500).from_port == 443
+    assert interface.compiledRules.find_rule(in_both, 8080).from_port == 443
+    assert interface.compiledRules.find_rule(in_one, 79) is None
+    assert interface.compiledRules.find_rule(in_both, 0) is None
+    assert interface.compiledRules.find_rule(in_both, 8081) is None
+
+def test_ConfigInterface_addresses_allowed_by_different_rules():
+    interface = ConfigInterface({
+        "firewallRules": [{
+            "cidr": "10.1.0.0/16",
+            "from_port": 1,
+            "to_port": 100
+        }, {
+            "cidr": "10.2.0.0/16",
+            "from_port": 1,
+            "to_port": 100
+        }, {
+            "cidr": "10.3.0.0/16",
+            "from_port": 50,
+            "to_port": 150
+        }],
+        "adminUsers": []
+    })
+    def addresses(*ip_addresses):
+        return [ipaddress.ip_address(ip_address) for ip_address in ip_addresses]
+
+    # Every address needs allowing, but not by the same rule, nor rules of the same port range
+    assert interface.compiledRules.find_rule(addresses("10.1.0.1", "10.2.0.1"), 80).cidr == "10.1.0.0/16"
+    assert interface.compiledRules.find_rule(addresses("10.1.0.1", "10.3.0.1"), 80) is not None
+    assert interface.compiledRules.find_rule(addresses("10.1.0.1", "10.3.0.1"), 120) is None
+    assert interface.compiledRules.find_rule(addresses("10.1.0.1", "10.4.0.1"), 80) is None
+
+def test_validate_urls(firewallconfig_server: FirewallConfigServer):
+    assert firewallconfig_server.put(
+        "/config",
+        data=json.dumps({
+            "firewallRules": [{
+                "cidr": "127.0.0.0/24",
+                "from_port": 1,
+                "to_port": 90
+            }],
+            "adminUsers": ["test_user@sanger.ac.uk"]
+        }),
+        content_type='application/json',
+        **auth
+    ).status_code == 204
+
+    resp = firewallconfig_server.post(
+        "/isvalid/batch",
+        data=json.dumps(["http://127.0.0.1", "http://127.0.0.1:100", "http://nonexistent.invalid"]),
+        content_type='application/json',
+        **auth
+    )
+
+    assert resp.status_code == 200
+
+    results = json.loads(resp.data)
+    assert [result["valid"] for result in results] == [True, False, False]
+    assert results[0]["rule"]["cidr"] == "127.0.0.0/24"
+    assert "error" in results[2]
+
+def test_metrics(firewallconfig_server: FirewallConfigServer):
+    assert firewallconfig_server.get("/isvalid?url=http%3A%2F%2Flocalhost", **auth).status_code == 200
+    assert firewallconfig_server.get("/config", headers={"user": "other_user@sanger.ac.uk"}).status_code == 403
+
+    resp = firewallconfig_server.get("/metrics")
+
+    assert resp.status_code == 200
+    metrics = resp.data.decode()
+    assert 'firewall_config_operation_duration_seconds_count{operation="is_url_valid"}' in metrics
+    assert 'firewall_config_operation_errors_total{error="NotAuthorisedError",operation="get_config"}' in metrics
+    assert 'firewall_config_dns_lookup_duration_seconds_count{outcome="success"}' in metrics
+    assert "firewall_config_dns_wait_duration_seconds_count" in metrics
+
+def test_FileInterface(tmpdir):
+    config_file = tmpdir.join("firewall_config.json")
+    config_file.write("{}")
+
+    io_interface = FileInterface(str(config_file), poll_interval=0)
+    assert io_interface.get() == "{}"
+
+    io_interface.set('{"a": 1}')
+    assert io_interface.get() == '{"a": 1}'
+    assert [path.basename for path in tmpdir.listdir()] == ["firewall_config.json"]
+
+    # External edits are picked up
+    config_file.write('{"b": 20}')
+    assert io_interface.get() == '{"b": 20}'
+
+def test_config_generation(firewallconfig_server: FirewallConfigServer):
+    first_generation = json.loads(firewallconfig_server.get("/config/generation").data)
+
+    assert firewallconfig_server.put(
+        "/config",
+        data=json.dumps({
+            "firewallRules": [],
+            "adminUsers": ["test_user@sanger.ac.uk", "new_user@sanger.ac.uk"]
+        }),
+        content_type='application/json',
+        **auth
+    ).status_code == 204
+
+    second_generation = json.loads(firewallconfig_server.get("/config/generation").data)
+
+    assert second_generation["generation"] == first_generation["generation"] + 1
+    assert second_generation["digest"] != first_generation["digest"]
+
+def test_set_invalid_config(firewallconfig_server: FirewallConfigServer):
+    config = json.loads(firewallconfig_server.get("/config", **auth).data)
+
+    resp = firewallconfig_server.put(
+        "/config",
+        data=json.dumps({
+            "firewallRules": [{
+                "cidr": "not a cidr",
+                "from_port": 1,
+                "to_port": 90
+            }],
+            "adminUsers": ["test_user@sanger.ac.uk"]
+        }),
+        content_type='application/json',
+        **auth
+    )
+
+    assert resp.status_code == 400
+    assert json.loads(resp.data)["error_num"] == 6
+
+    # The stored config is unchanged, so admins can still use the API
+    get_resp = firewallconfig_server.get("/config", **auth)
+    assert get_resp.status_code == 200
+    assert json.loads(get_resp.data) == config
+
+def test_invalid_config_file_keeps_last_valid_config():
+    io_interface = InMemIO(json.dumps({
+        "firewallRules": [],
+        "adminUsers": ["test_user@sanger.ac.uk"]
+    }))
+    test_client = FirewallConfigServer(test_auth, ioInterface=io_interface).app.app.test_client()
+
+    # Such as a bad manual edit of the file
+    io_interface.data = json.dumps({
+        "firewallRules": [{
+            "cidr": "300.0.0.0/8",
+            "from_port": 1,
+            "to_port": 90
+        }],
+        "adminUsers": []
+    })
+
+    assert json.loads(test_client.get("/amIAdmin", **auth).data) is True
+    assert json.loads(test_client.get("/config/generation").data)["generation"] == 1